@@ -7,28 +7,28 @@ fi
 
 NAME="flashcube"                            # Name of the application
 APPDIR=/var/apps/flashcube                  # Application project directory
-SOCKFILE=/var/apps/flashcube/gunicorn.sock  # Using a socket
-BIND="127.0.0.1:8000"                       # Using a port
+CONFIG=$APPDIR/flashcube/gunicorn_conf.py   # Gunicorn configuration module
+PIDFILE=$APPDIR/gunicorn.pid                # Master process id, for reloads
 USER="www-data"                             # User to run as
 GROUP="www-data"                            # Group to run as
-WORKERS=1                                   # How many worker processes
 
-echo "Starting $NAME"
+# Workers are sized from the CPU count; uncomment to override
+# export FLASHCUBE_WORKERS=4                # How many worker processes
+# export FLASHCUBE_WORKER_CLASS="gevent"    # Use "gevent" for the async mode
+export FLASHCUBE_BIND="127.0.0.1:8000"      # Using a port (or unix:$APPDIR/gunicorn.sock)
 
-# Collect the passphrase
-read -s -p "Enter $NAME passphrase: " PASSPHRASE
-echo ""
+echo "Starting $NAME"
 
 # Activate the virtual environment
 source /var/venvs/flashcube/bin/activate
 export FLASHCUBE_SETTINGS="flashcube.conf.ProductionConfig"
-export FLASHCUBE_PASSPHRASE=$PASSPRHASE
 
-# Start the Flask Gunicorn
-exec gunicorn $NAME:app \
+# Start the Flask Gunicorn; the master prompts for the passphrase once,
+# before it daemonizes, and hands the secret to the workers as it forks
+# them. Reload gracefully (without the passphrase) with: kill -HUP $(cat $PIDFILE)
+cd $APPDIR
+exec gunicorn $NAME.wsgi:app \
+    --config $CONFIG \
+    --pid $PIDFILE \
     --user $USER --group $GROUP \
-    --bind $BIND \
-    --workers $WORKERS \
-    --chdir $APPDIR \
-    --env FLASHCUBE_PASSPHRASE=$PASSPHRASE \
     --daemon
@@ -0,0 +1,38 @@
+/**
+ * 0001_credential_ciphertext.sql
+ * Copyright 2015 Bengfort.com
+ * Version: Flashcube v2
+ *
+ * Author:  Benjamin Bengfort <benjamin@bengfort.com>
+ *
+ * ALTER statements to add binary ciphertext storage to a Flashcube v2
+ * database created before the "ciphertext" column existed.
+ *
+ * Adding a nullable column without a default does not rewrite the table,
+ * so this can be applied online. Existing rows keep their base64 value in
+ * "password" until they are converted with `flashcube-migrate`.
+ */
+
+-------------------------------------------------------------------------
+-- Ensure transaction security by placing all CREATE and ALTER statements
+-- inside of `BEGIN` and `COMMIT` statements.
+-------------------------------------------------------------------------
+
+BEGIN;
+
+ALTER TABLE "credential"
+    ADD COLUMN IF NOT EXISTS "ciphertext" BYTEA;
+
+ALTER TABLE "credential"
+    ALTER COLUMN "password" DROP NOT NULL;
+
+-- NOT VALID skips the scan of existing rows, which already satisfy it.
+ALTER TABLE "credential"
+    ADD CONSTRAINT "chk_credential_ciphertext"
+    CHECK ("password" IS NOT NULL OR "ciphertext" IS NOT NULL) NOT VALID;
+
+COMMIT;
+
+-------------------------------------------------------------------------
+-- No CREATE or ALTER statements should be outside of the `COMMIT`.
+-------------------------------------------------------------------------
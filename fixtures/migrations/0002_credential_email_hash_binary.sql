@@ -0,0 +1,34 @@
+/**
+ * 0002_credential_email_hash_binary.sql
+ * Copyright 2015 Bengfort.com
+ * Version: Flashcube v2
+ *
+ * Author:  Benjamin Bengfort <benjamin@bengfort.com>
+ *
+ * ALTER statements to store the email hash of an existing Flashcube v2
+ * database as the 32 byte SHA-256 digest instead of base64 text, for use
+ * with FLASHCUBE_HASH_STORAGE = "binary".
+ *
+ * Changing the column type rewrites the table and its indices while
+ * holding an exclusive lock, so apply this during a maintenance window.
+ */
+
+-------------------------------------------------------------------------
+-- Ensure transaction security by placing all CREATE and ALTER statements
+-- inside of `BEGIN` and `COMMIT` statements.
+-------------------------------------------------------------------------
+
+BEGIN;
+
+-- The UNIQUE constraint already indexes "email_hash".
+DROP INDEX IF EXISTS "idx_credential_email_hash";
+
+ALTER TABLE "credential"
+    ALTER COLUMN "email_hash" TYPE BYTEA
+    USING decode("email_hash", 'base64');
+
+COMMIT;
+
+-------------------------------------------------------------------------
+-- No CREATE or ALTER statements should be outside of the `COMMIT`.
+-------------------------------------------------------------------------
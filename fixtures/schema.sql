@@ -10,6 +10,9 @@
  * Created: Fri Oct 16 20:53:09 2015 -0400
  *
  * CREATE statements for tables and indicies of the Flashcube Schema v2
+ *
+ * This file is a template rendered by `flashcube.syncdb`, which fills in
+ * the named placeholders from the application configuration.
  */
 
 -------------------------------------------------------------------------
@@ -47,28 +50,29 @@ CREATE TABLE IF NOT EXISTS "client"
 
 -- DROP TABLE IF EXISTS "credential";
 
-CREATE TABLE IF NOT EXISTS "credential"
+-- If FLASHCUBE_PARTITIONS is set, the table is hash partitioned on
+-- "email_hash"; the primary key must then include the partition key.
+
+CREATE TABLE IF NOT EXISTS "%(credential_table)s"
 (
-    "id" BIGSERIAL NOT NULL PRIMARY KEY,
-    "email_hash" CHAR(44) NOT NULL UNIQUE,
-    "password" VARCHAR(512) NOT NULL,
+    "id" BIGSERIAL NOT NULL,
+    "email_hash" %(email_hash_type)s NOT NULL UNIQUE,
+    "password" VARCHAR(512),
+    "ciphertext" BYTEA,
     "created" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    "updated" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
-);
-
+    "updated" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT "%(credential_table)s_pkey" PRIMARY KEY (%(credential_primary_key)s),
+    CONSTRAINT "chk_credential_ciphertext"
+        CHECK ("password" IS NOT NULL OR "ciphertext" IS NOT NULL)
+)%(credential_partition_by)s;
+%(credential_partitions)s
 /**
  *  CREATE INDICIES
  */
 
--- DROP INDEX IF EXISTS "idx_client_apikey"
-
-CREATE INDEX "idx_client_apikey"
-    ON "client" USING BTREE("apikey");
-
--- DROP INDEX IF EXISTS "idx_credential_email_hash"
-
-CREATE INDEX "idx_credential_email_hash"
-    ON "credential" USING BTREE("email_hash");
+-- The UNIQUE constraints on "client"."apikey" and "credential"."email_hash"
+-- already create BTREE indices on those columns, so no further indices
+-- are required (see `flashcube-indexes` to audit an existing database).
 
 COMMIT;
 
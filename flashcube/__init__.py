@@ -12,101 +12,18 @@
 """
 A simple, standalone CryptoService for member data integrity.
 
-This file contains Flask-specific details. All that's required is to import
-this module, and run the app.
+Importing this package does not import Flask, so that the command line
+utilities that do not need the app (e.g. flashcube-keygen) start quickly.
+The app and its extensions are in `flashcube.core`; serve the app returned
+by `create_app`, e.g. `flashcube.wsgi:app` with gunicorn.
 """
 
 __version__ = (0, 1, 1)
 
-import os
 
-from flask import Flask, jsonify
-from getpass import getpass
-from flask.ext.restful import Api
-from flask.ext.sqlalchemy import SQLAlchemy
-from flashcube.cipher import EncryptedFileKey, CheckSumError
-
-# Create Flask App
-app  = Flask(__name__)
-api  = Api(app)
-
-# Configure the App
-app.config.from_object('flashcube.conf.Config')
-if os.environ.get('FLASHCUBE_SETTINGS', None):
-    app.config.from_object(os.environ['FLASHCUBE_SETTINGS'])
-
-
-def prompt_for_secret(keypath=None, password=None):
+def create_app(config=None):
     """
-    Prompts for the secret key to decrypt the keyfile before loading.
+    Configures and returns the Flashcube app; see `flashcube.core`.
     """
-    keypath  = keypath or app.config['FLASHCUBE_KEY']
-
-    if not os.path.exists(keypath):
-        return None
-
-    keyfile  = EncryptedFileKey(keypath)
-    password = password or os.environ.get('FLASHCUBE_PASSPHRASE', None)
-    password = password or getpass("Passphrase for Flashcube Key: ")
-
-    try:
-        return keyfile.read(password)
-    except CheckSumError:
-        return prompt_for_secret()
-
-
-def syncdb(schema=None):
-    schema = schema or app.config.get('DATABASE_SCHEMA_PATH', None)
-
-    if not schema:
-        # Search for the fixture path
-        base = os.path.dirname(os.path.abspath(__file__))
-        name = 'fixtures/schema.sql'
-        for path in [os.path.join(base, name),
-                     os.path.realpath(os.path.join(base, '..', name))]:
-
-            if os.path.exists(path):
-                schema = path
-                break
-
-        if not schema:
-            raise Exception("Could not find schema to sync to database. "
-                            "Please specify one in the config.")
-
-    with open(schema, 'r') as data:
-        create = data.read()
-        db.session.execute(create)
-        db.session.commit()
-
-
-# Get the secret key from the command line if not skip and not secret.
-if (not app.config['FLASHCUBE_SECRET'] and
-    not os.environ.get('SKIP_FLASHCUBE_CRYPTO', False) and
-    not app.config['TESTING']):
-    app.config['FLASHCUBE_SECRET'] = prompt_for_secret()
-
-# Create the Database Object/Session
-db = SQLAlchemy(app)
-
-
-# Create DB Teardown
-@app.teardown_appcontext
-def shutdown_session(exception=None):
-    db.session.remove()
-
-
-# Create the HMAC Authentication Handler
-# Note: for now, must be after db
-from flashcube.auth import HMACAuth
-auth = HMACAuth(app)
-
-
-# Import resources
-# Note: MUST be after app config.
-import flashcube.views
-
-
-# If in production mode, perform ProxyFix
-if os.environ.get('FLASHCUBE_SETTINGS', None) == "flashcube.conf.ProductionConfig":
-    from werkzeug.contrib.fixers import ProxyFix
-    app.wsgi_app = ProxyFix(app.wsgi_app)
+    from flashcube.core import create_app
+    return create_app(config)
@@ -19,18 +19,24 @@ TODO: Refactor to be generic and not access database.
 ## Imports
 ##########################################################################
 
+import os
 import re
+import mmap
 import time
 import hmac
 import base64
+import struct
 import hashlib
 import calendar
+import threading
 
 from flask import request, g
 from datetime import datetime
 from functools import wraps
+from collections import namedtuple, OrderedDict
+from flashcube.core import replicas
 from flashcube.models import *
-from sqlalchemy.orm.exc import *
+from flashcube.queries import get_client
 from flashcube.exceptions import AuthenticationFailure
 
 
@@ -63,6 +69,168 @@ def create_hmac(api_key, secret, timestamp=None):
     return signature
 
 
+def create_hmac_key(secret):
+    """
+    Returns an HMAC-SHA256 object keyed with the secret but with no
+    message. The key padding and the inner and outer pad compressions are
+    computed only once; `copy()` the object to sign each message.
+    """
+    return hmac.new(secret, digestmod=hashlib.sha256)
+
+
+def verify_hmac(hmac_key, api_key, timestamp, code):
+    """
+    Verifies a base64 encoded HMAC signature using a pre-keyed HMAC object
+    from `create_hmac_key`. The raw digests are compared in constant time.
+    """
+    try:
+        code = base64.b64decode(code)
+    except TypeError:
+        return False
+
+    signature = hmac_key.copy()
+    signature.update(api_key + str(timestamp))
+    return hmac.compare_digest(signature.digest(), code)
+
+
+##########################################################################
+## API Client Cache
+##########################################################################
+
+# Lightweight, session-independent copy of a row in the client table,
+# along with the client's pre-keyed HMAC object.
+APIClient = namedtuple('APIClient', 'id name apikey secret hmac_key')
+
+
+class ClientGeneration(object):
+    """
+    A counter shared by every process on the host through a memory mapped
+    file, which is bumped whenever the client table changes (e.g. by the
+    flashcube-addclient utility) so that the ClientCache of every worker
+    drops the clients it cached before. Reading it is only a memory read,
+    so it is checked on every cache hit. Two concurrent bumps may only
+    count once, but either way the value changes.
+
+    Without a path, or if the file cannot be opened by a worker, the
+    generation never changes and cached clients only expire.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._map = None
+
+    def open(self):
+        """
+        Maps the counter file, creating it if needed. Raises if it cannot.
+        """
+        if self._map is None and self.path:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                if os.fstat(fd).st_size < 8:
+                    os.ftruncate(fd, 8)
+                self._map = mmap.mmap(fd, 8)
+            finally:
+                os.close(fd)
+        return self._map
+
+    @property
+    def value(self):
+        try:
+            counter = self.open()
+        except (IOError, OSError):
+            self.path = None
+            return 0
+
+        return struct.unpack_from("Q", counter)[0] if counter is not None else 0
+
+    def bump(self):
+        """
+        Increments the counter, invalidating the clients cached by every
+        process on the host.
+        """
+        counter = self.open()
+        if counter is not None:
+            struct.pack_into("Q", counter, 0, (struct.unpack_from("Q", counter)[0] + 1) % (1 << 64))
+
+
+class ClientCache(object):
+    """
+    A bounded, in-process cache of API clients keyed by apikey, so that
+    authentication does not require a database query on every request.
+    Entries expire after `ttl` seconds; unknown api keys are cached as
+    `None` for `negative_ttl` seconds so that floods of invalid keys do
+    not reach the database. When more than `maxsize` keys are cached the
+    least recently used entry is evicted.
+
+    Entries cached before the shared `generation` changed are misses, so
+    that a change to the client table is seen at once by every process on
+    the host that bumps the generation. Workers on other hosts see a new
+    client within `negative_ttl` seconds, and a changed or removed client
+    within `ttl` seconds.
+    """
+
+    # Sentinel for a cache miss, since None is a valid (negative) entry.
+    MISSING = object()
+
+    def __init__(self, maxsize=128, ttl=60, negative_ttl=5, timer=time.time, generation=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timer = timer
+        self.generation = generation or ClientGeneration()
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, apikey):
+        """
+        Returns the cached client (or None for a cached unknown key) or
+        `ClientCache.MISSING` if the key is not cached or has expired.
+        """
+        with self._lock:
+            try:
+                expires, generation, client = self._data.pop(apikey)
+            except KeyError:
+                return self.MISSING
+
+            if expires <= self.timer() or generation != self.generation.value:
+                return self.MISSING
+
+            # Reinsert to mark as most recently used
+            self._data[apikey] = (expires, generation, client)
+            return client
+
+    def set(self, apikey, client, generation=None):
+        """
+        Caches the client for the apikey; pass None to negatively cache
+        an apikey that is not in the client table. Pass the generation read
+        before the client was fetched, so that a change to the table made
+        meanwhile is not cached as current.
+        """
+        ttl = self.ttl if client is not None else self.negative_ttl
+        if generation is None:
+            generation = self.generation.value
+
+        with self._lock:
+            self._data.pop(apikey, None)
+            self._data[apikey] = (self.timer() + ttl, generation, client)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, apikey=None):
+        """
+        Removes the apikey from the cache, or clears the entire cache if
+        no apikey is specified.
+        """
+        with self._lock:
+            if apikey is None:
+                self._data.clear()
+            else:
+                self._data.pop(apikey, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
 ##########################################################################
 ## HMAC Authentication
 ##########################################################################
@@ -79,6 +247,7 @@ class HMACAuth(object):
     def __init__(self, app=None):
         # Store Default Settings
         self.authre = re.compile(r'^FLASHCUBE\s+([a-zA-Z0-9]{22}):([a-zA-Z0-9+/=]{44})$')
+        self.cache  = ClientCache()
 
         # Init the app
         if app is not None:
@@ -92,8 +261,26 @@ class HMACAuth(object):
         :param app: The `flask.Flask` object to configure
         """
 
+        if getattr(app, 'auth', None) is not self:
+            app.before_request(self._load_api_client)
         app.auth = self
-        app.before_request(self._load_api_client)
+
+        self.cache = ClientCache(
+            maxsize=app.config.get('CLIENT_CACHE_SIZE', 128),
+            ttl=app.config.get('CLIENT_CACHE_TTL', 60),
+            negative_ttl=app.config.get('CLIENT_NEGATIVE_TTL', 5),
+            generation=ClientGeneration(app.config.get('CLIENT_GENERATION_PATH', None)),
+        )
+
+    def invalidate(self, apikey=None):
+        """
+        Invalidates the cached api client for the apikey, or all cached
+        clients if no apikey is specified, in this process; then bumps the
+        shared generation so that every process on the host drops all of
+        its cached clients. Call this after modifying the client table.
+        """
+        self.cache.invalidate(apikey)
+        self.cache.generation.bump()
 
     def unauthorized(self):
         """
@@ -126,9 +313,8 @@ class HMACAuth(object):
         except ValueError:
             raise AuthenticationFailure("Could not parse Time header")
 
-        try:
-            client = Client.query.filter(Client.apikey==apikey).one()
-        except (NoResultFound, MultipleResultsFound):
+        client = self.get_api_client(apikey)
+        if client is None:
             ctx.client = None
             return
 
@@ -136,6 +322,27 @@ class HMACAuth(object):
         ctx.timestamp = timestamp
         ctx.hmac_code = code
 
+    def get_api_client(self, apikey):
+        """
+        Returns the api client for the apikey from the cache, otherwise
+        fetches it from the database and caches the result (including a
+        negative result if the apikey does not exist).
+        """
+        client = self.cache.get(apikey)
+        if client is not ClientCache.MISSING:
+            return client
+
+        generation = self.cache.generation.value
+        client     = None
+        row    = replicas.run(lambda session: get_client(session, apikey))
+        if row is not None:
+            secret = str(row.secret)
+            client = APIClient(row.id, row.name, str(row.apikey), secret,
+                               create_hmac_key(secret))
+
+        self.cache.set(apikey, client, generation)
+        return client
+
     def check_auth(self):
         """
         Checks the authorization header for the key details and determines
@@ -144,8 +351,7 @@ class HMACAuth(object):
         if g.client is None:
             return False
 
-        code = create_hmac(str(g.client.apikey), str(g.client.secret), g.timestamp)
-        return g.hmac_code == code
+        return verify_hmac(g.client.hmac_key, g.client.apikey, g.timestamp, g.hmac_code)
 
     def required(self, func):
         @wraps(func)
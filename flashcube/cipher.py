@@ -22,13 +22,69 @@ Crypto methodology and references:
 ## Imports
 ##########################################################################
 
+import os
 import zlib
 import base64
 import struct
 import hashlib
+import threading
 
-from Crypto import Random
 from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+
+##########################################################################
+## Initialization Vectors
+##########################################################################
+
+class IVPool(object):
+    """
+    A per-process source of initialization vectors. Random bytes are read
+    from the operating system CSPRNG (os.urandom) in large blocks and
+    handed out in IV sized slices, rather than creating a new random
+    number generator for every encryption.
+
+    The buffer is discarded whenever the process id changes, so forked
+    processes (e.g. gunicorn workers) never hand out the IVs buffered by
+    their parent or by each other.
+    """
+
+    def __init__(self, size=AES.block_size, count=256):
+        """
+        size      - the length of each initialization vector
+        count     - the number of vectors to read from the OS at once
+        """
+        self.size  = size
+        self.count = count
+        self._lock = threading.Lock()
+        self.reseed()
+
+    def reseed(self):
+        """
+        Discards any buffered random bytes.
+        """
+        self._pid    = os.getpid()
+        self._buffer = ""
+        self._offset = 0
+
+    def read(self):
+        """
+        Returns the next initialization vector from the pool.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self.reseed()
+
+            if self._offset >= len(self._buffer):
+                self._buffer = os.urandom(self.size * self.count)
+                self._offset = 0
+
+            invec = self._buffer[self._offset:self._offset+self.size]
+            self._offset += self.size
+            return invec
+
+
+# The IV pool shared by every Cipher in this process.
+ivpool = IVPool()
 
 ##########################################################################
 ## Cipher Objects
@@ -44,8 +100,17 @@ class CheckSumError(Exception):
 class Cipher(object):
     """
     Cipher object- utility for encryption and decryption.
+
+    The AES key schedule for the secret is computed once (as an ECB block
+    cipher) and reused by every operation; CBC chaining with the IV is
+    applied to the blocks here rather than creating a new AES object for
+    every encryption or decryption.
     """
 
+    # Plaintexts of up to this many blocks are chained with the cached key
+    # schedule; longer ones are faster with a new CBC object.
+    chain_blocks = 3
+
     def __init__(self, secret, lazy=True):
         """
         Create a Cipher object with the secret. If lazy is True, then pad
@@ -55,6 +120,15 @@ class Cipher(object):
         """
         self.secret = self._lazysecret(secret) if lazy else secret
 
+    @property
+    def secret(self):
+        return self._secret
+
+    @secret.setter
+    def secret(self, secret):
+        self._secret = secret
+        self._blockcipher = None
+
     #####################################################################
     ## The big show- the main promise interface
     #####################################################################
@@ -73,20 +147,14 @@ class Cipher(object):
 
         @returns: ciphertext (ascii)
         """
-        invec  = Random.new().read(AES.block_size)
-        encobj = AES.new(self.secret, AES.MODE_CBC, invec)
-
         if isinstance(plaintext, unicode):
             plaintext = plaintext.encode('utf8')
 
-        if checksum:
-            plaintext += self.crc32(plaintext)
-
-        ciphertext = encobj.encrypt(self.pad(plaintext))
+        ciphertext = self.encrypt_bytes(plaintext, checksum)
 
         if encode:
-            return base64.b64encode( invec + ciphertext )
-        return invec + ciphertext
+            return base64.b64encode(ciphertext)
+        return ciphertext
 
     def decrypt(self, ciphertext, checksum=True, decode=True):
         """
@@ -102,22 +170,231 @@ class Cipher(object):
         if decode:
             ciphertext = base64.b64decode(ciphertext)
 
-        invec     = ciphertext[:16]
-        encobj    = AES.new(self.secret, AES.MODE_CBC, invec)
-        plaintext = encobj.decrypt(ciphertext[16:])
-        plaintext = self.unpad(plaintext)
+        return self.decrypt_bytes(ciphertext, checksum).decode('utf8')
+
+    #####################################################################
+    ## Binary interface for raw ciphertext storage
+    #####################################################################
 
+    def encrypt_bytes(self, plaintext, checksum=True):
+        """
+        Encrypt binary plaintext with the secret key, returning the raw IV
+        and ciphertext without base64 encoding. The plaintext, checksum
+        and padding are copied into one preallocated buffer rather than
+        built up by string concatenation; the encrypted blocks are then
+        joined with the IV into a new string.
+
+        plaintext - content to encrypt (str, bytearray, buffer or memoryview)
+        checksum  - attach crc32 byte encoded
+
+        @returns: ciphertext (binary)
+        """
+        size      = AES.block_size
+        plaintext = self._readable(plaintext)
+        length    = len(plaintext) + 4 if checksum else len(plaintext)
+        ordn      = size - length % size
+
+        padded = bytearray(length + ordn)
+        padded[:len(plaintext)] = plaintext
         if checksum:
-            crc, plaintext = (plaintext[-4:], plaintext[:-4])
-            if not crc == self.crc32(plaintext):
-                raise CheckSumError("Checksum mismatch")
+            struct.pack_into("i", padded, len(plaintext), zlib.crc32(plaintext))
+        padded[length:] = ordn * chr(ordn)
+
+        invec = ivpool.read()
+        return invec + self.cbc_encrypt(invec, buffer(padded))
+
+    def decrypt_bytes(self, ciphertext, checksum=True):
+        """
+        Decrypt raw binary ciphertext with the secret key, returning the
+        binary plaintext without decoding it. The IV is assumed to be the
+        first 16 bytes of the ciphertext; the blocks after it are passed to
+        the block cipher as a view, but the XOR mask is a copy of the IV
+        and all but the last block, and the plaintext is a new string.
+
+        ciphertext - encrypted content (str, bytearray, buffer or memoryview)
+        checksum   - verify crc32 byte encoded checksum
+
+        @returns: plaintext (binary)
+        """
+        size       = AES.block_size
+        ciphertext = self._readable(ciphertext)
+
+        # The XOR mask is the IV and all but the last ciphertext block.
+        plaintext = self.blockcipher.decrypt(buffer(ciphertext, size))
+        plaintext = strxor(plaintext, ciphertext[:-size])
+        return self._unwrap(plaintext, checksum)
+
+    #####################################################################
+    ## Batch interface for vectors of records
+    #####################################################################
+
+    def encrypt_many(self, plaintexts, checksum=True, encode=True):
+        """
+        Encrypt an iterable of plaintexts, returning a list of ciphertexts
+        in the same order; each is identical in format to `encrypt`. The
+        CBC chains of every plaintext are advanced in lockstep so that the
+        block cipher is called once per block position for the entire
+        batch rather than once per block of every plaintext.
+
+        plaintexts - iterable of content to encrypt (ascii or unicode)
+        checksum   - attach crc32 byte encoded
+        encode     - return as base64 strings instead of binary
+
+        @returns: list of ciphertexts (ascii)
+        """
+        size   = AES.block_size
+        padded = []
+        for plaintext in plaintexts:
+            if isinstance(plaintext, unicode):
+                plaintext = plaintext.encode('utf8')
+            if checksum:
+                plaintext += self.crc32(plaintext)
+            padded.append(self.pad(plaintext))
+
+        chains  = [ivpool.read() for plaintext in padded]
+        outputs = [[invec] for invec in chains]
+        offset  = 0
+
+        while True:
+            active = [idx for idx, plaintext in enumerate(padded) if len(plaintext) > offset]
+            if not active: break
+
+            blocks = "".join(padded[idx][offset:offset+size] for idx in active)
+            prevs  = "".join(chains[idx] for idx in active)
+            blocks = self.blockcipher.encrypt(strxor(blocks, prevs))
+
+            for pos, idx in enumerate(active):
+                chains[idx] = blocks[pos*size:(pos+1)*size]
+                outputs[idx].append(chains[idx])
+            offset += size
+
+        if encode:
+            return [base64.b64encode("".join(output)) for output in outputs]
+        return ["".join(output) for output in outputs]
+
+    def decrypt_many(self, ciphertexts, checksum=True, decode=True):
+        """
+        Decrypt an iterable of ciphertexts, returning a list of plaintexts
+        in the same order. Because CBC decryption is parallel, the blocks
+        of the entire batch are decrypted with a single block cipher call.
+
+        Items that cannot be decrypted do not abort the batch; instead the
+        exception (e.g. a `CheckSumError`) is returned in place of the
+        plaintext for that item.
+
+        ciphertexts - iterable of encrypted content to decrypt
+        checksum    - verify crc32 byte encoded checksum
+        decode      - decode ciphertexts from base64 strings if true
+
+        @returns: list of plaintexts (unicode) or exceptions
+        """
+        size    = AES.block_size
+        results = []
+        valid   = []
+
+        for idx, ciphertext in enumerate(ciphertexts):
+            try:
+                if decode:
+                    ciphertext = base64.b64decode(ciphertext)
+                if len(ciphertext) < 2 * size or len(ciphertext) % size:
+                    raise ValueError("Ciphertext is not a whole number of blocks")
+            except (TypeError, ValueError) as e:
+                results.append(e)
+                continue
+
+            results.append(None)
+            valid.append((idx, ciphertext))
+
+        if not valid:
+            return results
+
+        # The XOR mask for each ciphertext is its IV and all but its last block.
+        bodies    = "".join(ciphertext[size:] for idx, ciphertext in valid)
+        masks     = "".join(ciphertext[:-size] for idx, ciphertext in valid)
+        plaintext = strxor(self.blockcipher.decrypt(bodies), masks)
+
+        offset = 0
+        for idx, ciphertext in valid:
+            length  = len(ciphertext) - size
+            results[idx] = self._finish_decrypt(plaintext[offset:offset+length], checksum)
+            offset += length
+
+        return results
+
+    def _finish_decrypt(self, plaintext, checksum=True):
+        """
+        Unpads, verifies and decodes a decrypted plaintext, returning the
+        exception rather than raising it if the plaintext is invalid.
+        """
+        try:
+            return self._unwrap(plaintext, checksum).decode('utf8')
+        except (CheckSumError, UnicodeDecodeError) as e:
+            return e
+
+    #####################################################################
+    ## Block chaining
+    #####################################################################
+
+    @property
+    def blockcipher(self):
+        """
+        The AES cipher in ECB mode for the secret, so that the key
+        expansion happens once per Cipher rather than once per operation.
+        """
+        if self._blockcipher is None:
+            self._blockcipher = AES.new(self.secret, AES.MODE_ECB)
+        return self._blockcipher
+
+    def cbc_encrypt(self, invec, plaintext):
+        """
+        AES-CBC encrypts the padded plaintext with the initialization
+        vector. CBC encryption is sequential, so short plaintexts are
+        chained block by block; longer ones use a new CBC cipher object.
+        """
+        size = AES.block_size
+        if len(plaintext) > self.chain_blocks * size:
+            return AES.new(self.secret, AES.MODE_CBC, invec).encrypt(plaintext)
 
-        return plaintext.decode('utf8')
+        blocks = []
+        for idx in xrange(0, len(plaintext), size):
+            invec = self.blockcipher.encrypt(strxor(plaintext[idx:idx+size], invec))
+            blocks.append(invec)
+        return "".join(blocks)
 
     #####################################################################
     ## Helper methods
     #####################################################################
 
+    def _readable(self, data):
+        """
+        Returns binary data in a form that PyCrypto and zlib accept: a
+        read-only buffer over a bytearray, or the data itself if it is a str
+        or buffer. Memoryviews do not expose the old buffer interface that
+        PyCrypto requires, so they are copied into a str.
+        """
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        if isinstance(data, bytearray):
+            return buffer(data)
+        return data
+
+    def _unwrap(self, plaintext, checksum=True):
+        """
+        Removes the padding and checksum from a decrypted plaintext in a
+        single slice, verifying the checksum over a view of the content.
+        """
+        ordn = ord(plaintext[-1]) if plaintext else 0
+        end  = len(plaintext) - ordn
+        if not 0 < ordn <= AES.block_size or end < 0:
+            raise CheckSumError("Padding mismatch")
+
+        if checksum:
+            end -= 4
+            if end < 0 or plaintext[end:end+4] != struct.pack("i", zlib.crc32(buffer(plaintext, 0, end))):
+                raise CheckSumError("Checksum mismatch")
+
+        return plaintext[:end]
+
     def _lazysecret(self, secret):
         """
         Uses SHA256 to ensure that the secret is 32 bytes long.
@@ -156,6 +433,187 @@ class Cipher(object):
             text = text.encode('UTF8')
         return struct.pack("i", zlib.crc32(text))
 
+
+class UnknownKeyError(CheckSumError):
+    """
+    The ciphertext was encrypted with a key that is not on the keyring.
+    """
+    pass
+
+
+class Keyring(object):
+    """
+    A set of versioned keys, each identified by a key id from 0 to 255, one
+    of which is the current key that encrypts. Ciphertexts are prefixed with
+    a header of a marker byte and the key id, so that decryption uses the
+    key that encrypted them; the header makes the length of a ciphertext 2
+    more than a multiple of the block size, which a ciphertext without one
+    never is. Ciphertexts of key 0 have no header, so that the ciphertexts
+    of a single secret from before keyrings are those of key 0.
+
+    A Keyring has the encryption interface of a Cipher.
+    """
+
+    marker = "\xfc"
+
+    def __init__(self, current=0, secret=None):
+        self.current = current
+        self.ciphers = {}
+
+        if secret is not None:
+            self.add(current, secret)
+
+    def add(self, key_id, secret):
+        """
+        Adds the key with the secret to the keyring.
+        """
+        if not 0 <= key_id <= 255:
+            raise ValueError("Key ids must be between 0 and 255.")
+        if not secret:
+            raise TypeError("Cannot add key %i without a secret." % key_id)
+        self.ciphers[key_id] = Cipher(secret)
+
+    def cipher(self, key_id=None):
+        """
+        Returns the Cipher of the key id (by default, the current key).
+        """
+        key_id = self.current if key_id is None else key_id
+        if key_id not in self.ciphers:
+            raise UnknownKeyError("Key %i is not on the keyring." % key_id)
+        return self.ciphers[key_id]
+
+    def header(self, key_id):
+        """
+        Returns the header of the ciphertexts of the key id.
+        """
+        return self.marker + chr(key_id) if key_id else ""
+
+    def split(self, ciphertext):
+        """
+        Returns the key id and the ciphertext without its header.
+        """
+        if (len(ciphertext) % AES.block_size == 2 and
+            ciphertext[0] == self.marker):
+            return ord(ciphertext[1]), ciphertext[2:]
+        return 0, ciphertext
+
+    def key_id(self, ciphertext, decode=True):
+        """
+        Returns the id of the key that encrypted the ciphertext.
+        """
+        if decode:
+            ciphertext = base64.b64decode(ciphertext)
+        return self.split(ciphertext)[0]
+
+    def stale(self, ciphertext, decode=True):
+        """
+        True if the ciphertext was encrypted with a retired key on the
+        keyring, so that it can be encrypted again with the current key.
+        """
+        key_id = self.key_id(ciphertext, decode)
+        return key_id != self.current and key_id in self.ciphers
+
+    def encrypt(self, plaintext, checksum=True, encode=True):
+        """
+        Encrypts the plaintext with the current key; see Cipher.encrypt.
+        """
+        ciphertext = self.header(self.current) + self.cipher().encrypt(plaintext, checksum, False)
+        if encode:
+            return base64.b64encode(ciphertext)
+        return ciphertext
+
+    def decrypt(self, ciphertext, checksum=True, decode=True):
+        """
+        Decrypts the ciphertext with the key that encrypted it.
+        """
+        if decode:
+            ciphertext = base64.b64decode(ciphertext)
+        key_id, ciphertext = self.split(ciphertext)
+        return self.cipher(key_id).decrypt(ciphertext, checksum, False)
+
+    def encrypt_many(self, plaintexts, checksum=True, encode=True):
+        """
+        Encrypts the plaintexts with the current key in one batch.
+        """
+        header      = self.header(self.current)
+        ciphertexts = [header + ciphertext for ciphertext
+                       in self.cipher().encrypt_many(plaintexts, checksum, False)]
+        if encode:
+            return [base64.b64encode(ciphertext) for ciphertext in ciphertexts]
+        return ciphertexts
+
+    def decrypt_many(self, ciphertexts, checksum=True, decode=True):
+        """
+        Decrypts the ciphertexts in one batch per key. As with
+        Cipher.decrypt_many, the exception of an item that cannot be
+        decrypted is returned in place of its plaintext.
+        """
+        results = []
+        batches = {}
+        for idx, ciphertext in enumerate(ciphertexts):
+            results.append(None)
+            try:
+                if decode:
+                    ciphertext = base64.b64decode(ciphertext)
+            except TypeError as e:
+                results[idx] = e
+                continue
+
+            key_id, ciphertext = self.split(ciphertext)
+            batches.setdefault(key_id, []).append((idx, ciphertext))
+
+        for key_id, batch in batches.items():
+            try:
+                plaintexts = self.cipher(key_id).decrypt_many(
+                    (ciphertext for idx, ciphertext in batch), checksum, False)
+            except UnknownKeyError as e:
+                plaintexts = [e] * len(batch)
+
+            for (idx, ciphertext), plaintext in zip(batch, plaintexts):
+                results[idx] = plaintext
+
+        return results
+
+
+class LazyCipher(object):
+    """
+    A Cipher whose secret is only loaded, by calling `loader`, the first
+    time it is used; e.g. so that the key file is not decrypted (or the
+    passphrase prompted for) just by importing the app. The loader returns
+    either the secret or a cipher (e.g. a Keyring), every attribute of
+    which is available on this object.
+    """
+
+    def __init__(self, loader):
+        self.loader  = loader
+        self._cipher = None
+        self._lock   = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._cipher is not None
+
+    def load(self):
+        """
+        Returns the Cipher, loading the secret if it is not loaded yet.
+        """
+        with self._lock:
+            if self._cipher is None:
+                cipher = self.loader()
+                if not cipher: raise TypeError("Cannot encrypt or decrypt without a secret.")
+                self._cipher = Cipher(cipher) if isinstance(cipher, basestring) else cipher
+            return self._cipher
+
+    def reset(self):
+        """
+        Forgets the Cipher, so that the secret is loaded again on next use.
+        """
+        with self._lock:
+            self._cipher = None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
 ##########################################################################
 ## Filesystem key
 ##########################################################################
@@ -0,0 +1,434 @@
+# flashcube.concurrency
+# The async serving mode and the worker pool for encryption.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 12 10:17:31 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: concurrency.py [] benjamin@bengfort.com $
+
+"""
+Support for serving many requests concurrently in one worker process.
+
+In the async serving mode, gunicorn runs Flashcube with the gevent worker
+class, which patches the standard library so that each request runs in a
+greenlet. psycopg2 does not use the standard library sockets, so it is made
+cooperative with a wait callback: a query waits on its socket in the gevent
+hub and other requests run in the meantime. The mode is detected from the
+patched standard library unless FLASHCUBE_ASYNC is set. gevent is only
+imported in this mode, so it is an optional dependency (the `async` extra).
+
+Encryption and decryption run in the CryptoPool, a bounded pool of
+FLASHCUBE_CRYPTO_POOL threads (real threads, even under gevent), so
+that a request that is encrypting does not stall the requests that are
+waiting on the database. At most FLASHCUBE_CRYPTO_QUEUE operations wait
+for a thread; beyond that requests fail with a 503 rather than queueing
+without bound. With no workers, the default, crypto runs in the request.
+
+Work that a request does not need to wait for (e.g. re-encrypting a
+credential read under an old key) goes on the BackgroundQueue, which runs
+it in a background thread after the request has returned.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import sys
+import Queue
+import logging
+import threading
+
+from flashcube.exceptions import ServiceUnavailable
+
+##########################################################################
+## Async Serving Mode
+##########################################################################
+
+def gevent_patched(module='socket'):
+    """
+    True if gevent has patched the standard library module.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched(module)
+
+
+def async_mode(app):
+    """
+    True if the app is served in the async mode, either as configured in
+    FLASHCUBE_ASYNC or, if that is None, because gevent is serving it.
+    """
+    mode = app.config.get('FLASHCUBE_ASYNC', None)
+    if mode is None:
+        return gevent_patched()
+    return bool(mode)
+
+
+def patch_psycopg():
+    """
+    Makes psycopg2 cooperative with gevent, so that waiting on the database
+    yields to the other requests of the process instead of blocking it.
+    """
+    try:
+        from gevent.socket import wait_read, wait_write
+    except ImportError:
+        raise ImportError("The async serving mode requires gevent; "
+                          "pip install gevent or set FLASHCUBE_ASYNC to False.")
+
+    from psycopg2 import extensions, OperationalError
+
+    def wait(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise OperationalError("Bad result from poll: %r" % state)
+
+    extensions.set_wait_callback(wait)
+
+##########################################################################
+## Crypto Worker Pool
+##########################################################################
+
+class Task(object):
+    """
+    A call that is run by a worker thread; the result (or the exception
+    info) is handed back to the waiting request.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func   = func
+        self.args   = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error  = None
+        self.done   = threading.Event()
+
+    def __call__(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class Submission(object):
+    """
+    Wraps a function submitted to the CryptoPool, which moves it from
+    queued to active when a worker picks it up and from active to completed
+    when it returns. A submission that is cancelled before a worker picks
+    it up (e.g. because it could not be handed to the pool) leaves the
+    queue and never runs, so the gauges stay right either way.
+    """
+
+    def __init__(self, pool, func):
+        self.pool      = pool
+        self.func      = func
+        self.started   = False
+        self.cancelled = False
+
+    def __call__(self, *args, **kwargs):
+        with self.pool._lock:
+            if self.cancelled:
+                return None
+            self.started     = True
+            self.pool.queued -= 1
+            self.pool.active += 1
+
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            with self.pool._lock:
+                self.pool.active    -= 1
+                self.pool.completed += 1
+
+    def cancel(self):
+        """
+        Takes the submission off the queue unless a worker has picked it up.
+        """
+        with self.pool._lock:
+            if not self.started and not self.cancelled:
+                self.cancelled    = True
+                self.pool.queued -= 1
+
+
+class CryptoPool(object):
+    """
+    A bounded pool of worker threads that runs the encryption and
+    decryption of requests, with a gauge of the operations waiting for a
+    worker. Threads are started on first use, and again in any process
+    forked from the one that started them (e.g. gunicorn workers).
+    """
+
+    def __init__(self, app=None):
+        self.size     = 0
+        self.limit    = 0
+        self._lock    = threading.Lock()
+        self._pid     = None
+        self._pool    = None
+        self._threads = []
+        self.reset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the pool from the FLASHCUBE_CRYPTO_POOL and
+        FLASHCUBE_CRYPTO_QUEUE settings. Can be called again to resize it.
+        """
+        self.stop()
+        self.size  = app.config.get('FLASHCUBE_CRYPTO_POOL', 0) or 0
+        self.limit = app.config.get('FLASHCUBE_CRYPTO_QUEUE', 0) or 0
+
+    def reset(self):
+        """
+        Resets the gauges and counters of the pool.
+        """
+        self.queued    = 0
+        self.active    = 0
+        self.peak      = 0
+        self.completed = 0
+        self.rejected  = 0
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs the function on a worker and returns its result (or raises its
+        exception), blocking only the calling request in the meantime. If
+        the queue is full, raises ServiceUnavailable.
+        """
+        if not self.size:
+            return func(*args, **kwargs)
+
+        with self._lock:
+            if self.limit and self.queued >= self.limit:
+                self.rejected += 1
+                raise ServiceUnavailable("Too many requests are waiting to encrypt or decrypt.")
+            self.queued += 1
+            self.peak    = max(self.peak, self.queued)
+
+        submission = Submission(self, func)
+        try:
+            if gevent_patched('thread'):
+                return self._gevent_pool().apply(submission, args, kwargs)
+
+            task = Task(submission, args, kwargs)
+            self._thread_pool().put(task)
+            return task.wait()
+        finally:
+            # Nothing ran if the submission failed or the pool was killed
+            submission.cancel()
+
+    def _thread_pool(self):
+        """
+        Returns the queue of the worker threads, starting them if needed.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork, so start new ones
+                self._pid     = os.getpid()
+                self._pool    = Queue.Queue()
+                self._threads = []
+                for idx in xrange(self.size):
+                    thread = threading.Thread(target=self._work, args=(self._pool,),
+                                              name="flashcube-crypto-%i" % idx)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+            return self._pool
+
+    def _gevent_pool(self):
+        """
+        Returns a gevent pool of real threads (the threading module itself
+        is patched to use greenlets), so waiting only blocks the greenlet.
+        """
+        from gevent.threadpool import ThreadPool
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid  = os.getpid()
+                self._pool = ThreadPool(self.size)
+            return self._pool
+
+    @staticmethod
+    def _work(queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            task()
+
+    def stop(self):
+        """
+        Stops the worker threads once they are idle.
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._pool is not None:
+                if isinstance(self._pool, Queue.Queue):
+                    for thread in self._threads:
+                        self._pool.put(None)
+                else:
+                    self._pool.kill()
+
+            self._pid     = None
+            self._pool    = None
+            self._threads = []
+
+    def serialize(self):
+        return {
+            "workers": self.size,
+            "queue_limit": self.limit,
+            "queued": self.queued,
+            "active": self.active,
+            "peak_queued": self.peak,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+##########################################################################
+## Background Queue
+##########################################################################
+
+class BackgroundQueue(object):
+    """
+    A bounded queue of tasks that a background thread runs, each in an app
+    context, after the requests that submitted them have returned. Tasks
+    are keyed, and a task is not queued again while one with its key is
+    pending. Tasks are dropped when the queue is full (they must be safe to
+    skip, e.g. because later requests will submit them again).
+    """
+
+    def __init__(self, app=None):
+        self.app      = None
+        self.maxsize  = 0
+        self.logger   = logging.getLogger("flashcube.background")
+        self._lock    = threading.Lock()
+        self._pid     = None
+        self._queue   = None
+        self._pending = set()
+        self.reset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configures the queue from the BACKGROUND_QUEUE_SIZE setting.
+        """
+        self.stop()
+        self.app     = app
+        self.maxsize = app.config.get('BACKGROUND_QUEUE_SIZE', 1000)
+
+    def reset(self):
+        """
+        Resets the counters of the queue.
+        """
+        self.submitted = 0
+        self.completed = 0
+        self.failed    = 0
+        self.dropped   = 0
+
+    def submit(self, key, func, *args):
+        """
+        Queues the function to run in the background, returning False if it
+        was not queued because the key is pending or the queue is full.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+
+            queue = self._start()
+            try:
+                queue.put_nowait((key, func, args))
+            except Queue.Full:
+                self.dropped += 1
+                return False
+
+            self._pending.add(key)
+            self.submitted += 1
+            return True
+
+    def join(self):
+        """
+        Blocks until every queued task has run.
+        """
+        with self._lock:
+            queue = self._queue if self._pid == os.getpid() else None
+        if queue is not None:
+            queue.join()
+
+    def _start(self):
+        """
+        Returns the queue, starting the thread if needed (including after a
+        fork). Must be called with the lock held.
+        """
+        if self._pid != os.getpid():
+            self._pid     = os.getpid()
+            self._queue   = Queue.Queue(self.maxsize)
+            self._pending = set()
+
+            thread = threading.Thread(target=self._work, args=(self._queue,),
+                                      name="flashcube-background")
+            thread.daemon = True
+            thread.start()
+        return self._queue
+
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                queue.task_done()
+                return
+
+            key, func, args = task
+            try:
+                with self.app.app_context():
+                    func(*args)
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                self.logger.exception("Background task for %r failed", key)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                queue.task_done()
+
+    def stop(self):
+        """
+        Stops the thread once it has run the queued tasks.
+        """
+        with self._lock:
+            queue = self._queue if self._pid == os.getpid() else None
+            self._pid   = None
+            self._queue = None
+
+        if queue is not None:
+            queue.put(None)
+
+    def serialize(self):
+        return {
+            "queue_size": self.maxsize,
+            "pending": len(self._pending),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
@@ -12,6 +12,10 @@
 """
 Wrapper console utility that wraps the function in the utils.keygen module
 for the generation of API clients and stores them into the database.
+
+Running workers cache API clients; adding a client bumps the shared client
+generation so that workers on this host see it at once, while workers on
+other hosts see it within CLIENT_NEGATIVE_TTL seconds.
 """
 
 ##########################################################################
@@ -22,7 +26,7 @@ import hashlib
 
 from sqlalchemy.exc import *
 from optparse import make_option
-from flashcube import db
+from flashcube.core import app, db, auth
 from flashcube.utils.keygen import generate
 from flashcube.console import ConsoleProgram, ConsoleError
 from flashcube.console.mixins import ConfirmationMixin
@@ -72,7 +76,8 @@ class ClientUtility(ConsoleProgram, ConfirmationMixin):
         Is this threadsafe?
         """
 
-        # Check if the client name is already in the database.
+        # Check if the client name is already in the database. Always
+        # uses the primary database, never a (possibly stale) replica.
         if Client.query.filter(Client.name == data['name']).count() > 0:
             print self.style.ERROR(u"\u2717 A client with name '%s' already exists." % data['name'])
             print
@@ -90,6 +95,14 @@ class ClientUtility(ConsoleProgram, ConfirmationMixin):
             print
             raise ConsoleError("Could not add client.")
 
+        # Drop the unknown apikey from the caches of the running workers
+        try:
+            auth.invalidate(data['apikey'])
+        except (IOError, OSError) as e:
+            print self.style.WARNING(u"\u2717 Could not notify the running workers: %s" % e)
+            print self.style.WARNING(u"  The client can authenticate within %i seconds." % app.config['CLIENT_NEGATIVE_TTL'])
+            print
+
     def handle(self, *args, **opts):
 
         # Collect details to enter into the database
@@ -0,0 +1,112 @@
+# flashcube.console.indexes
+# A Console utility that audits the indices of the Flashcube database.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Tue Nov 03 10:05:51 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: indexes.py [] benjamin@bengfort.com $
+
+"""
+Wrapper console utility that wraps the functions in the utils.indexes
+module to report, and optionally drop, the duplicate or unused indices on
+the Flashcube tables of a live database.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+from optparse import make_option
+from flashcube.core import db
+from flashcube.utils.indexes import *
+from flashcube.console import ConsoleProgram, ConsoleError
+from flashcube.console.mixins import ConfirmationMixin
+
+##########################################################################
+## Index Audit Utility
+##########################################################################
+
+class IndexAuditUtility(ConsoleProgram, ConfirmationMixin):
+
+    args = ""
+    opts = ConsoleProgram.opts + (
+        make_option("--drop", default=False, action="store_true",
+            help="Drop the redundant indices that are reported."),
+        make_option("--unused", default=False, action="store_true",
+            help="Also report (and drop) indices that are never scanned."),
+        make_option("-y", "--yes", default=False, action="store_true",
+            help="Do not ask for confirmation before dropping."),
+    )
+
+    help = "Reports (or drops) duplicate and unused indices on Flashcube tables."
+
+    def report(self, index, reason):
+        print u"\u272b  %s %s (%s, %i bytes)" % (
+            self.style.WARNING(index.name), reason, index.tablename, index.size)
+        if int(self.verbosity) > 1:
+            print u"    %s" % index.definition
+
+    def drop(self, indexes):
+        """
+        Drops the indices concurrently, so that writes are not blocked;
+        this cannot be done inside of a transaction.
+        """
+        conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            for index in indexes:
+                conn.execute('DROP INDEX CONCURRENTLY IF EXISTS "%s"' % index.name)
+                print self.style.STRONG(u"\u2713 Dropped %s" % index.name)
+        except Exception as e:
+            raise ConsoleError("Could not drop index: %s" % e)
+        finally:
+            conn.close()
+
+    def handle(self, *args, **opts):
+        self.verbosity = opts.get('verbosity', 1)
+
+        try:
+            indexes = fetch_indexes(db.session)
+        except Exception as e:
+            raise ConsoleError("Could not inspect the database indices: %s" % e)
+        finally:
+            db.session.remove()
+
+        targets = []
+        for index, kept in redundant_indexes(indexes):
+            self.report(index, "duplicates %s" % kept.name)
+            targets.append(index)
+
+        if opts.get('unused'):
+            for index in unused_indexes(indexes):
+                if index in targets: continue
+                self.report(index, "has never been scanned")
+                targets.append(index)
+
+        if not targets:
+            print self.style.STRONG(u"\u2713 No redundant indices found")
+            return
+
+        # Constraint indices must be removed with ALTER TABLE ... DROP CONSTRAINT
+        for index in targets:
+            if not droppable(index):
+                print self.style.NOTICE(u"    %s is owned by a constraint and will not be dropped" % index.name)
+        targets = [index for index in targets if droppable(index)]
+
+        if not opts.get('drop') or not targets:
+            return
+
+        print
+        if opts.get('yes') or self.confirm("Drop %i indices?" % len(targets), False):
+            self.drop(targets)
+
+##########################################################################
+## Main method and testing
+##########################################################################
+
+if __name__ == "__main__":
+
+    import sys
+    IndexAuditUtility().load(sys.argv)
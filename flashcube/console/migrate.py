@@ -0,0 +1,111 @@
+# flashcube.console.migrate
+# A Console utility that converts credentials between storage formats.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Mon Nov 02 10:14:37 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: migrate.py [] benjamin@bengfort.com $
+
+"""
+Console utility that converts the stored ciphertext of credentials from
+base64 text in the "password" column to raw bytes in the "ciphertext"
+column (or back again), in small batches so the service can stay online.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import time
+
+from optparse import make_option
+from flashcube.core import shards
+from flashcube.console import ConsoleProgram, ConsoleError
+from flashcube.models import Credential
+
+##########################################################################
+## Storage Migration Utility
+##########################################################################
+
+class StorageMigrationUtility(ConsoleProgram):
+
+    args = ""
+    opts = ConsoleProgram.opts + (
+        make_option("-b", "--batch-size", metavar="ROWS", type="int", default=1000,
+            help="Number of rows to convert in each transaction."),
+        make_option("-s", "--sleep", metavar="SECS", type="float", default=0.0,
+            help="Seconds to pause between batches to limit load."),
+        make_option("--start", metavar="ID", type="int", default=0,
+            help="Only convert rows with an id greater than this one."),
+        make_option("--reverse", default=False, action="store_true",
+            help="Convert binary ciphertexts back to base64 passwords."),
+    )
+
+    help = "Converts credentials between base64 and binary ciphertext storage."
+
+    def convert(self, session, binary, **opts):
+        """
+        Converts every credential in the session's database in batches.
+        Returns the number converted and the ids that failed to decode.
+        """
+        after  = opts.get('start', 0)
+        total  = 0
+        failed = []
+
+        while True:
+            try:
+                last, converted, errors = Credential.convert_batch(after, opts['batch_size'],
+                                                                   binary, session)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise ConsoleError("Could not convert batch after id %i: %s" % (after, e))
+
+            if last is None: break
+
+            total += converted
+            failed.extend(errors)
+            after  = last
+
+            if int(opts.get('verbosity', 1)) > 1:
+                print u"    converted %i rows through id %i" % (converted, last)
+
+            if opts.get('sleep'):
+                time.sleep(opts['sleep'])
+
+        session.remove()
+        return total, failed
+
+    def handle(self, *args, **opts):
+
+        binary = not opts.get('reverse', False)
+        total  = 0
+        failed = []
+
+        print self.style.NOTICE("Converting credentials to %s storage:" %
+                                ("binary" if binary else "base64"))
+
+        # Every shard (or just the default database) is converted in turn
+        for session in shards.sessions():
+            converted, errors = self.convert(session, binary, **opts)
+            total += converted
+            failed.extend(errors)
+
+        print self.style.STRONG(u"\u2713 Converted %i credentials" % total)
+
+        if failed:
+            print self.style.ERROR(u"\u2717 Could not decode %i credentials: %s" %
+                                   (len(failed), ", ".join(str(pk) for pk in failed)))
+            raise ConsoleError("Some credentials were not converted.")
+
+##########################################################################
+## Main method and testing
+##########################################################################
+
+if __name__ == "__main__":
+
+    import sys
+    StorageMigrationUtility().load(sys.argv)
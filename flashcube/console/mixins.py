@@ -104,3 +104,30 @@ class WriteOutMixin(object):
         else:
             if hasattr(self, 'stdout'):
                 self.stdout.write('\n'.join(output))
+
+
+class ProgressMixin(object):
+    """
+    Reports the progress of a scan of the credentials (see
+    flashcube.rotation.ChunkedScan) against the total number of rows.
+
+    Set C{self.total} before calling C{progress()} after every chunk.
+    """
+
+    total = 0
+
+    def progress(self, scan):
+        """
+        Reports the rows examined, the rate and the time left.
+
+        @param scan: The scan whose chunk was committed
+        """
+        rate = scan.rate
+        left = max(self.total - scan.examined, 0)
+        eta  = "unknown"
+        if rate:
+            secs = int(left / rate)
+            eta  = "%i:%02i:%02i" % (secs / 3600, secs / 60 % 60, secs % 60)
+
+        print self.style.NOTICE(u"    %i of %i rows, %i rows/sec, ETA %s" %
+                                (scan.examined, self.total, rate, eta))
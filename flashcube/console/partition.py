@@ -0,0 +1,237 @@
+# flashcube.console.partition
+# A Console utility that moves credentials into a partitioned table.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Wed Nov 04 14:12:09 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: partition.py [] benjamin@bengfort.com $
+
+"""
+Console utility that copies an existing, unpartitioned credential table
+into a new table that is hash partitioned on the email hash, in chunks so
+the service can stay online, then optionally swaps the two tables. For the
+swap, a trigger logs the credentials changed during the copy, which are
+replayed onto the new table while the service writes; writes are only
+blocked to replay the last few changes and to rename the tables.
+
+Requires PostgreSQL 11+ for declarative hash partitioning.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import time
+
+from optparse import make_option
+from sqlalchemy import text
+from flashcube.core import app, db, syncdb, schema_context
+from flashcube.console import ConsoleProgram, ConsoleError
+from flashcube.models import Credential
+
+##########################################################################
+## Partition Utility
+##########################################################################
+
+class PartitionUtility(ConsoleProgram):
+
+    args = ""
+    opts = ConsoleProgram.opts + (
+        make_option("-p", "--partitions", metavar="NUM", type="int", default=None,
+            help="Number of hash partitions (default FLASHCUBE_PARTITIONS or 16)."),
+        make_option("-t", "--table", metavar="NAME", default="credential_partitioned",
+            help="Name of the partitioned table to copy the credentials into."),
+        make_option("-c", "--chunk", metavar="ROWS", type="int", default=10000,
+            help="Number of rows to copy in each transaction."),
+        make_option("-s", "--sleep", metavar="SECS", type="float", default=0.0,
+            help="Seconds to pause between chunks to limit load."),
+        make_option("--swap", default=False, action="store_true",
+            help="Replace the credential table with the partitioned table when done."),
+    )
+
+    help = "Copies the credential table into a hash partitioned table."
+
+    def copy(self, target, **opts):
+        """
+        Copies every credential into the target table by id, one chunk
+        per transaction. Returns the last id copied.
+        """
+        after  = 0
+        total  = 0
+
+        while True:
+            try:
+                last, copied = Credential.copy_batch(target, after, opts['chunk'])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                raise ConsoleError("Could not copy chunk after id %i: %s" % (after, e))
+
+            if last is None: break
+
+            total += copied
+            after  = last
+
+            if int(opts.get('verbosity', 1)) > 1:
+                print u"    copied %i rows through id %i" % (copied, last)
+
+            if opts.get('sleep'):
+                time.sleep(opts['sleep'])
+
+        print self.style.STRONG(u"\u2713 Copied %i credentials into %s" % (total, target))
+        return after
+
+    def track(self, target):
+        """
+        Installs a trigger that logs the email hash of every credential
+        inserted, updated (including re-encrypted or converted in place)
+        or deleted from now on, so that the changes made during the copy
+        can be replayed onto the target without comparing whole tables.
+        """
+        statements = (
+            'CREATE TABLE "%s_changes" ("seq" BIGSERIAL PRIMARY KEY, '
+            '"email_hash" %s NOT NULL)' % (target, schema_context()['email_hash_type']),
+
+            'CREATE FUNCTION "%s_log"() RETURNS TRIGGER AS $$ BEGIN '
+            'IF TG_OP <> \'INSERT\' THEN INSERT INTO "%s_changes" ("email_hash") VALUES (OLD."email_hash"); END IF; '
+            'IF TG_OP <> \'DELETE\' THEN INSERT INTO "%s_changes" ("email_hash") VALUES (NEW."email_hash"); END IF; '
+            'RETURN NULL; END $$ LANGUAGE plpgsql' % (target, target, target),
+
+            'CREATE TRIGGER "%s_log" AFTER INSERT OR UPDATE OR DELETE ON "credential" '
+            'FOR EACH ROW EXECUTE PROCEDURE "%s_log"()' % (target, target),
+        )
+
+        for sql in statements:
+            db.session.execute(text(sql))
+        db.session.commit()
+
+    def untrack(self, target):
+        """
+        Removes the trigger and the log of changes. Called in the same
+        transaction as the swap, or to clean up after a failure.
+        """
+        for sql in ('DROP TRIGGER IF EXISTS "%s_log" ON "credential"',
+                    'DROP FUNCTION IF EXISTS "%s_log"()',
+                    'DROP TABLE IF EXISTS "%s_changes"'):
+            db.session.execute(text(sql % target))
+
+    def replay(self, target, limit):
+        """
+        Replays up to `limit` logged changes onto the target: the rows of
+        their email hashes are deleted from the target and copied again
+        from the credential table as it is now. Only the log entries that
+        were read are removed, so changes committed meanwhile are replayed
+        by a later call. Returns the number of log entries replayed; the
+        caller is responsible for the commit.
+        """
+        drained = db.session.execute(text(
+            'DELETE FROM "%s_changes" WHERE "seq" IN (SELECT "seq" FROM "%s_changes" '
+            'ORDER BY "seq" LIMIT :limit) RETURNING "email_hash"' % (target, target)),
+            {'limit': limit}).fetchall()
+        if not drained:
+            return 0
+
+        columns = '"id", "email_hash", "password", "ciphertext", "created", "updated"'
+        params  = {'hashes': [email_hash for email_hash, in drained]}
+        db.session.execute(text(
+            'DELETE FROM "%s" WHERE "email_hash" = ANY(:hashes)' % target), params)
+        db.session.execute(text(
+            'INSERT INTO "%s" (%s) SELECT %s FROM "credential" WHERE "email_hash" = ANY(:hashes)'
+            % (target, columns, columns)), params)
+        return len(drained)
+
+    def catchup(self, target, **opts):
+        """
+        Replays the changes made during the copy, one chunk per transaction
+        and without blocking writes, until less than a chunk is left.
+        """
+        while True:
+            try:
+                replayed = self.replay(target, opts['chunk'])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                raise ConsoleError("Could not replay the changes made during the copy: %s" % e)
+
+            if int(opts.get('verbosity', 1)) > 1:
+                print u"    replayed %i changes" % replayed
+
+            if replayed < opts['chunk']: break
+
+            if opts.get('sleep'):
+                time.sleep(opts['sleep'])
+
+    def swap(self, target, **opts):
+        """
+        Blocks writes to the credential table while the last changes (at
+        most those made since the catch up) are replayed onto the target,
+        then renames the target into its place. Reads are not blocked while
+        the changes are replayed, but the renames take an ACCESS EXCLUSIVE
+        lock, so reads wait for the (short) end of the transaction.
+        """
+        statements = (
+            'ALTER TABLE "credential" RENAME TO "credential_unpartitioned"',
+            'ALTER TABLE "%s" RENAME TO "credential"' % target,
+            'SELECT setval(pg_get_serial_sequence(\'"credential"\', \'id\'), '
+            '(SELECT COALESCE(MAX("id"), 1) FROM "credential"))',
+        )
+
+        try:
+            db.session.execute(text('LOCK TABLE "credential" IN EXCLUSIVE MODE'))
+            while self.replay(target, opts['chunk']): pass
+            self.untrack(target)
+            for sql in statements:
+                db.session.execute(text(sql))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise ConsoleError("Could not swap the credential tables: %s" % e)
+
+        print self.style.STRONG(u"\u2713 Swapped %s into place as credential" % target)
+        print self.style.NOTICE(u"    The old table remains as credential_unpartitioned")
+
+    def handle(self, *args, **opts):
+
+        target     = opts['table']
+        partitions = opts.get('partitions') or app.config.get('FLASHCUBE_PARTITIONS') or 16
+
+        if target == Credential.__tablename__:
+            raise ConsoleError("Cannot copy the credential table into itself.")
+
+        try:
+            syncdb(table=target, partitions=partitions)
+        except Exception as e:
+            db.session.rollback()
+            raise ConsoleError("Could not create the partitioned table: %s" % e)
+
+        print self.style.STRONG(u"\u2713 Created %s with %i partitions" % (target, partitions))
+
+        try:
+            # Log the changes before the copy starts, to replay them for the swap
+            if opts.get('swap'):
+                self.track(target)
+
+            self.copy(target, **opts)
+
+            if opts.get('swap'):
+                self.catchup(target, **opts)
+                self.swap(target, **opts)
+        except (Exception, KeyboardInterrupt):
+            db.session.rollback()
+            self.untrack(target)
+            db.session.commit()
+            raise
+        finally:
+            db.session.remove()
+
+##########################################################################
+## Main method and testing
+##########################################################################
+
+if __name__ == "__main__":
+
+    import sys
+    PartitionUtility().load(sys.argv)
@@ -0,0 +1,99 @@
+# flashcube.console.reshard
+# A Console utility that moves credentials to the shards they belong on.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 05 15:47:20 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: reshard.py [] benjamin@bengfort.com $
+
+"""
+Console utility that streams the credentials on every shard that belong
+on another shard (e.g. after adding shards to FLASHCUBE_SHARDS) to their
+new shard, in batches, while the service continues to serve them.
+
+Run with FLASHCUBE_RESHARD_FROM set to the previous number of shards in
+both the service and this utility, then unset it once it is done.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import time
+
+from optparse import make_option
+from flashcube.core import shards
+from flashcube.shards import reshard_batch
+from flashcube.console import ConsoleProgram, ConsoleError
+
+##########################################################################
+## Reshard Utility
+##########################################################################
+
+class ReshardUtility(ConsoleProgram):
+
+    args = ""
+    opts = ConsoleProgram.opts + (
+        make_option("-b", "--batch-size", metavar="ROWS", type="int", default=1000,
+            help="Number of rows to examine in each batch."),
+        make_option("-s", "--sleep", metavar="SECS", type="float", default=0.0,
+            help="Seconds to pause between batches to limit load."),
+    )
+
+    help = "Moves credentials to the shards they belong on."
+
+    def reshard(self, idx, **opts):
+        """
+        Moves the credentials on one shard that belong on another.
+        """
+        after, total, skipped = 0, 0, []
+
+        while True:
+            try:
+                last, moved, errors = reshard_batch(shards, idx, after, opts['batch_size'])
+            except Exception as e:
+                raise ConsoleError("Could not reshard batch after id %i on shard %i: %s" %
+                                   (after, idx, e))
+
+            if last is None: break
+
+            total += moved
+            skipped.extend(errors)
+            after  = last
+
+            if int(opts.get('verbosity', 1)) > 1:
+                print u"    moved %i rows through id %i" % (moved, last)
+
+            if opts.get('sleep'):
+                time.sleep(opts['sleep'])
+
+        return total, skipped
+
+    def handle(self, *args, **opts):
+
+        if not shards.enabled:
+            raise ConsoleError("No shards are configured in FLASHCUBE_SHARDS.")
+
+        skipped = []
+        for idx in xrange(shards.count):
+            moved, errors = self.reshard(idx, **opts)
+            skipped.extend(errors)
+            print self.style.STRONG(u"\u2713 Moved %i credentials off of shard %i" % (moved, idx))
+
+        shards.remove()
+
+        if skipped:
+            print self.style.WARNING(u"\u272b  %i credentials changed while moving; run again to move them" %
+                                     len(skipped))
+
+##########################################################################
+## Main method and testing
+##########################################################################
+
+if __name__ == "__main__":
+
+    import sys
+    ReshardUtility().load(sys.argv)
@@ -0,0 +1,116 @@
+# flashcube.console.rotate
+# A Console utility that re-encrypts every credential with the current key.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Wed Nov 18 14:20:51 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: rotate.py [] benjamin@bengfort.com $
+
+"""
+Console utility that re-encrypts every credential that was not encrypted
+with the current key (FLASHCUBE_KEY_ID) across a pool of processes, e.g.
+to retire a key immediately rather than as credentials are read. The keys
+to re-encrypt from must be listed in FLASHCUBE_KEYRING.
+
+Progress is checkpointed after every chunk, so if the rotation is stopped
+or crashes, running it again resumes from the last chunk committed.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import multiprocessing
+
+from optparse import make_option
+from flashcube.core import crypto, shards
+from flashcube.rotation import Rotation, Checkpoint
+from flashcube.console import ConsoleProgram, ConsoleError
+from flashcube.console.mixins import ProgressMixin
+
+##########################################################################
+## Rotation Utility
+##########################################################################
+
+class RotationUtility(ConsoleProgram, ProgressMixin):
+
+    args = ""
+    opts = ConsoleProgram.opts + (
+        make_option("-b", "--batch-size", metavar="ROWS", type="int", default=500,
+            help="Number of rows re-encrypted by a process and updated at once."),
+        make_option("-c", "--chunk-size", metavar="ROWS", type="int", default=10000,
+            help="Number of rows read with each cursor and committed at once."),
+        make_option("-p", "--processes", metavar="NUM", type="int",
+            default=multiprocessing.cpu_count(),
+            help="Number of processes to re-encrypt with (0 to use none)."),
+        make_option("--checkpoint", metavar="PATH", default=".flashcube-rotate.json",
+            help="File to save progress to and resume from."),
+        make_option("--restart", default=False, action="store_true",
+            help="Ignore the checkpoint and start from the first row."),
+    )
+
+    help = "Re-encrypts every credential with the current key."
+
+    def handle(self, *args, **opts):
+
+        try:
+            keyring = crypto.load()
+        except TypeError:
+            raise ConsoleError("No secret to encrypt with; set FLASHCUBE_KEY or FLASHCUBE_SECRET.")
+
+        checkpoint = Checkpoint(opts['checkpoint'], keyring.current)
+        if opts.get('restart'):
+            checkpoint.clear()
+        elif checkpoint.load().shards:
+            print self.style.NOTICE("Resuming from the checkpoint in %s" % checkpoint.path)
+
+        if len(keyring.ciphers) < 2:
+            print self.style.WARNING(u"\u272b  No retired keys in FLASHCUBE_KEYRING; "
+                                     "credentials under other keys cannot be re-encrypted")
+
+        rotation = Rotation(keyring, checkpoint, opts['processes'],
+                            opts['chunk_size'], opts['batch_size'])
+
+        # Start the processes before the connections are opened
+        rotation.start()
+        try:
+            sessions   = shards.sessions()
+            self.total = sum(rotation.count(idx, session) for idx, session in enumerate(sessions))
+
+            print self.style.NOTICE("Re-encrypting %i credentials with key %i:" %
+                                    (self.total, keyring.current))
+
+            progress = self.progress if int(opts.get('verbosity', 1)) > 0 else None
+            for idx, session in enumerate(sessions):
+                rotation.rotate(idx, session, progress)
+        except Exception as e:
+            raise ConsoleError("Could not rotate credentials (run again to resume): %s" % e)
+        finally:
+            rotation.stop()
+            shards.remove()
+
+        print self.style.STRONG(u"\u2713 Re-encrypted %i credentials (%i already current) at %i rows/sec" %
+                                (rotation.rotated, rotation.current, rotation.rate))
+
+        if rotation.changed:
+            print self.style.WARNING(u"\u272b  %i credentials changed while rotating and were skipped" %
+                                     rotation.changed)
+
+        if rotation.failed:
+            print self.style.ERROR(u"\u2717 Could not decrypt %i credentials: %s" %
+                                   (len(rotation.failed), ", ".join(str(pk) for pk in rotation.failed)))
+            raise ConsoleError("Some credentials were not re-encrypted.")
+
+        checkpoint.clear()
+
+##########################################################################
+## Main method and testing
+##########################################################################
+
+if __name__ == "__main__":
+
+    import sys
+    RotationUtility().load(sys.argv)
@@ -0,0 +1,144 @@
+# flashcube.console.verify
+# A Console utility that verifies every credential can be decrypted.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 19 10:05:23 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: verify.py [] benjamin@bengfort.com $
+
+"""
+Console utility that decrypts every credential (or a sample of them)
+across a pool of processes and reports those that fail their checksum,
+padding or UTF-8 decoding, e.g. nightly. It reads from the first read
+replica if FLASHCUBE_REPLICAS is set, so that the primary is not loaded;
+sharded credentials are read from their shards.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import multiprocessing
+
+from optparse import make_option
+from flashcube.core import db, crypto, shards, replicas
+from flashcube.rotation import Checkpoint
+from flashcube.integrity import IntegrityScan
+from flashcube.console import ConsoleProgram, ConsoleError
+from flashcube.console.mixins import ProgressMixin
+
+##########################################################################
+## Integrity Scan Utility
+##########################################################################
+
+class IntegrityScanUtility(ConsoleProgram, ProgressMixin):
+
+    args = ""
+    opts = ConsoleProgram.opts + (
+        make_option("-b", "--batch-size", metavar="ROWS", type="int", default=500,
+            help="Number of rows decrypted by a process at once."),
+        make_option("-c", "--chunk-size", metavar="ROWS", type="int", default=10000,
+            help="Number of rows read with each cursor."),
+        make_option("-p", "--processes", metavar="NUM", type="int",
+            default=multiprocessing.cpu_count(),
+            help="Number of processes to decrypt with (0 to use none)."),
+        make_option("--sample", metavar="FRACTION", type="float", default=1.0,
+            help="Fraction of the rows to verify, chosen at random."),
+        make_option("--checkpoint", metavar="PATH", default=".flashcube-verify.json",
+            help="File to save progress to."),
+        make_option("--resume", default=False, action="store_true",
+            help="Resume from the checkpoint of a scan that did not finish."),
+        make_option("--primary", default=False, action="store_true",
+            help="Read from the primary database even if there are replicas."),
+    )
+
+    help = "Verifies the checksum of every stored credential."
+
+    def sessions(self, primary=False):
+        """
+        Returns the sessions to scan: every shard, or else the first
+        replica (unless primary is True), or else the default database.
+        """
+        if shards.enabled:
+            return shards.sessions()
+        if replicas.enabled and not primary:
+            print self.style.NOTICE("Reading from replica 0")
+            return [replicas.session(0)]
+        return [db.session]
+
+    def report(self, scan):
+        """
+        Reports the failures that have not been reported yet, including
+        those restored from the checkpoint of a resumed scan.
+        """
+        for pk, reason in scan.failures[self.reported:]:
+            print self.style.ERROR(u"\u2717 Credential %i: %s" % (pk, reason))
+        self.reported = len(scan.failures)
+
+    def progress(self, scan):
+        super(IntegrityScanUtility, self).progress(scan)
+
+        # Report the failures as they are found
+        self.report(scan)
+
+    def handle(self, *args, **opts):
+
+        if not 0.0 < opts['sample'] <= 1.0:
+            raise ConsoleError("The sample must be a fraction greater than 0 and at most 1.")
+
+        try:
+            keyring = crypto.load()
+        except TypeError:
+            raise ConsoleError("No secret to decrypt with; set FLASHCUBE_KEY or FLASHCUBE_SECRET.")
+
+        checkpoint = Checkpoint(opts['checkpoint'], "verify")
+        if not opts.get('resume'):
+            checkpoint.clear()
+        elif checkpoint.load().shards:
+            print self.style.NOTICE("Resuming from the checkpoint in %s" % checkpoint.path)
+
+        scan = IntegrityScan(keyring, checkpoint, opts['processes'], opts['chunk_size'],
+                             opts['batch_size'], opts['sample'])
+        self.reported = 0
+
+        # Start the processes before the connections are opened
+        scan.start()
+        try:
+            sessions   = self.sessions(opts.get('primary'))
+            self.total = sum(scan.count(idx, session) for idx, session in enumerate(sessions))
+
+            print self.style.NOTICE("Verifying %s%i credentials:" %
+                ("%0.1f%% of " % (opts['sample'] * 100) if opts['sample'] < 1.0 else "", self.total))
+
+            # Only the sample is read, so report progress against its size
+            self.total = int(round(self.total * opts['sample']))
+            progress   = self.progress if int(opts.get('verbosity', 1)) > 0 else None
+            for idx, session in enumerate(sessions):
+                scan.verify(idx, session, progress)
+        except Exception as e:
+            raise ConsoleError("Could not verify credentials (run again with --resume): %s" % e)
+        finally:
+            scan.stop()
+            shards.remove()
+            replicas.remove()
+            db.session.remove()
+
+        self.report(scan)
+        checkpoint.clear()
+        print self.style.STRONG(u"\u2713 Verified %i credentials at %i rows/sec" %
+                                (scan.verified, scan.rate))
+
+        if scan.failures:
+            raise ConsoleError("%i credentials failed verification." % len(scan.failures))
+
+##########################################################################
+## Main method and testing
+##########################################################################
+
+if __name__ == "__main__":
+
+    import sys
+    IntegrityScanUtility().load(sys.argv)
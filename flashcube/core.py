@@ -0,0 +1,257 @@
+# flashcube.core
+# The Flashcube app, its extensions and the app factory.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Fri Oct 16 23:12:48 2015 -0400
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: core.py [] benjamin@bengfort.com $
+
+"""
+The Flashcube app and its extensions (the database, shards, replicas, the
+crypto worker pool and authentication), configured from the settings named
+by the FLASHCUBE_SETTINGS environment variable.
+
+Importing this module has no other side effects: the resources are only
+registered by `create_app`, and the secret is only loaded (and prompted
+for, if need be) the first time something is encrypted or decrypted, or
+when `load_secret` is called. There is one app per process, so calling
+`create_app` again reconfigures it.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+
+from flask import Flask
+from getpass import getpass
+from flask.ext.restful import Api
+from flashcube.pool import PooledSQLAlchemy
+from flashcube.cipher import EncryptedFileKey, CheckSumError, Keyring, LazyCipher
+
+# Create Flask App
+app  = Flask('flashcube')
+api  = Api(app)
+
+# Configure the App
+app.config.from_object('flashcube.conf.Config')
+if os.environ.get('FLASHCUBE_SETTINGS', None):
+    app.config.from_object(os.environ['FLASHCUBE_SETTINGS'])
+
+##########################################################################
+## Secret
+##########################################################################
+
+def prompt_for_secret(keypath=None, password=None):
+    """
+    Prompts for the secret key to decrypt the keyfile before loading. A
+    wrong passphrase is prompted for again, unless it is the passphrase in
+    the FLASHCUBE_PASSPHRASE environment variable, which raises.
+    """
+    keypath  = keypath or app.config['FLASHCUBE_KEY']
+
+    if not os.path.exists(keypath):
+        return None
+
+    keyfile  = EncryptedFileKey(keypath)
+    environ  = os.environ.get('FLASHCUBE_PASSPHRASE', None)
+    password = password or environ
+    password = password or getpass("Passphrase for %s: " % keypath)
+
+    try:
+        return keyfile.read(password)
+    except CheckSumError:
+        if environ and password == environ:
+            raise CheckSumError("FLASHCUBE_PASSPHRASE does not decrypt the key in %s" % keypath)
+        return prompt_for_secret(keypath)
+
+
+def schema_context(table="credential", partitions=None):
+    """
+    Returns the values substituted into the schema template by syncdb.
+
+    table      - the name of the credential table to create
+    partitions - the number of hash partitions (default from the config)
+    """
+    binary = app.config.get('FLASHCUBE_HASH_STORAGE', None) == "binary"
+    if partitions is None:
+        partitions = app.config.get('FLASHCUBE_PARTITIONS', 0)
+
+    context = {
+        'email_hash_type': "BYTEA" if binary else "CHAR(44)",
+        'credential_table': table,
+        'credential_primary_key': '"id"',
+        'credential_partition_by': "",
+        'credential_partitions': "",
+    }
+
+    if partitions:
+        # Requires PostgreSQL 11+ for hash partitioning and unique indices
+        context['credential_primary_key']  = '"id", "email_hash"'
+        context['credential_partition_by'] = ' PARTITION BY HASH ("email_hash")'
+        context['credential_partitions']   = "".join(
+            '\nCREATE TABLE IF NOT EXISTS "%s_p%i" PARTITION OF "%s"'
+            '\n    FOR VALUES WITH (MODULUS %i, REMAINDER %i);\n' % (table, idx, table, partitions, idx)
+            for idx in xrange(partitions)
+        )
+
+    return context
+
+
+def syncdb(schema=None, session=None, **context):
+    schema = schema or app.config.get('DATABASE_SCHEMA_PATH', None)
+
+    if not schema:
+        # Search for the fixture path
+        base = os.path.dirname(os.path.abspath(__file__))
+        name = 'fixtures/schema.sql'
+        for path in [os.path.join(base, name),
+                     os.path.realpath(os.path.join(base, '..', name))]:
+
+            if os.path.exists(path):
+                schema = path
+                break
+
+        if not schema:
+            raise Exception("Could not find schema to sync to database. "
+                            "Please specify one in the config.")
+
+    with open(schema, 'r') as data:
+        create  = data.read() % schema_context(**context)
+        session = session or db.session
+        session.execute(create)
+        session.commit()
+
+
+def load_secret():
+    """
+    Returns the secret, decrypting it from the key file (with a prompt for
+    the passphrase unless it is in the environment) if it is not set.
+    """
+    if (not app.config['FLASHCUBE_SECRET'] and
+        not os.environ.get('SKIP_FLASHCUBE_CRYPTO', False)):
+        app.config['FLASHCUBE_SECRET'] = prompt_for_secret()
+    return app.config['FLASHCUBE_SECRET']
+
+
+def load_keyring():
+    """
+    Returns the keyring of the secret, as the key FLASHCUBE_KEY_ID, and of
+    the retired keys in FLASHCUBE_KEYRING (a dict of key id to the path of
+    the key file, each decrypted in turn), or None if there is no secret.
+    """
+    secret = load_secret()
+    if not secret:
+        return None
+
+    keyring = Keyring(app.config['FLASHCUBE_KEY_ID'], secret)
+    for key_id, keypath in (app.config['FLASHCUBE_KEYRING'] or {}).items():
+        if key_id != keyring.current:
+            keyring.add(key_id, prompt_for_secret(keypath))
+    return keyring
+
+
+def keyring_settings():
+    """
+    Returns the settings that the keyring is loaded from.
+    """
+    return tuple(app.config[key] for key in ('FLASHCUBE_SECRET', 'FLASHCUBE_KEY_ID',
+                                             'FLASHCUBE_KEYRING'))
+
+
+# The keyring of the secret, which is loaded on first use
+crypto = LazyCipher(load_keyring)
+
+##########################################################################
+## Extensions
+##########################################################################
+
+# Create the Database Object/Session
+db = PooledSQLAlchemy(app)
+
+
+# Create DB Teardown
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    db.session.remove()
+
+
+# Create the Credential Shard Map
+# Note: must be after db
+from flashcube.shards import ShardMap
+shards = ShardMap(db, app)
+
+
+# Create the Read Replica Set
+# Note: must be after db
+from flashcube.replicas import ReplicaSet
+replicas = ReplicaSet(db, app)
+
+
+# Create the Worker Pool for Encryption and Decryption
+from flashcube.concurrency import CryptoPool, async_mode, patch_psycopg
+cryptopool = CryptoPool(app)
+
+
+# Create the Queue of Background Tasks (e.g. re-encryption)
+from flashcube.concurrency import BackgroundQueue
+background = BackgroundQueue(app)
+
+
+# Create the HMAC Authentication Handler
+# Note: for now, must be after db
+from flashcube.auth import HMACAuth
+auth = HMACAuth(app)
+
+##########################################################################
+## App Factory
+##########################################################################
+
+def create_app(config=None):
+    """
+    Configures the app with the settings object (or its import name, by
+    default the FLASHCUBE_SETTINGS environment variable), registers the
+    resources and returns the app, ready to serve. A secret that was
+    already loaded (e.g. by the gunicorn master) is kept unless the
+    settings have one of their own.
+    """
+    secret   = app.config['FLASHCUBE_SECRET']
+    settings = keyring_settings()
+    config   = config or os.environ.get('FLASHCUBE_SETTINGS', None)
+    if config:
+        app.config.from_object(config)
+
+    if not app.config['FLASHCUBE_SECRET']:
+        app.config['FLASHCUBE_SECRET'] = secret
+
+    # Forget the keyring of the previous keys
+    if keyring_settings() != settings:
+        crypto.reset()
+
+    # Make waiting on PostgreSQL cooperative when served by gevent
+    # Note: must be before the first connection
+    if async_mode(app):
+        patch_psycopg()
+
+    shards.init_app(app)
+    replicas.init_app(app)
+    cryptopool.init_app(app)
+    background.init_app(app)
+    auth.init_app(app)
+
+    # Import resources
+    # Note: MUST be after app config.
+    import flashcube.views
+
+    # If in production mode, perform ProxyFix
+    if (config == "flashcube.conf.ProductionConfig" and
+        not getattr(app, '_flashcube_proxyfix', False)):
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app)
+        app._flashcube_proxyfix = True
+
+    return app
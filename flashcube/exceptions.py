@@ -18,7 +18,7 @@ Exception classes and handling for the Flashcube API.
 ##########################################################################
 
 from flask import jsonify
-from flashcube import app, api
+from flashcube.core import app, api
 from werkzeug.exceptions import HTTPException
 from werkzeug.exceptions import default_exceptions
 
@@ -73,6 +73,10 @@ class DatabaseError(FlashcubeException):
 
     status_code = 500
 
+class ServiceUnavailable(FlashcubeException):
+
+    status_code = 503
+
 
 ##########################################################################
 ## Helper Functions
@@ -112,7 +116,7 @@ api.handle_error = handle_flashcube_exception
 # All Flashcube exceptions
 flashcube_exceptions = [FlashcubeException, AuthenticationFailure,
                         CredentialNotFound, ResourceConflict,
-                        DatabaseError]
+                        DatabaseError, ServiceUnavailable]
 
 
 # Handle Default Exceptions for API
@@ -0,0 +1,98 @@
+# flashcube.gunicorn_conf
+# The gunicorn configuration for serving Flashcube in production.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Mon Nov 16 10:31:14 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: gunicorn_conf.py [] benjamin@bengfort.com $
+
+"""
+The gunicorn configuration for serving Flashcube in production, e.g.:
+
+    $ gunicorn -c flashcube/gunicorn_conf.py flashcube.wsgi:app
+
+The key files are decrypted once, in the master, while this configuration is
+loaded (before gunicorn daemonizes, so the passphrase can be prompted for).
+The app is preloaded in the master, so every worker is forked with the
+secret already in its memory; the secret and the passphrase are never put
+in the environment. A graceful reload (HUP) reads this configuration again
+and replaces the workers by forking the master, so it does not ask for the
+passphrase again. Code changes still require a restart.
+
+The number of workers is sized from the number of CPUs: 2 * CPUs + 1 sync
+workers, or one gevent worker per CPU, each with FLASHCUBE_THREADS crypto
+threads (unless FLASHCUBE_CRYPTO_POOL is set). Set the FLASHCUBE_BIND,
+FLASHCUBE_WORKERS and FLASHCUBE_WORKER_CLASS environment variables to
+override the defaults.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import multiprocessing
+
+from flashcube.core import app, crypto, cryptopool
+
+##########################################################################
+## Sizing
+##########################################################################
+
+def cpu_workers(worker_class, cpus=None):
+    """
+    Returns the number of workers for the worker class and CPU count.
+    """
+    cpus = cpus or multiprocessing.cpu_count()
+    if worker_class == "sync":
+        return 2 * cpus + 1
+    return cpus
+
+##########################################################################
+## Server Settings
+##########################################################################
+
+bind         = os.environ.get('FLASHCUBE_BIND', "127.0.0.1:8000")
+worker_class = os.environ.get('FLASHCUBE_WORKER_CLASS', "sync")
+workers      = int(os.environ.get('FLASHCUBE_WORKERS', 0)) or cpu_workers(worker_class)
+proc_name    = "flashcube"
+preload_app  = True
+timeout      = 30
+
+# Crypto threads per gevent worker (not a gunicorn setting)
+crypto_threads = int(os.environ.get('FLASHCUBE_THREADS', 2))
+
+##########################################################################
+## Secret Handoff
+##########################################################################
+
+# Loaded once per master; on reload the keyring is already in memory
+try:
+    crypto.load()
+except TypeError:
+    raise RuntimeError("Could not load the Flashcube secret; "
+                       "generate a key with flashcube-keygen.")
+
+##########################################################################
+## Server Hooks
+##########################################################################
+
+def on_starting(server):
+    """
+    Loads the keyring in the master, if the app settings replaced it, so
+    that the workers inherit it as well.
+    """
+    crypto.load()
+
+
+def post_fork(server, worker):
+    """
+    Sizes the crypto worker pool of the gevent workers.
+    """
+    if (server.cfg.settings['worker_class'].get() != "sync" and
+        not app.config['FLASHCUBE_CRYPTO_POOL']):
+        app.config['FLASHCUBE_CRYPTO_POOL'] = crypto_threads
+        cryptopool.init_app(app)
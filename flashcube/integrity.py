@@ -0,0 +1,103 @@
+# flashcube.integrity
+# Verifies that every stored credential can be decrypted.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 19 09:12:44 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: integrity.py [] benjamin@bengfort.com $
+
+"""
+Verifies that every stored credential decrypts: that its ciphertext is
+valid base64 (if stored as text) and a whole number of blocks, that it was
+encrypted with a key on the keyring, and that its padding, its CRC32
+checksum and the UTF-8 of its plaintext are intact. Otherwise a corrupted
+credential is only found when its user tries to log in.
+
+The scan reads the credentials in chunks with a server-side cursor and
+decrypts them on a pool of processes (see flashcube.rotation), without
+writing anything, so it can run against a read replica.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+from flashcube.models import Credential
+from flashcube.rotation import ChunkedScan, stream_batches
+from flashcube.cipher import CheckSumError, UnknownKeyError
+
+##########################################################################
+## Verification
+##########################################################################
+
+def failure_reason(error):
+    """
+    Returns the reason a credential failed to decrypt from the error.
+    """
+    if isinstance(error, UnknownKeyError):
+        return "unknown key"
+    if isinstance(error, CheckSumError):
+        return str(error).lower()
+    if isinstance(error, UnicodeDecodeError):
+        return "invalid utf-8"
+    if isinstance(error, ValueError):
+        return "incomplete blocks"
+    return "invalid base64"
+
+
+def verify_rows(rows, keyring):
+    """
+    Decrypts the (id, password, ciphertext) rows, returning the number of
+    rows that were verified and the (id, reason) of every row that failed.
+    """
+    raws     = []
+    failures = []
+    for pk, password, ciphertext in rows:
+        try:
+            raws.append((pk, Credential.unwrap(password, ciphertext)))
+        except TypeError as e:
+            failures.append((pk, failure_reason(e)))
+
+    plaintexts = keyring.decrypt_many((raw for pk, raw in raws), decode=False)
+    for (pk, raw), plaintext in zip(raws, plaintexts):
+        if isinstance(plaintext, Exception):
+            failures.append((pk, failure_reason(plaintext)))
+
+    return len(rows) - len(failures), failures
+
+##########################################################################
+## Integrity Scan
+##########################################################################
+
+class IntegrityScan(ChunkedScan):
+    """
+    Verifies the credentials of each shard, or a random sample of them
+    (the fraction `sample`), which is chosen by the database so that only
+    the sample is read.
+    """
+
+    worker = staticmethod(verify_rows)
+    counts = ('verified', 'failures')
+
+    def __init__(self, keyring, checkpoint, processes=0, chunk=10000, size=500, sample=1.0):
+        super(IntegrityScan, self).__init__(keyring, checkpoint, processes, chunk, size)
+        self.sample   = sample
+        self.verified = 0
+        self.failures = []
+
+    def batches(self, connection, after):
+        for batch in stream_batches(connection, after, self.chunk, self.size, self.sample):
+            yield batch[-1][0], len(batch), batch
+
+    def handle(self, session, result):
+        verified, failures = result
+        return {'verified': verified, 'failures': failures}
+
+    def verify(self, idx, session, progress=None):
+        """
+        Verifies the shard from its checkpoint.
+        """
+        self.scan(idx, session, progress)
@@ -17,8 +17,54 @@ SQLAlchemy declarative models for Flashcube.
 ## Imports
 ##########################################################################
 
-from flashcube import db
+import base64
+
+from flashcube.core import app, db
 from datetime import datetime
+from collections import namedtuple
+from sqlalchemy import text, bindparam, and_
+from sqlalchemy.types import UserDefinedType
+
+
+##########################################################################
+## Column Types
+##########################################################################
+
+def binary_hashes():
+    """
+    True if email hashes are stored as the 32 raw bytes of the SHA-256
+    digest rather than as 44 characters of base64 text.
+    """
+    return app.config['FLASHCUBE_HASH_STORAGE'] == "binary"
+
+
+class EmailHash(UserDefinedType):
+    """
+    The SHA-256 email hash column, stored either as base64 text in a
+    CHAR(44) or as the raw digest in a BYTEA depending on the setting of
+    FLASHCUBE_HASH_STORAGE. Values are passed in the stored format; the
+    API decodes base64 email hashes before querying in binary mode.
+    """
+
+    def get_col_spec(self):
+        return "BYTEA" if binary_hashes() else "CHAR(44)"
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None or not binary_hashes():
+                return value
+            return dialect.dbapi.Binary(value)
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if value is None:
+                return value
+            if binary_hashes():
+                return str(value)
+            # CHAR columns are padded with trailing whitespace
+            return value.rstrip()
+        return process
 
 
 ##########################################################################
@@ -67,19 +113,316 @@ class Credential(db.Model):
     __tablename__ = 'credential'
 
     id         = db.Column("id", db.BIGINT(signed=False), primary_key=True)
-    email_hash = db.Column("email_hash", db.CHAR(44), unique=True, nullable=False)
-    password   = db.Column("password", db.VARCHAR(512), nullable=False)
+    email_hash = db.Column("email_hash", EmailHash(), unique=True, nullable=False)
+    password   = db.Column("password", db.VARCHAR(512), nullable=True)
+    ciphertext = db.Column("ciphertext", db.LargeBinary, nullable=True)
     created    = db.Column('created', db.DateTime(timezone=True), nullable=False,
                         default=datetime.now)
     updated    = db.Column('updated', db.DateTime(timezone=True),
                         nullable=False, default=datetime.now, onupdate=datetime.now)
 
-    def __init__(self, email_hash=None, password=None, **kwargs):
+    def __init__(self, email_hash=None, password=None, ciphertext=None, **kwargs):
         self.email_hash = email_hash
         self.password   = password
+        self.ciphertext = ciphertext
 
         for key, val in kwargs.items():
             setattr(self, key, val)
 
     def __repr__(self):
+        if binary_hashes():
+            return "<Credential: %s>" % base64.b64encode(self.email_hash)
         return "<Credential: %s>" % self.email_hash
+
+    @property
+    def raw_ciphertext(self):
+        """
+        The binary ciphertext of this credential, in either storage format.
+        """
+        return self.unwrap(self.password, self.ciphertext)
+
+    @staticmethod
+    def unwrap(password, ciphertext):
+        """
+        Returns the binary ciphertext from the columns of a credential row.
+        During the transition from base64 to binary storage a row may have
+        either the raw `ciphertext` column or the base64 `password` column
+        set; the binary column is preferred if both are.
+        """
+        if ciphertext is not None:
+            return ciphertext
+        return base64.b64decode(password)
+
+    @classmethod
+    def insert_many(klass, rows, column="password", session=None):
+        """
+        Inserts many (email_hash, ciphertext) rows with a single multi-row
+        INSERT statement, skipping any rows whose email hash is already in
+        the cube. The ciphertexts are stored in the named column, either
+        "password" (base64) or "ciphertext" (binary). Returns the set of
+        email hashes that were inserted.
+
+        Requires PostgreSQL 9.5+ (or SQLite 3.35+) for ON CONFLICT and
+        RETURNING support. The caller is responsible for the commit of the
+        session (by default the db session, otherwise e.g. a shard).
+        """
+        if not rows:
+            return set()
+
+        session = session or db.session
+        htype  = klass.__table__.c.email_hash.type
+        dtype  = klass.__table__.c[column].type
+        values = []
+        params = {}
+        binds  = []
+        for idx, (email_hash, ciphertext) in enumerate(rows):
+            values.append("(:email_hash_%i, :value_%i, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)" % (idx, idx))
+            params['email_hash_%i' % idx] = email_hash
+            params['value_%i' % idx]      = ciphertext
+            binds.append(bindparam('email_hash_%i' % idx, type_=htype))
+            binds.append(bindparam('value_%i' % idx, type_=dtype))
+
+        sql = (
+            'INSERT INTO "credential" ("email_hash", "%s", "created", "updated") '
+            'VALUES %s ON CONFLICT ("email_hash") DO NOTHING RETURNING "email_hash"'
+        ) % (column, ", ".join(values))
+
+        result = session.execute(text(sql, bindparams=binds, typemap={'email_hash': htype}), params)
+        if not result.returns_rows:
+            # SQLite reports no cursor description when nothing is returned
+            return set()
+        return set(row[0] for row in result)
+
+    @classmethod
+    def convert_batch(klass, after=0, limit=1000, binary=True, session=None):
+        """
+        Converts up to `limit` rows with an id greater than `after` to the
+        binary storage format (or back to base64 if binary is False), in
+        one UPDATE per batch. Rows are only converted if their stored value
+        is unchanged, so concurrent writes are never overwritten.
+
+        Returns the last id examined (None if there were no rows left), the
+        number of rows converted, and the ids of rows that could not be
+        decoded. The caller is responsible for the commit of the session.
+        """
+        session = session or db.session
+        query   = session.query(klass.id, klass.password, klass.ciphertext)
+        query = query.filter(klass.id > after)
+        query = query.filter(klass.ciphertext == None if binary else klass.password == None)
+        rows  = query.order_by(klass.id).limit(limit).all()
+
+        if not rows:
+            return None, 0, []
+
+        params = []
+        failed = []
+        for pk, password, ciphertext in rows:
+            if binary:
+                try:
+                    value = base64.b64decode(password)
+                except TypeError:
+                    failed.append(pk)
+                    continue
+                params.append({'_id': pk, '_old': password, '_new': value})
+            else:
+                params.append({'_id': pk, '_old': ciphertext, '_new': base64.b64encode(ciphertext)})
+
+        source, target = ("password", "ciphertext") if binary else ("ciphertext", "password")
+        converted = klass.replace_many(params, source, target, session)
+        return rows[-1][0], converted, failed
+
+    @classmethod
+    def rewrap(klass, email_hash, old, password=None, ciphertext=None, session=None):
+        """
+        Replaces the stored ciphertext of the credential with the email hash
+        by the same password encrypted under another key, but only if the
+        stored (password, ciphertext) columns are still `old`, so that a
+        concurrent write is never overwritten. Returns the number of rows
+        replaced. The caller is responsible for the commit of the session.
+        """
+        session = session or db.session
+        table   = klass.__table__
+        clauses = [table.c.email_hash == email_hash]
+        for column, value in zip((table.c.password, table.c.ciphertext), old):
+            clauses.append(column == value) # IS NULL for None
+
+        # Leave "updated" alone, since the credential itself is unchanged
+        stmt = table.update().where(and_(*clauses))
+        stmt = stmt.values({table.c.password: password, table.c.ciphertext: ciphertext,
+                            table.c.updated: table.c.updated})
+        return session.execute(stmt).rowcount
+
+    @classmethod
+    def rewrap_batch(klass, params, binary=False, session=None):
+        """
+        Replaces the stored ciphertexts of a batch of credentials with the
+        same passwords encrypted under another key, in one UPDATE. Params
+        are dicts of the '_id', the '_old' stored value and the '_new' value
+        of the column of the storage format (the binary "ciphertext" column
+        if binary is True, otherwise the "password" column). Rows are only
+        replaced if their stored value is unchanged, so concurrent writes
+        are never overwritten.
+
+        Returns the number of rows replaced. The caller is responsible for
+        the commit of the session.
+        """
+        column = "ciphertext" if binary else "password"
+        return klass.replace_many(params, column, column, session)
+
+    @classmethod
+    def replace_many(klass, params, source, target, session=None):
+        """
+        Sets the `target` column of many credentials with a single UPDATE
+        ... FROM (VALUES ...) statement, where their `source` column is
+        still the old value; the `source` column is cleared if it is not
+        the target. Params are dicts of the '_id', the '_old' value of the
+        source and the '_new' value of the target. The updated timestamp
+        is left alone, since the credentials themselves are unchanged.
+
+        The columns of the VALUES list are referred to by their default
+        names (column1, column2, ...), since SQLite cannot alias them.
+        Requires PostgreSQL (or SQLite 3.33+) for UPDATE ... FROM. Returns
+        the number of rows replaced; the caller is responsible for the
+        commit of the session.
+        """
+        if not params:
+            return 0
+
+        session = session or db.session
+        otype  = klass.__table__.c[source].type
+        ntype  = klass.__table__.c[target].type
+        values = []
+        binds  = []
+        args   = {}
+        for idx, param in enumerate(params):
+            values.append("(:id_%i, :old_%i, :new_%i)" % (idx, idx, idx))
+            args['id_%i' % idx]  = param['_id']
+            args['old_%i' % idx] = param['_old']
+            args['new_%i' % idx] = param['_new']
+            binds.append(bindparam('old_%i' % idx, type_=otype))
+            binds.append(bindparam('new_%i' % idx, type_=ntype))
+
+        assign = ['"%s" = "batch"."column3"' % target]
+        if source != target:
+            assign.append('"%s" = NULL' % source)
+
+        sql = (
+            'UPDATE "credential" SET %s FROM (VALUES %s) AS "batch" '
+            'WHERE "credential"."id" = "batch"."column1" '
+            'AND "credential"."%s" = "batch"."column2"'
+        ) % (", ".join(assign), ", ".join(values), source)
+
+        return session.execute(text(sql, bindparams=binds), args).rowcount
+
+    @classmethod
+    def copy_batch(klass, target, after=0, limit=10000):
+        """
+        Copies up to `limit` rows with an id greater than `after` from the
+        credential table into the `target` table (e.g. a new partitioned
+        table) with the same columns, in one INSERT ... SELECT. Rows that
+        are already in the target are skipped.
+
+        Returns the last id copied (None if there were no rows left) and
+        the number of rows inserted. The caller is responsible for the
+        commit.
+        """
+        table  = klass.__tablename__
+        params = {'after': after, 'limit': limit}
+        window = ('SELECT MAX("id") FROM (SELECT "id" FROM "%s" WHERE "id" > :after '
+                  'ORDER BY "id" LIMIT :limit) AS "batch"') % table
+        last   = db.session.execute(text(window), params).scalar()
+
+        if last is None:
+            return None, 0
+
+        columns = '"id", "email_hash", "password", "ciphertext", "created", "updated"'
+        sql = (
+            'INSERT INTO "%s" (%s) SELECT %s FROM "%s" WHERE "id" > :after AND "id" <= :last '
+            'ON CONFLICT DO NOTHING'
+        ) % (target, columns, columns, table)
+
+        params['last'] = last
+        return last, db.session.execute(text(sql), params).rowcount
+
+    @classmethod
+    def restore_many(klass, rows, session=None):
+        """
+        Inserts many credential rows, given as dictionaries of every column
+        but the id, with a single multi-row INSERT statement. Unlike
+        insert_many, the created and updated timestamps are preserved (e.g.
+        when moving credentials between shards). Rows whose email hash is
+        already present are skipped; returns the set of email hashes that
+        were inserted. The caller is responsible for the commit.
+        """
+        if not rows:
+            return set()
+
+        session = session or db.session
+        columns = ("email_hash", "password", "ciphertext", "created", "updated")
+        table   = klass.__table__
+        values  = []
+        params  = {}
+        binds   = []
+        for idx, row in enumerate(rows):
+            names = [":%s_%i" % (column, idx) for column in columns]
+            values.append("(%s)" % ", ".join(names))
+            for column in columns:
+                params["%s_%i" % (column, idx)] = row[column]
+                binds.append(bindparam("%s_%i" % (column, idx), type_=table.c[column].type))
+
+        sql = (
+            'INSERT INTO "credential" (%s) VALUES %s '
+            'ON CONFLICT ("email_hash") DO NOTHING RETURNING "email_hash"'
+        ) % (", ".join('"%s"' % column for column in columns), ", ".join(values))
+
+        result = session.execute(text(sql, bindparams=binds,
+                                      typemap={'email_hash': table.c.email_hash.type}), params)
+        if not result.returns_rows:
+            return set()
+        return set(row[0] for row in result)
+
+##########################################################################
+## Credential Records
+##########################################################################
+
+class CredentialRecord(namedtuple('CredentialRecord', 'id email_hash password ciphertext created updated')):
+    """
+    A compact, read-only record of the columns of a credential row, for
+    code that needs attribute access to a row but not a mapped instance
+    (which is registered in the identity map, instrumented, and carries a
+    __dict__ and instance state of its own).
+    """
+
+    __slots__ = ()
+
+    # The columns to select for a record, in the order of the fields
+    columns = (Credential.id, Credential.email_hash, Credential.password,
+               Credential.ciphertext, Credential.created, Credential.updated)
+
+    def __new__(klass, id=None, email_hash=None, password=None,
+                ciphertext=None, created=None, updated=None):
+        return super(CredentialRecord, klass).__new__(klass, id, email_hash, password,
+                                                      ciphertext, created, updated)
+
+    def __repr__(self):
+        return "<CredentialRecord: %s>" % self.id
+
+    @classmethod
+    def select(klass, query):
+        """
+        Returns a record for each row of a query of the record columns.
+        """
+        return [klass(*row) for row in query]
+
+    @property
+    def raw_ciphertext(self):
+        """
+        The binary ciphertext of this credential, in either storage format.
+        """
+        return Credential.unwrap(self.password, self.ciphertext)
+
+    def serialize(self):
+        """
+        Returns every column but the id, e.g. for restore_many.
+        """
+        return dict((name, getattr(self, name)) for name in self._fields[1:])
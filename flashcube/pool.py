@@ -0,0 +1,214 @@
+# flashcube.pool
+# An instrumented connection pool for the Flashcube database engines.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Mon Nov 09 10:04:36 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: pool.py [] benjamin@bengfort.com $
+
+"""
+Wires the DATABASE_OPTIONS setting into the creation of every engine (the
+default database, shards and replicas) and provides a QueuePool that keeps
+statistics on how long requests wait for a connection, so that the pool
+can be sized to the number of workers.
+
+The pool also backports two options of later versions of SQLAlchemy:
+`pre_ping`, which tests each connection with a SELECT 1 when it is checked
+out and transparently reconnects if it was dropped, and `use_lifo`, which
+reuses the most recently returned connection first so that idle
+connections beyond the steady state load can be recycled.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import time
+import threading
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import queue as sqla_queue
+from flask.ext.sqlalchemy import SQLAlchemy
+
+# Engine options that configure the pool rather than the engine
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle',
+                'pre_ping', 'use_lifo')
+
+##########################################################################
+## Pool Statistics
+##########################################################################
+
+class PoolStats(object):
+    """
+    Counters for an instrumented pool. Kept separately from the pool, so
+    that they survive the pool being recreated after a disconnect.
+    """
+
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self.checkouts = 0
+        self.connects  = 0
+        self.timeouts  = 0
+        self.failed_pings = 0
+        self.wait_time = 0.0
+        self.max_wait  = 0.0
+
+    def waited(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += seconds
+            self.max_wait   = max(self.max_wait, seconds)
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def serialize(self):
+        return {
+            "checkouts": self.checkouts,
+            "connects": self.connects,
+            "timeouts": self.timeouts,
+            "failed_pings": self.failed_pings,
+            "wait_time": self.wait_time,
+            "avg_wait": self.wait_time / self.checkouts if self.checkouts else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+##########################################################################
+## Instrumented Pool
+##########################################################################
+
+class LifoQueue(sqla_queue.Queue):
+    """
+    A pool queue that returns the most recently returned item first.
+    """
+
+    def _get(self):
+        return self.queue.pop()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that records checkout waits and timeouts, with optional
+    pre-ping and LIFO checkout.
+    """
+
+    def __init__(self, creator, pre_ping=False, use_lifo=False, stats=None, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self._pre_ping = pre_ping
+        self._use_lifo = use_lifo
+        self.stats     = stats or PoolStats()
+
+        if use_lifo:
+            self._pool = LifoQueue(self._pool.maxsize)
+
+    def _create_connection(self):
+        self.stats.increment('connects')
+        return QueuePool._create_connection(self)
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            record = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.stats.increment('timeouts')
+            raise
+        finally:
+            self.stats.waited(time.time() - started)
+
+        if self._pre_ping:
+            self._ping(record)
+        return record
+
+    def _ping(self, record):
+        """
+        Tests the connection of the record, reconnecting if it has gone
+        away (e.g. the database restarted or a firewall dropped it).
+        """
+        connection = record.get_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+        except Exception as e:
+            self.stats.increment('failed_pings')
+            record.invalidate(e)
+            try:
+                record.get_connection()
+            except Exception:
+                # Return the record so that its slot in the pool is not lost
+                self._do_return_conn(record)
+                raise
+
+    def recreate(self):
+        self.logger.info("Pool recreating")
+        return self.__class__(self._creator, pool_size=self._pool.maxsize,
+                          max_overflow=self._max_overflow,
+                          timeout=self._timeout,
+                          recycle=self._recycle, echo=self.echo,
+                          logging_name=self._orig_logging_name,
+                          use_threadlocal=self._use_threadlocal,
+                          reset_on_return=self._reset_on_return,
+                          pre_ping=self._pre_ping,
+                          use_lifo=self._use_lifo,
+                          stats=self.stats,
+                          _dispatch=self.dispatch,
+                          _dialect=self._dialect)
+
+
+def pool_status(engine):
+    """
+    Returns the current status and statistics of the pool of the engine.
+    """
+    pool   = engine.pool
+    status = { "pool": pool.__class__.__name__ }
+
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool._timeout,
+        })
+
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(pool.stats.serialize())
+        status.update({ "pre_ping": pool._pre_ping, "use_lifo": pool._use_lifo })
+
+    return status
+
+##########################################################################
+## Flask-SQLAlchemy
+##########################################################################
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    Applies the DATABASE_OPTIONS setting to every engine that is created,
+    using the instrumented pool for every database but SQLite (which does
+    not use a QueuePool unless a pool size is given).
+    """
+
+    def apply_pool_defaults(self, app, options):
+        SQLAlchemy.apply_pool_defaults(self, app, options)
+        options.update(app.config.get('DATABASE_OPTIONS', None) or {})
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite':
+            for key in POOL_OPTIONS:
+                options.pop(key, None)
+        else:
+            options.setdefault('poolclass', InstrumentedQueuePool)
+
+        if not issubclass(options.get('poolclass', QueuePool), InstrumentedQueuePool):
+            options.pop('pre_ping', None)
+            options.pop('use_lifo', None)
+
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
@@ -0,0 +1,197 @@
+# flashcube.queries
+# Data access layer for the hot paths of the Flashcube service.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Tue Nov 10 09:48:13 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: queries.py [] benjamin@bengfort.com $
+
+"""
+Data access layer for the statements that run on almost every request:
+looking up an API client by api key, and selecting, updating or deleting a
+credential by email hash. Rather than building and compiling an ORM query
+each time, each is a Core statement that is built once and compiled once
+per process (with a compiled cache). On PostgreSQL it is also prepared
+once per connection with PREPARE, so that the server parses and plans it
+only once per connection rather than on every request.
+
+A prepared statement keeps the parameter types of the table when it was
+prepared, so the names of the credential statements include the email hash
+storage (CHAR or BYTEA) and a statement prepared before it was changed is
+never executed. Prepared statements belong to a server connection, so set
+FLASHCUBE_PREPARE to False behind a pooler in transaction mode (e.g.
+pgbouncer).
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import re
+
+from datetime import datetime
+from flashcube.core import app
+from flashcube.models import Client, Credential
+from sqlalchemy import select, bindparam, text
+
+# Compiled forms of the statements, shared by every connection
+COMPILED_CACHE = {}
+
+# Key of the names of the statements prepared on a connection in its info
+PREPARED_KEY = 'flashcube_prepared'
+
+##########################################################################
+## Hot Statements
+##########################################################################
+
+class HotStatement(object):
+    """
+    A statement that is compiled once per process and, on PostgreSQL,
+    prepared once per connection. The settings named in `modes` change the
+    parameter types of the statement, so their values are part of the
+    name it is prepared with.
+    """
+
+    def __init__(self, name, clause, modes=()):
+        self.name      = name
+        self.clause    = clause
+        self.modes     = modes
+        self._prepared = {}
+
+    @property
+    def prepared_name(self):
+        """
+        The name of the statement on the server, with its current modes.
+        """
+        return "_".join((self.name,) + tuple(str(app.config.get(mode)) for mode in self.modes))
+
+    def prepared(self, dialect):
+        """
+        Returns the PREPARE and EXECUTE clauses of the statement for the
+        dialect and the current modes, which are built once so that they
+        are compiled once.
+        """
+        name = self.prepared_name
+        if (dialect.name, name) not in self._prepared:
+            compiled = self.clause.compile(dialect=dialect)
+            sql, names = self.numbered(compiled.string)
+
+            prepare = text("PREPARE %s AS %s" % (name, sql))
+            execute = text(
+                "EXECUTE %s (%s)" % (name, ", ".join(":%s" % param for param in names)),
+                bindparams=[bindparam(param, type_=compiled.binds[param].type) for param in names],
+                typemap=dict((column.name, column.type) for column in self.columns),
+            )
+            self._prepared[(dialect.name, name)] = (prepare, execute)
+
+        return self._prepared[(dialect.name, name)]
+
+    @property
+    def columns(self):
+        return getattr(self.clause, 'columns', ())
+
+    @staticmethod
+    def numbered(sql):
+        """
+        Converts the named parameters of a statement compiled for psycopg2,
+        %(name)s, into the numbered parameters of PREPARE, $1. Returns the
+        statement and the parameter names in order.
+        """
+        names = []
+
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return "$%i" % (names.index(match.group(1)) + 1)
+
+        sql = re.sub(r"%\((\w+)\)s", number, sql).replace("%%", "%")
+        return sql, names
+
+    def execute(self, session, **params):
+        """
+        Executes the statement in the session with the parameters.
+        """
+        connection = session.connection().execution_options(compiled_cache=COMPILED_CACHE)
+
+        if (connection.dialect.name != 'postgresql' or
+            not app.config.get('FLASHCUBE_PREPARE', True)):
+            return connection.execute(self.clause, params)
+
+        name = self.prepared_name
+        prepare, execute = self.prepared(connection.dialect)
+
+        # The info is cleared whenever the connection is replaced
+        prepared = connection.connection.info.setdefault(PREPARED_KEY, set())
+        if name not in prepared:
+            connection.execute(prepare)
+            prepared.add(name)
+
+        return connection.execute(execute, params)
+
+
+client     = Client.__table__
+credential = Credential.__table__
+
+CLIENT_BY_APIKEY = HotStatement("flashcube_client_by_apikey",
+    select([client.c.id, client.c.name, client.c.apikey, client.c.secret])
+    .where(client.c.apikey == bindparam('apikey', type_=client.c.apikey.type)))
+
+CREDENTIAL_BY_HASH = HotStatement("flashcube_credential_by_hash",
+    select([credential.c.password, credential.c.ciphertext])
+    .where(credential.c.email_hash == bindparam('email_hash', type_=credential.c.email_hash.type)),
+    modes=('FLASHCUBE_HASH_STORAGE',))
+
+UPDATE_CREDENTIAL = HotStatement("flashcube_update_credential",
+    credential.update()
+    .where(credential.c.email_hash == bindparam('_email_hash', type_=credential.c.email_hash.type))
+    .values(password=bindparam('_password', type_=credential.c.password.type),
+            ciphertext=bindparam('_ciphertext', type_=credential.c.ciphertext.type),
+            updated=bindparam('_updated', type_=credential.c.updated.type)),
+    modes=('FLASHCUBE_HASH_STORAGE',))
+
+DELETE_CREDENTIAL = HotStatement("flashcube_delete_credential",
+    credential.delete()
+    .where(credential.c.email_hash == bindparam('email_hash', type_=credential.c.email_hash.type)),
+    modes=('FLASHCUBE_HASH_STORAGE',))
+
+##########################################################################
+## Data Access Functions
+##########################################################################
+
+def get_client(session, apikey):
+    """
+    Returns the (id, name, apikey, secret) row of the client with the api
+    key, or None if there is no such client.
+    """
+    return CLIENT_BY_APIKEY.execute(session, apikey=apikey).first()
+
+
+def get_credential(session, email_hash):
+    """
+    Returns the (password, ciphertext) of the credential with the email
+    hash (as stored) as a plain tuple, or None if there is no such
+    credential. The result proxy row is not kept, since it holds on to the
+    result metadata and the processors of the row.
+    """
+    row = CREDENTIAL_BY_HASH.execute(session, email_hash=email_hash).first()
+    return tuple(row) if row is not None else None
+
+
+def update_credential(session, email_hash, password=None, ciphertext=None):
+    """
+    Replaces the stored ciphertext of the credential with the email hash.
+    Returns the number of rows updated. The caller commits the session.
+    """
+    return UPDATE_CREDENTIAL.execute(session, _email_hash=email_hash, _password=password,
+                                     _ciphertext=ciphertext, _updated=datetime.now()).rowcount
+
+
+def delete_credential(session, email_hash):
+    """
+    Deletes the credential with the email hash. Returns the number of rows
+    deleted. The caller commits the session.
+    """
+    return DELETE_CREDENTIAL.execute(session, email_hash=email_hash).rowcount
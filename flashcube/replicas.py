@@ -0,0 +1,234 @@
+# flashcube.replicas
+# Routes read only queries to replicas of the primary database.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Fri Nov 06 09:31:52 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: replicas.py [] benjamin@bengfort.com $
+
+"""
+Routes read only queries (fetching a credential, looking up an API client)
+to the read replicas of the primary database listed in the
+FLASHCUBE_REPLICAS setting. Every replica has its own engine and connection
+pool (as a Flask-SQLAlchemy bind). Writes always use the primary database.
+
+Replicas lag behind the primary, so for FLASHCUBE_WRITE_WINDOW seconds
+after an email hash is written it is read from the primary instead (read
+your writes). The recent writes are in shared memory that is created the
+first time the app is configured with replicas (and reused when it is
+configured again), so they are seen by every worker forked from a
+preloaded app (as in gunicorn_conf); an app configured in each worker
+only sees its own writes. A replica that fails with a
+connection error is skipped for FLASHCUBE_REPLICA_RETRY seconds, and the
+query is retried on the next replica or the primary.
+
+Replicas mirror the default database only; sharded credentials are always
+read from their shard.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import time
+import zlib
+import ctypes
+import multiprocessing
+
+from flashcube.shards import BoundSession
+from sqlalchemy.exc import OperationalError, InterfaceError
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+##########################################################################
+## Recent Writes
+##########################################################################
+
+class RecentWrites(object):
+    """
+    A record of the keys written in the last `window` seconds, in shared
+    memory so that every process forked after it is created (the workers
+    of a preloaded gunicorn app) sees the writes of the others. Each key
+    hashes to one of `maxsize` slots holding the time it expires; keys that
+    share a slot are recent until the later of them expires, which only
+    sends a few more reads to the primary.
+    """
+
+    def __init__(self, window=5, maxsize=100000, timer=time.time):
+        self.window  = window
+        self.maxsize = maxsize
+        self.timer   = timer
+        self._slots  = multiprocessing.RawArray('d', maxsize)
+
+    def slot(self, key):
+        """
+        Returns the index of the slot of the key, the same in every process.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return (zlib.crc32(key) & 0xffffffff) % self.maxsize
+
+    def add(self, *keys):
+        """
+        Records that the keys were just written.
+        """
+        if not self.window:
+            return
+
+        expires = self.timer() + self.window
+        for key in keys:
+            self._slots[self.slot(key)] = expires
+
+    def clear(self):
+        """
+        Forgets every recorded write, in every process.
+        """
+        ctypes.memset(self._slots, 0, ctypes.sizeof(self._slots))
+
+    def __contains__(self, key):
+        return self._slots[self.slot(key)] > self.timer()
+
+    def __len__(self):
+        now = self.timer()
+        return sum(1 for expires in self._slots if expires > now)
+
+##########################################################################
+## Replica Set
+##########################################################################
+
+class ReplicaSet(object):
+    """
+    Routes read only queries to a healthy replica of the primary database.
+    """
+
+    # Errors that indicate the replica (rather than the query) has failed
+    FAILURES = (OperationalError, InterfaceError)
+
+    def __init__(self, db, app=None, timer=time.time):
+        self.db        = db
+        self.app       = None
+        self.count     = 0
+        self.retry     = 30
+        self.timer     = timer
+        self.writes    = None
+        self._next     = 0
+        self._down     = {}
+        self._sessions = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Registers a bind for every replica in the FLASHCUBE_REPLICAS
+        setting. Can be called again to reconfigure the replicas.
+        """
+        self.remove()
+
+        uris  = app.config.get('FLASHCUBE_REPLICAS', None) or ()
+        binds = dict(app.config.get('SQLALCHEMY_BINDS', None) or {})
+        for key in [key for key in binds if key.startswith('replica')]:
+            del binds[key]
+        for idx, uri in enumerate(uris):
+            binds[self.bind_key(idx)] = uri
+
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+
+        self.app       = app
+        self.count     = len(uris)
+        self.retry     = app.config.get('FLASHCUBE_REPLICA_RETRY', 30)
+        self._next     = 0
+        self._down     = {}
+        self._sessions = {}
+
+        # The shared memory is only needed with replicas, and is allocated
+        # once so that it is the same in every worker forked after this.
+        window = app.config.get('FLASHCUBE_WRITE_WINDOW', 5)
+        if self.writes is not None:
+            self.writes.window = window
+            self.writes.timer  = self.timer
+            self.writes.clear()
+        elif self.enabled:
+            self.writes = RecentWrites(window, timer=self.timer)
+
+        if not getattr(app, '_flashcube_replicas', False):
+            app.teardown_appcontext(lambda exception=None: self.remove())
+            app._flashcube_replicas = True
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def bind_key(self, idx):
+        return "replica%i" % idx
+
+    def session(self, idx):
+        """
+        Returns the scoped session of the replica with the given index.
+        """
+        if idx not in self._sessions:
+            engine = self.db.get_engine(self.app, self.bind_key(idx))
+            self._sessions[idx] = scoped_session(sessionmaker(class_=BoundSession,
+                                                              app=self.app, bind=engine))
+        return self._sessions[idx]
+
+    def healthy(self):
+        """
+        Returns the indices of the replicas that have not recently failed,
+        starting from the next replica in turn.
+        """
+        now   = self.timer()
+        start = self._next
+        self._next = (self._next + 1) % (self.count or 1)
+
+        indices = [(start + offset) % self.count for offset in xrange(self.count)]
+        return [idx for idx in indices if self._down.get(idx, 0) <= now]
+
+    def failed(self, idx):
+        """
+        Skips the replica with the given index for the retry period.
+        """
+        self._down[idx] = self.timer() + self.retry
+
+    def wrote(self, *keys):
+        """
+        Records that the email hashes were written to the primary, so
+        that they are read from the primary for the next few seconds.
+        """
+        if self.enabled:
+            self.writes.add(*keys)
+
+    def run(self, query, keys=(), primary=None):
+        """
+        Runs the read only function `query(session)` on a healthy replica
+        and returns its result. The primary session (by default the db
+        session) is used instead if there are no replicas, if any of the
+        email hash keys were recently written, or if the primary is not the
+        default database (e.g. a shard). If a replica fails, the query is
+        retried on the next one, and finally on the primary.
+        """
+        primary = primary or self.db.session
+        if not self.enabled or primary is not self.db.session:
+            return query(primary)
+
+        if any(key in self.writes for key in keys):
+            return query(primary)
+
+        for idx in self.healthy():
+            session = self.session(idx)
+            try:
+                return query(session)
+            except self.FAILURES:
+                session.remove()
+                self.failed(idx)
+
+        return query(primary)
+
+    def remove(self):
+        """
+        Removes the replica sessions at the end of a request.
+        """
+        for session in self._sessions.values():
+            session.remove()
@@ -0,0 +1,381 @@
+# flashcube.rotation
+# Re-encrypts every stored credential with the current key.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Wed Nov 18 10:42:16 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: rotation.py [] benjamin@bengfort.com $
+
+"""
+Offline re-encryption of every credential with the current key of the
+keyring, for a forced rotation (credentials are otherwise re-encrypted
+lazily, as they are read).
+
+Credentials are read in chunks of rows in id order (keyset pagination),
+each with a server-side cursor so that a chunk is never entirely in
+memory, and handed in batches to a pool of processes that decrypt them
+and encrypt them again. The batches are written back, in order, with one
+UPDATE ... FROM (VALUES ...) per storage format in each batch; each chunk
+is one transaction, after which the last id is saved to a checkpoint file
+so that an interrupted rotation resumes from the last chunk that was
+committed. Other scans of every credential
+(e.g. verifying their checksums) are built on the same ChunkedScan.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import json
+import base64
+import time
+import multiprocessing
+
+from collections import deque
+from sqlalchemy import select, func
+from flashcube.models import Credential
+
+##########################################################################
+## Reading and Re-encryption
+##########################################################################
+
+def sampled(dialect, fraction):
+    """
+    Returns a clause that is true for about the fraction of the rows, at
+    random. PostgreSQL's random() is a float between 0 and 1, but SQLite's
+    is a signed 64-bit integer.
+    """
+    if dialect.name == 'sqlite':
+        return func.abs(func.random() % 1000000) < int(fraction * 1000000)
+    return func.random() < fraction
+
+
+def stream_batches(connection, after=0, chunk=10000, size=500, sample=1.0):
+    """
+    Yields batches of up to `size` (id, password, ciphertext) rows from the
+    `chunk` rows with an id greater than `after`, in id order, read with a
+    server-side cursor where the driver has one (e.g. psycopg2). If sample
+    is less than 1, the database only returns that fraction of the rows,
+    chosen at random.
+    """
+    table  = Credential.__table__
+    query  = select([table.c.id, table.c.password, table.c.ciphertext])
+    query  = query.where(table.c.id > after)
+    if sample < 1.0:
+        query = query.where(sampled(connection.dialect, sample))
+    query  = query.order_by(table.c.id).limit(chunk)
+    result = connection.execution_options(stream_results=True).execute(query)
+
+    try:
+        while True:
+            rows = result.fetchmany(size)
+            if not rows: break
+
+            # Buffers cannot be sent to the worker processes
+            yield [(pk, password, None if ciphertext is None else str(ciphertext))
+                   for pk, password, ciphertext in rows]
+    finally:
+        result.close()
+
+
+# The keyring of a worker process of the pool
+_keyring = None
+
+def init_worker(keyring):
+    """
+    Gives the worker process of the pool the keyring.
+    """
+    global _keyring
+    _keyring = keyring
+
+
+def run_worker(worker, rows):
+    """
+    Calls the batch function with the rows and the keyring of the worker
+    process.
+    """
+    return worker(rows, _keyring)
+
+
+def rewrap_rows(rows, keyring):
+    """
+    Re-encrypts the (id, password, ciphertext) rows that were not encrypted
+    with the current key, in the storage format of each row. Returns the
+    params of Credential.rewrap_batch for the base64 and the binary rows,
+    the number of rows that were already current, and the ids of the rows
+    that could not be decrypted.
+    """
+    stale   = []
+    current = 0
+    failed  = []
+
+    for pk, password, ciphertext in rows:
+        try:
+            raw = Credential.unwrap(password, ciphertext)
+        except TypeError:
+            failed.append(pk)
+            continue
+
+        if keyring.key_id(raw, decode=False) == keyring.current:
+            current += 1
+        else:
+            stale.append((pk, password, ciphertext, raw))
+
+    plaintexts = keyring.decrypt_many((row[3] for row in stale), decode=False)
+    decrypted  = []
+    for row, plaintext in zip(stale, plaintexts):
+        if isinstance(plaintext, Exception):
+            failed.append(row[0])
+        else:
+            decrypted.append((row, plaintext))
+
+    ciphertexts = keyring.encrypt_many((plaintext for row, plaintext in decrypted), encode=False)
+    passwords   = []
+    binary      = []
+    for ((pk, password, ciphertext, raw), plaintext), new in zip(decrypted, ciphertexts):
+        if ciphertext is not None:
+            binary.append({'_id': pk, '_old': ciphertext, '_new': new})
+        else:
+            passwords.append({'_id': pk, '_old': password, '_new': base64.b64encode(new)})
+
+    return passwords, binary, current, failed
+
+##########################################################################
+## Checkpoints
+##########################################################################
+
+class Checkpoint(object):
+    """
+    The progress of a scan, as the last id committed on each shard and the
+    counts of the scan so far, saved to a JSON file. The checkpoint is
+    saved under a key (e.g. the id of the key a rotation is to) and a
+    checkpoint under another key is ignored.
+    """
+
+    def __init__(self, path, key):
+        self.path   = path
+        self.key    = key
+        self.shards = {}
+        self.counts = {}
+
+    def load(self):
+        """
+        Loads the progress from the file, if there is one for the key.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('key') == self.key:
+                self.shards = dict((int(idx), last) for idx, last in data['shards'].items())
+                self.counts = data.get('counts', {})
+        return self
+
+    def last_id(self, idx):
+        """
+        Returns the last id committed on the shard with the index.
+        """
+        return self.shards.get(idx, 0)
+
+    def save(self, idx, last_id, counts=None):
+        """
+        Records the last id committed on the shard (and the counts of the
+        scan through it), replacing the file atomically so that a crash
+        never leaves it half written.
+        """
+        self.shards[idx] = last_id
+        if counts is not None:
+            self.counts = counts
+
+        partial = self.path + ".partial"
+        with open(partial, 'w') as f:
+            json.dump({'key': self.key, 'shards': self.shards, 'counts': self.counts}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partial, self.path)
+
+    def clear(self):
+        """
+        Deletes the checkpoint once the scan is complete.
+        """
+        self.shards = {}
+        self.counts = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+##########################################################################
+## Chunked Scans
+##########################################################################
+
+class ChunkedScan(object):
+    """
+    Runs the batch function `worker(rows, keyring)` over the credentials of
+    each shard from its checkpoint, on a pool of `processes` worker
+    processes (or in this process if there are none). Subclasses handle
+    the result of each batch, returning the counts to add to their
+    attributes (named in `counts`) once the chunk is committed; the counts
+    are saved with the checkpoint so that a resumed scan reports them all.
+    """
+
+    worker = None
+    counts = ()
+
+    def __init__(self, keyring, checkpoint, processes=0, chunk=10000, size=500):
+        self.keyring    = keyring
+        self.checkpoint = checkpoint
+        self.processes  = processes
+        self.chunk      = chunk
+        self.size       = size
+        self.pool       = None
+        self.started    = None
+        self.examined   = 0
+
+    def start(self):
+        """
+        Restores the counts of the checkpoint and starts the worker
+        processes; before any connections are opened, so that they are not
+        shared with the workers.
+        """
+        for key in self.counts:
+            if key in self.checkpoint.counts:
+                setattr(self, key, self.checkpoint.counts[key])
+
+        self.started = time.time()
+        if self.processes:
+            self.pool = multiprocessing.Pool(self.processes, init_worker, (self.keyring,))
+
+    def stop(self):
+        """
+        Stops the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def count(self, idx, session):
+        """
+        Returns the number of rows left to scan on the shard.
+        """
+        try:
+            query = session.query(func.count(Credential.id))
+            return query.filter(Credential.id > self.checkpoint.last_id(idx)).scalar()
+        finally:
+            session.commit()
+
+    @property
+    def rate(self):
+        """
+        The number of rows examined per second.
+        """
+        elapsed = time.time() - self.started
+        return self.examined / elapsed if elapsed > 0 else 0.0
+
+    def batches(self, connection, after):
+        """
+        Yields the last id, the number of rows read and the rows to pass to
+        the worker of each batch of the chunk after the id.
+        """
+        for batch in stream_batches(connection, after, self.chunk, self.size):
+            yield batch[-1][0], len(batch), batch
+
+    def results(self, batches):
+        """
+        Yields the last id, the number of rows read and the result of the
+        worker for each batch, in order, with at most two batches per worker
+        process in flight so that memory stays bounded.
+        """
+        if self.pool is None:
+            for last, count, rows in batches:
+                yield last, count, self.worker(rows, self.keyring)
+            return
+
+        pending = deque()
+        for last, count, rows in batches:
+            pending.append((last, count, self.pool.apply_async(run_worker, (self.worker, rows))))
+            if len(pending) >= 2 * self.processes:
+                last, count, result = pending.popleft()
+                yield last, count, result.get()
+
+        while pending:
+            last, count, result = pending.popleft()
+            yield last, count, result.get()
+
+    def handle(self, session, result):
+        """
+        Handles the result of a batch, returning the counts to add.
+        """
+        raise NotImplementedError()
+
+    def scan(self, idx, session, progress=None):
+        """
+        Scans the shard from its checkpoint, one chunk per transaction,
+        calling progress (if given) after each chunk is committed.
+        """
+        after = self.checkpoint.last_id(idx)
+        while True:
+            examined, counts = 0, {}
+            try:
+                connection = session.connection(mapper=Credential.__mapper__)
+                batches    = self.batches(connection, after)
+                for last, count, result in self.results(batches):
+                    for key, value in self.handle(session, result).items():
+                        counts[key] = counts[key] + value if key in counts else value
+                    after     = last
+                    examined += count
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
+            if not examined: break
+
+            self.examined += examined
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+            self.checkpoint.save(idx, after, dict((key, getattr(self, key)) for key in self.counts))
+
+            if progress is not None:
+                progress(self)
+
+            if examined < self.chunk: break
+
+##########################################################################
+## Rotation
+##########################################################################
+
+class Rotation(ChunkedScan):
+    """
+    Re-encrypts the credentials of each shard with the current key of the
+    keyring, writing each batch back with one UPDATE per storage format.
+    """
+
+    worker = staticmethod(rewrap_rows)
+    counts = ('rotated', 'current', 'changed', 'failed')
+
+    def __init__(self, *args, **kwargs):
+        super(Rotation, self).__init__(*args, **kwargs)
+        self.rotated = 0
+        self.current = 0
+        self.changed = 0
+        self.failed  = []
+
+    def handle(self, session, result):
+        passwords, binary, current, failed = result
+        rotated  = Credential.rewrap_batch(passwords, False, session)
+        rotated += Credential.rewrap_batch(binary, True, session)
+        return {
+            'rotated': rotated,
+            'changed': len(passwords) + len(binary) - rotated,
+            'current': current,
+            'failed': failed,
+        }
+
+    def rotate(self, idx, session, progress=None):
+        """
+        Rotates the shard from its checkpoint.
+        """
+        self.scan(idx, session, progress)
@@ -0,0 +1,283 @@
+# flashcube.shards
+# Routes credentials across several databases by email hash.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 05 11:02:44 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: shards.py [] benjamin@bengfort.com $
+
+"""
+Application level sharding of the credential table across the databases
+listed in the FLASHCUBE_SHARDS setting. Every shard has its own engine and
+connection pool (as a Flask-SQLAlchemy bind) and its own scoped session;
+clients and anything else that is not a credential stay in the default
+database. If no shards are configured, credentials are in the default
+database as well.
+
+Credentials are routed with jump consistent hashing of the email hash, so
+adding a shard to the end of the list only moves 1/N of the credentials.
+While `flashcube-reshard` moves them, FLASHCUBE_RESHARD_FROM is set to the
+previous number of shards and credentials are looked for on both.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import base64
+import struct
+import hashlib
+
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+##########################################################################
+## Routing Functions
+##########################################################################
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping and Veach, 2014) of a 64 bit integer key
+    into one of the given number of buckets.
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key    = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump   = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def digest(email_hash):
+    """
+    Returns the 32 byte SHA-256 digest of an email hash as stored, either
+    as base64 text or as the raw digest, so that credentials are routed to
+    the same shard whatever the setting of FLASHCUBE_HASH_STORAGE.
+    """
+    if len(email_hash) == 32:
+        return str(email_hash)
+    return base64.b64decode(email_hash)
+
+
+def shard_index(email_hash, count):
+    """
+    Returns the index of the shard for an email hash (as stored) out of
+    the given number of shards.
+    """
+    key, = struct.unpack(">Q", hashlib.md5(digest(email_hash)).digest()[:8])
+    return jump_hash(key, count)
+
+##########################################################################
+## Shard Map
+##########################################################################
+
+class BoundSession(Session):
+    """
+    A session bound to the engine of a single database (e.g. a shard).
+    Flask-SQLAlchemy's commit signals are registered on every session, so
+    it carries the attributes that they expect.
+    """
+
+    def __init__(self, app=None, **options):
+        self.app = app
+        self._model_changes = {}
+        Session.__init__(self, **options)
+
+
+class ShardMap(object):
+    """
+    Maps email hashes to the session of the database that stores them.
+    """
+
+    def __init__(self, db, app=None):
+        self.db        = db
+        self.app       = None
+        self.count     = 0
+        self.previous  = None
+        self._sessions = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Registers a bind for every shard in the FLASHCUBE_SHARDS setting.
+        Can be called again to reconfigure the shards.
+        """
+        self.remove()
+
+        uris  = app.config.get('FLASHCUBE_SHARDS', None) or ()
+        binds = dict(app.config.get('SQLALCHEMY_BINDS', None) or {})
+        for key in [key for key in binds if key.startswith('shard')]:
+            del binds[key]
+        for idx, uri in enumerate(uris):
+            binds[self.bind_key(idx)] = uri
+
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+
+        self.app       = app
+        self.count     = len(uris)
+        self.previous  = app.config.get('FLASHCUBE_RESHARD_FROM', None) if uris else None
+        self._sessions = {}
+
+        if not getattr(app, '_flashcube_shards', False):
+            app.teardown_appcontext(lambda exception=None: self.remove())
+            app._flashcube_shards = True
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def bind_key(self, idx):
+        return "shard%i" % idx
+
+    def index(self, email_hash, count=None):
+        """
+        Returns the index of the shard for the email hash.
+        """
+        return shard_index(email_hash, count or self.count)
+
+    def session(self, idx):
+        """
+        Returns the scoped session of the shard with the given index.
+        """
+        if not self.enabled:
+            return self.db.session
+
+        if idx not in self._sessions:
+            engine = self.db.get_engine(self.app, self.bind_key(idx))
+            self._sessions[idx] = scoped_session(sessionmaker(class_=BoundSession,
+                                                              app=self.app, bind=engine))
+        return self._sessions[idx]
+
+    def sessions(self):
+        """
+        Returns the session of every shard (or the default session).
+        """
+        if not self.enabled:
+            return [self.db.session]
+        return [self.session(idx) for idx in xrange(self.count)]
+
+    def session_for(self, email_hash):
+        """
+        Returns the session of the shard the email hash belongs on.
+        """
+        if not self.enabled:
+            return self.db.session
+        return self.session(self.index(email_hash))
+
+    def previous_for(self, email_hash):
+        """
+        While resharding, returns the session of the shard the email hash
+        belonged on before, if it is not the same shard; otherwise None.
+        """
+        if not self.previous:
+            return None
+
+        idx = self.index(email_hash, self.previous)
+        if idx == self.index(email_hash):
+            return None
+        return self.session(idx)
+
+    def sessions_for(self, email_hash):
+        """
+        Returns the sessions that the email hash may be stored in, with
+        the shard it belongs on first.
+        """
+        sessions = [self.session_for(email_hash)]
+        previous = self.previous_for(email_hash)
+        if previous is not None:
+            sessions.append(previous)
+        return sessions
+
+    def group(self, email_hashes):
+        """
+        Groups email hashes by the index of the shard they belong on.
+        """
+        groups = {}
+        for email_hash in email_hashes:
+            idx = self.index(email_hash) if self.enabled else 0
+            groups.setdefault(idx, []).append(email_hash)
+        return groups
+
+    def remove(self):
+        """
+        Removes the shard sessions at the end of a request.
+        """
+        for session in self._sessions.values():
+            session.remove()
+
+##########################################################################
+## Resharding
+##########################################################################
+
+def reshard_batch(shards, idx, after=0, limit=1000):
+    """
+    Moves the credentials in up to `limit` rows with an id greater than
+    `after` on the shard with the given index that belong on another
+    shard. Each credential is copied to its shard, then deleted from this
+    shard only if it was not written to in the meantime (every write
+    changes the stored ciphertext); if it was, the copy is deleted instead
+    so that the next pass moves the newer version.
+
+    Returns the last id examined (None if there were no rows left), the
+    number of credentials moved, and the email hashes that were not.
+    """
+    from flashcube.models import Credential, CredentialRecord
+
+    source  = shards.session(idx)
+    query   = source.query(*CredentialRecord.columns).filter(Credential.id > after)
+    rows    = CredentialRecord.select(query.order_by(Credential.id).limit(limit))
+    source.commit()
+
+    if not rows:
+        return None, 0, []
+
+    # Group the rows that do not belong here by their shard
+    moves = {}
+    for row in rows:
+        dest = shards.index(row.email_hash)
+        if dest != idx:
+            moves.setdefault(dest, []).append(row)
+
+    def unchanged(row):
+        return (Credential.email_hash == row.email_hash,
+                Credential.password == row.password,
+                Credential.ciphertext == row.ciphertext)
+
+    moved, skipped = 0, []
+    for dest, batch in moves.items():
+        target = shards.session(dest)
+        items  = [row.serialize() for row in batch]
+        try:
+            created = Credential.restore_many(items, target)
+            target.commit()
+        except Exception:
+            target.rollback()
+            raise
+
+        for row in batch:
+            if row.email_hash not in created:
+                # Already copied by a previous pass, or written to directly
+                existing = target.query(Credential.id).filter(*unchanged(row)).count()
+                target.commit()
+                if not existing:
+                    skipped.append(row.email_hash)
+                    continue
+
+            deleted = source.query(Credential).filter(Credential.id == row.id,
+                *unchanged(row)).delete(synchronize_session=False)
+            source.commit()
+
+            if deleted:
+                moved += 1
+                continue
+
+            # Written to on this shard while being copied; undo the copy
+            target.query(Credential).filter(*unchanged(row)).delete(synchronize_session=False)
+            target.commit()
+            skipped.append(row.email_hash)
+
+    return rows[-1].id, moved, skipped
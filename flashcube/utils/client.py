@@ -82,6 +82,18 @@ class FlashcubeClient(object):
         response = requests.post(urlp, data=data, headers=head)
         return response
 
+    def bulk_post(self, credentials):
+        """
+        POSTs many (email, password) pairs to Flashcube at once
+        """
+        data = "&".join("email_hash=%s&password=%s" % (self.hash_email(email), self.urlquote(password))
+                        for email, password in credentials)
+        head = self.build_headers()
+        urlp = self._endpoint('cube', '_bulk')
+
+        response = requests.post(urlp, data=data, headers=head)
+        return response
+
     def get(self, email):
         email_hash = self.hash_email(email)
         endpoint   = self._endpoint('cube', email_hash)
@@ -90,6 +102,17 @@ class FlashcubeClient(object):
         response   = requests.get(endpoint, headers=headers)
         return response
 
+    def mget(self, emails):
+        """
+        GETs the passwords for many emails from Flashcube at once
+        """
+        data     = "&".join("email_hash=%s" % self.hash_email(email) for email in emails)
+        endpoint = self._endpoint('cube', '_mget')
+        headers  = self.build_headers()
+
+        response = requests.post(endpoint, data=data, headers=headers)
+        return response
+
     def put(self, email, password):
         email_hash = self.hash_email(email)
         endpoint   = self._endpoint('cube', email_hash)
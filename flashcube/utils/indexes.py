@@ -0,0 +1,120 @@
+# flashcube.utils.indexes
+# Inspects the indices of a live Flashcube database.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Tue Nov 03 09:42:18 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: indexes.py [] benjamin@bengfort.com $
+
+"""
+Inspects the indices of a live Flashcube database (PostgreSQL only) to
+find those that are redundant or unused. Every index must be updated on
+every write to its table, so an index that duplicates another, or that is
+never scanned, is pure write amplification.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+from collections import namedtuple
+from sqlalchemy import text
+
+##########################################################################
+## Index Catalog
+##########################################################################
+
+# The tables owned by Flashcube
+TABLES = ('client', 'credential')
+
+INDEX_QUERY = """
+SELECT ix.relname AS name, t.relname AS tablename,
+       i.indkey::text || ' ' || i.indclass::text || ' ' || i.indcollation::text AS columns,
+       COALESCE(pg_get_expr(i.indexprs, i.indrelid), '') AS expressions,
+       COALESCE(pg_get_expr(i.indpred, i.indrelid), '') AS predicate,
+       am.amname AS method, i.indisunique AS is_unique, i.indisprimary AS is_primary,
+       c.conname IS NOT NULL AS is_constraint, COALESCE(s.idx_scan, 0) AS scans,
+       pg_relation_size(i.indexrelid) AS size, pg_get_indexdef(i.indexrelid) AS definition
+FROM pg_index i
+JOIN pg_class t ON t.oid = i.indrelid
+JOIN pg_class ix ON ix.oid = i.indexrelid
+JOIN pg_am am ON am.oid = ix.relam
+LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+LEFT JOIN pg_constraint c ON c.conindid = i.indexrelid
+WHERE t.relname IN :tables AND pg_table_is_visible(t.oid)
+ORDER BY t.relname, ix.relname
+"""
+
+Index = namedtuple('Index', 'name tablename columns expressions predicate method '
+                            'is_unique is_primary is_constraint scans size definition')
+
+
+def fetch_indexes(session, tables=TABLES):
+    """
+    Returns an Index for every index on the given tables.
+    """
+    result = session.execute(text(INDEX_QUERY), {'tables': tuple(tables)})
+    return [Index(*row) for row in result]
+
+##########################################################################
+## Audit Functions
+##########################################################################
+
+def index_signature(index):
+    """
+    Indices with the same signature index the same data in the same way,
+    so all but one of them are redundant.
+    """
+    return (index.tablename, index.columns, index.expressions,
+            index.predicate, index.method)
+
+
+def index_rank(index):
+    """
+    Sorts the index to keep from a set of duplicates first: those backing
+    a primary key or constraint cannot be dropped, and a unique index also
+    enforces uniqueness, so prefer them over plain indices.
+    """
+    return (not index.is_primary, not index.is_constraint,
+            not index.is_unique, index.name)
+
+
+def redundant_indexes(indexes):
+    """
+    Returns (redundant, kept) pairs for every index that duplicates
+    another index on the same table.
+    """
+    groups = {}
+    for index in indexes:
+        groups.setdefault(index_signature(index), []).append(index)
+
+    redundant = []
+    for group in groups.values():
+        if len(group) < 2: continue
+        group = sorted(group, key=index_rank)
+        for index in group[1:]:
+            redundant.append((index, group[0]))
+
+    return sorted(redundant, key=lambda pair: (pair[0].tablename, pair[0].name))
+
+
+def unused_indexes(indexes):
+    """
+    Returns the indices that have never been scanned since the statistics
+    were last reset, excluding those that enforce a constraint.
+    """
+    return [
+        index for index in indexes
+        if not index.scans and not (index.is_primary or index.is_constraint or index.is_unique)
+    ]
+
+
+def droppable(index):
+    """
+    True if the index can be dropped directly, rather than by dropping the
+    constraint that owns it.
+    """
+    return not (index.is_primary or index.is_constraint)
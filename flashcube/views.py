@@ -17,16 +17,124 @@ Views for the Flashcube webapp, utilizing the Flask microframework.
 ## Imports
 ##########################################################################
 
+import base64
+
 from flask import request
-from flashcube import app, api, db, auth
+from flashcube.core import app, api, db, auth, crypto, shards, replicas, cryptopool, background
 from flask.ext.restful import Resource, reqparse, abort
-from flashcube.models import Client, Credential
-from flashcube.cipher import Cipher, EncryptedFileKey
+from flashcube.models import Client, Credential, binary_hashes
+from flashcube.pool import pool_status
+from flashcube.queries import *
 from flashcube.exceptions import *
 from sqlalchemy.orm.exc import *
 
+##########################################################################
+## Storage helpers
+##########################################################################
+
+def binary_storage():
+    """
+    True if new ciphertexts are written to the binary "ciphertext" column
+    rather than base64 encoded into the "password" column. Both formats
+    are always readable so that rows can be migrated online.
+    """
+    return app.config['FLASHCUBE_STORAGE'] == "binary"
+
+
+def storage_column():
+    """
+    The name of the column that new ciphertexts are written to.
+    """
+    return "ciphertext" if binary_storage() else "password"
+
+
+def hash_key(email_hash):
+    """
+    Decodes an email hash from the request into the value stored in the
+    email_hash column, once at the edge of the API: the base64 email hash
+    itself, or in binary mode the 32 byte digest. Returns None if the
+    email hash is not the canonical base64 encoding of a digest in either
+    mode, so that it is never stored or routed to a shard.
+    """
+    try:
+        digest = base64.b64decode(email_hash)
+    except TypeError:
+        return None
+
+    if len(digest) != 32 or base64.b64encode(digest) != email_hash:
+        return None
+    return digest if binary_hashes() else email_hash
+
+
+def group_sessions(keys, lookup=None):
+    """
+    Groups email hash keys by the session returned for each by the lookup
+    (by default the shard each belongs on), skipping keys without one.
+    """
+    lookup = lookup or shards.session_for
+    groups = {}
+    for key in keys:
+        session = lookup(key)
+        if session is not None:
+            groups.setdefault(session, []).append(key)
+    return groups
+
+
+def stored_elsewhere(keys):
+    """
+    While resharding, returns the set of email hash keys that are still
+    stored on the shard they belonged on before, so that they are not
+    inserted twice.
+    """
+    stored = set()
+    for session, group in group_sessions(keys, shards.previous_for).items():
+        try:
+            query = session.query(Credential.email_hash)
+            stored.update(key for key, in query.filter(Credential.email_hash.in_(group)))
+        finally:
+            session.commit()
+    return stored
+
+
+def encrypt_columns(password):
+    """
+    Encrypts a password into the column values for the storage format,
+    clearing the column of the other format.
+    """
+    if binary_storage():
+        ciphertext = cryptopool.run(crypto.encrypt, password, encode=False)
+        return {'password': None, 'ciphertext': ciphertext}
+    return {'password': cryptopool.run(crypto.encrypt, password), 'ciphertext': None}
+
+
+def rewrap(key, password, ciphertext):
+    """
+    Re-encrypts the credential stored as (password, ciphertext) with the
+    current key, unless it was written to in the meantime. Run in the
+    background, so that keys are rotated by normal read traffic.
+    """
+    plaintext = crypto.decrypt(Credential.unwrap(password, ciphertext), decode=False)
+    columns   = encrypt_columns(plaintext)
+    for session in shards.sessions_for(key):
+        try:
+            rewrapped = Credential.rewrap(key, (password, ciphertext), session=session, **columns)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        if rewrapped:
+            return rewrapped
+    return 0
+
 
-crypto = Cipher(app.config['FLASHCUBE_SECRET']) if app.config['FLASHCUBE_SECRET'] else None
+def rewrap_stale(key, row, raw):
+    """
+    Queues the re-encryption of a credential row if its raw ciphertext was
+    encrypted with a key other than the current one.
+    """
+    if app.config['FLASHCUBE_REWRAP'] and crypto.stale(raw, decode=False):
+        background.submit(key, rewrap, key, *row)
 
 ##########################################################################
 ## Resources
@@ -55,21 +163,35 @@ class Cube(Resource):
         email = args.get('email_hash', None)
         password = args.get('password', None)
 
-        if Credential.query.filter(Credential.email_hash == email).count() > 0:
-            abort(409, message="Attempting to insert duplicate entry.")
         if not email:
             abort(409, message="No email hash provided.")
         if not password:
             abort(409, message="No password provided.")
 
+        key = hash_key(email)
+        if key is None:
+            abort(409, message="Invalid email hash provided.")
+
         # Encrypt the password
-        password = crypto.encrypt(password)
-        print password
-        # Save to the database
-        credential = Credential(email, password)
-        db.session.add(credential)
-        db.session.commit()
+        column   = storage_column()
+        password = encrypt_columns(password)[column]
 
+        # Save to the database with a single conditional insert, so that
+        # concurrent writers of the same hash cannot race the check.
+        session = shards.session_for(key)
+        try:
+            created = set()
+            if not stored_elsewhere([key]):
+                created = Credential.insert_many([(key, password)], column, session)
+                session.commit()
+        except Exception:
+            session.rollback()
+            abort(500, message="Unknown database error.")
+
+        if not created:
+            abort(409, message="Attempting to insert duplicate entry.")
+
+        replicas.wrote(key)
         return { "success": True, "status": "created" }, 201
 
 
@@ -90,24 +212,71 @@ class CubeFacet(Resource):
             self._parser.add_argument('password', type=unicode)
         return self._parser
 
-    def obj_or_404(self, email_hash):
-        try:
-            return Credential.query.filter(Credential.email_hash == email_hash).one()
-        except NoResultFound:
+    def key_or_404(self, email_hash):
+        """
+        Decodes the email hash from the URL, which cannot exist if invalid.
+        """
+        key = hash_key(email_hash)
+        if key is None:
             raise CredentialNotFound("Object with ID '%s' does not exist." % email_hash)
-        except MultipleResultsFound:
-            abort(409, message="Multiple objects returned for ID '%s'" % email_hash)
-        except Exception:
-            abort(500, message="Unknown database error.")
+        return key
+
+    def row_or_404(self, email_hash):
+        """
+        Returns the (password, ciphertext) row of the credential.
+        """
+        key   = self.key_or_404(email_hash)
+        fetch = lambda session: get_credential(session, key)
+        for session in shards.sessions_for(key):
+            try:
+                row = replicas.run(fetch, [key], session)
+            except Exception:
+                abort(500, message="Unknown database error.")
+
+            if row is not None:
+                return row
+
+        raise CredentialNotFound("Object with ID '%s' does not exist." % email_hash)
+
+    def rowcount_or_404(self, email_hash, statement, first=True):
+        """
+        Executes a single UPDATE or DELETE statement (a function of the
+        session and the key of the email hash) on the shard of the email
+        hash and commits it, using the rowcount rather than a prior SELECT
+        to determine if the object exists. While resharding, the statement
+        is also executed on the previous shard of the email hash, unless it
+        matched on the first one.
+        """
+        key      = self.key_or_404(email_hash)
+        rowcount = 0
+        for session in shards.sessions_for(key):
+            try:
+                rowcount += statement(session, key)
+                session.commit()
+            except Exception:
+                session.rollback()
+                abort(500, message="Unknown database error.")
+
+            if rowcount and first:
+                break
+
+        if rowcount == 0:
+            raise CredentialNotFound("Object with ID '%s' does not exist." % email_hash)
+
+        replicas.wrote(key)
+        return rowcount
 
     @auth.required
     def get(self, email_hash):
-        obj = self.obj_or_404(email_hash)
+        row = self.row_or_404(email_hash)
+        raw = Credential.unwrap(*row)
         context = {
-            'email_hash': obj.email_hash,
-            'password': crypto.decrypt(obj.password),
+            'email_hash': email_hash,
+            'password': cryptopool.run(crypto.decrypt, raw, decode=False),
             'success': True,
         }
+
+        rewrap_stale(hash_key(email_hash), row, raw)
         return context
 
     @auth.required
@@ -117,24 +286,203 @@ class CubeFacet(Resource):
         if not args['password']:
             abort(409, message="No password provided.")
 
-        obj  = self.obj_or_404(email_hash)
-        obj.password = crypto.encrypt(args['password'])
-
-        db.session.merge(obj)
-        db.session.commit()
+        columns = encrypt_columns(args['password'])
+        self.rowcount_or_404(email_hash,
+            lambda session, key: update_credential(session, key, **columns))
 
         return { 'success': True, 'status': 'updated' }
 
     @auth.required
     def delete(self, email_hash):
+        self.rowcount_or_404(email_hash, delete_credential, first=False)
 
-        obj = self.obj_or_404(email_hash)
-
-        db.session.delete(obj)
-        db.session.commit()
         return { 'success': True, 'status': 'deleted' }
 
 
+class CubeMultiGet(Resource):
+    """
+    A batch "detail" resource for the Cube endpoint that fetches many
+    facets of the cube in a single request. All of the email hashes are
+    fetched with one query and decrypted in one pass; hashes that are not
+    in the cube are reported per item rather than failing the batch.
+    """
+
+    @property
+    def parser(self):
+        """
+        Returns the default parser for this Resource
+        """
+        if not hasattr(self, '_parser'):
+            self._parser = reqparse.RequestParser()
+            self._parser.add_argument('email_hash', type=str, action='append')
+        return self._parser
+
+    @auth.required
+    def post(self):
+        args   = self.parser.parse_args()
+        hashes = args.get('email_hash', None)
+
+        if not hashes:
+            abort(409, message="No email hashes provided.")
+        if len(hashes) > app.config['FLASHCUBE_BATCH_LIMIT']:
+            abort(409, message="Cannot fetch more than %i email hashes at once." %
+                  app.config['FLASHCUBE_BATCH_LIMIT'])
+
+        # Fetch the requested rows with a single query per shard (or from a
+        # replica), then from their previous shards any not moved yet.
+        keys      = dict((email_hash, hash_key(email_hash)) for email_hash in hashes)
+        pending   = set(keys.values()) - set([None])
+        rows      = {}
+        passwords = {}
+
+        def fetch(group):
+            def query(session):
+                query = session.query(Credential.email_hash, Credential.password,
+                                      Credential.ciphertext)
+                try:
+                    return query.filter(Credential.email_hash.in_(group)).all()
+                finally:
+                    session.commit()
+            return query
+
+        for lookup in (shards.session_for, shards.previous_for):
+            for session, group in group_sessions(pending, lookup).items():
+                # Read the binary ciphertext of each row in either storage format
+                for key, password, ciphertext in replicas.run(fetch(group), group, session):
+                    try:
+                        rows[key] = Credential.unwrap(password, ciphertext)
+                    except TypeError as e:
+                        passwords[key] = e
+                    else:
+                        rewrap_stale(key, (password, ciphertext), rows[key])
+
+            pending -= set(rows) | set(passwords)
+
+        # Decrypt every row in one batch
+        found = list(rows)
+        passwords.update(zip(found, cryptopool.run(crypto.decrypt_many,
+                                                   [rows[key] for key in found], decode=False)))
+
+        # Report in request order, with errors per item
+        results = []
+        for email_hash in hashes:
+            if keys[email_hash] not in passwords:
+                error = CredentialNotFound("Object with ID '%s' does not exist." % email_hash,
+                                           payload={'email_hash': email_hash})
+                results.append(error.serialize())
+                continue
+
+            password = passwords[keys[email_hash]]
+            if isinstance(password, Exception):
+                error = DatabaseError("Could not decrypt object with ID '%s'." % email_hash,
+                                      payload={'email_hash': email_hash})
+                results.append(error.serialize())
+                continue
+
+            results.append({
+                'email_hash': email_hash,
+                'password': password,
+                'success': True,
+            })
+
+        return { 'success': True, 'results': results }
+
+
+class CubeBulk(Resource):
+    """
+    A batch "list" resource for the Cube endpoint that adds many facets to
+    the cube in a single request. Passwords are encrypted in bulk and
+    written with one multi-row INSERT per chunk; email hashes that are
+    already in the cube are reported per item as conflicts.
+
+    With multiple shards, each shard is written in its own transaction.
+    """
+
+    @property
+    def parser(self):
+        """
+        Returns the default parser for this Resource
+        """
+        if not hasattr(self, '_parser'):
+            self._parser = reqparse.RequestParser()
+            self._parser.add_argument('email_hash', type=str, action='append')
+            self._parser.add_argument('password', type=unicode, action='append')
+        return self._parser
+
+    @auth.required
+    def post(self):
+        args      = self.parser.parse_args()
+        hashes    = args.get('email_hash', None) or []
+        passwords = args.get('password', None) or []
+
+        if not hashes:
+            abort(409, message="No email hashes provided.")
+        if len(hashes) != len(passwords):
+            abort(409, message="Each email hash requires exactly one password.")
+        if len(hashes) > app.config['FLASHCUBE_BATCH_LIMIT']:
+            abort(409, message="Cannot insert more than %i credentials at once." %
+                  app.config['FLASHCUBE_BATCH_LIMIT'])
+
+        # Skip blank passwords, invalid and duplicate hashes
+        keys   = [hash_key(email_hash) for email_hash in hashes]
+        errors = {}
+        rows   = []
+        seen   = set()
+        for idx, (key, password) in enumerate(zip(keys, passwords)):
+            if not hashes[idx]:
+                errors[idx] = ResourceConflict("No email hash provided.")
+            elif key is None:
+                errors[idx] = ResourceConflict("Invalid email hash provided.")
+            elif not password:
+                errors[idx] = ResourceConflict("No password provided.")
+            elif key in seen:
+                errors[idx] = ResourceConflict("Attempting to insert duplicate entry.")
+            else:
+                seen.add(key)
+                rows.append((key, password))
+
+        # Encrypt the passwords in one batch
+        column      = storage_column()
+        ciphertexts = cryptopool.run(crypto.encrypt_many, [password for key, password in rows],
+                                     encode=not binary_storage())
+        rows = [(key, ciphertext) for (key, password), ciphertext
+                in zip(rows, ciphertexts)]
+
+        # Save to each shard one multi-row statement per chunk
+        chunk   = app.config['FLASHCUBE_BULK_CHUNK']
+        created = set()
+        rows    = dict(rows)
+        for session, group in group_sessions(set(rows) - stored_elsewhere(rows)).items():
+            group = [(key, rows[key]) for key in group]
+            try:
+                for idx in xrange(0, len(group), chunk):
+                    created |= Credential.insert_many(group[idx:idx+chunk], column, session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                abort(500, message="Unknown database error.")
+
+        replicas.wrote(*created)
+
+        results = []
+        for idx, email_hash in enumerate(hashes):
+            if idx not in errors and keys[idx] not in created:
+                errors[idx] = ResourceConflict("Attempting to insert duplicate entry.")
+
+            if idx in errors:
+                errors[idx].payload = {'email_hash': email_hash}
+                results.append(errors[idx].serialize())
+                continue
+
+            results.append({
+                'email_hash': email_hash,
+                'status': 'created',
+                'success': True,
+            })
+
+        return { 'success': True, 'results': results }
+
+
 class Heartbeat(Resource):
     """
     Keep alive heartbeat endpoint for New Relic. If you hit this endpoint
@@ -149,11 +497,39 @@ class Heartbeat(Resource):
         return context
 
 
+class PoolStatus(Resource):
+    """
+    Instrumentation endpoint that reports the connection pool statistics
+    of every database engine in this process (the default database and
+    any shards or replicas): checked out connections, overflow, and the
+    time spent waiting for a connection. Use it to size the pool to the
+    number of workers; every worker process has its own pools. Also
+    reports the depth of the queue of the crypto worker pool and of the
+    background tasks.
+    """
+
+    @auth.required
+    def get(self):
+        engines = {"default": db.get_engine(app)}
+        for bind in app.config.get('SQLALCHEMY_BINDS', None) or {}:
+            engines[bind] = db.get_engine(app, bind)
+
+        return {
+            "success": True,
+            "pools": dict((name, pool_status(engine)) for name, engine in engines.items()),
+            "crypto": cryptopool.serialize(),
+            "background": background.serialize(),
+        }
+
+
 ##########################################################################
 ## Required in THIS FILE: creation of endpoints/routes
 ##########################################################################
 
 # Create endpoints
 api.add_resource(Cube, '/cube/')
+api.add_resource(CubeMultiGet, '/cube/_mget/')
+api.add_resource(CubeBulk, '/cube/_bulk/')
 api.add_resource(CubeFacet, '/cube/<path:email_hash>/')
 api.add_resource(Heartbeat, '/heartbeat/')
+api.add_resource(PoolStatus, '/heartbeat/pools/')
@@ -0,0 +1,26 @@
+# flashcube.wsgi
+# The WSGI entry point of the Flashcube app.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Fri Nov 13 09:52:06 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: wsgi.py [] benjamin@bengfort.com $
+
+"""
+The WSGI entry point of the Flashcube app, configured from the settings
+named by the FLASHCUBE_SETTINGS environment variable, e.g.:
+
+    $ gunicorn flashcube.wsgi:app
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+from flashcube.core import create_app
+
+# The app to serve
+app = create_app()
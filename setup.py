@@ -39,9 +39,14 @@ config = {
     "url": "https://github.com/bbengfort/flashcube/",
     "packages": packages,
     "install_requires": requires,
+    "extras_require": {
+        "async": ['gevent==1.0', 'greenlet==0.4.1'],
+    },
     "classifiers": classifiers,
     "zip_safe": False,
-    "scripts": ['bin/flashcube-addclient', 'bin/flashcube-keygen',],
+    "scripts": ['bin/flashcube-addclient', 'bin/flashcube-keygen', 'bin/flashcube-migrate',
+                'bin/flashcube-indexes', 'bin/flashcube-partition',
+                'bin/flashcube-reshard', 'bin/flashcube-rotate', 'bin/flashcube-verify',],
 }
 
 setup(**config)
@@ -17,10 +17,67 @@ The base test case for creating tests in Flashcube.
 ## Imports
 ##########################################################################
 
+import os
+import base64
+import urllib
+import hashlib
+import tempfile
 import unittest
-from flashcube import app, syncdb, db
+
+from flashcube.core import app, syncdb, db, schema_context, create_app
+from flashcube.core import crypto, prompt_for_secret, load_keyring
+from flashcube.auth import create_hmac, get_utc_timestamp
+from flashcube.cipher import Cipher, EncryptedFileKey, CheckSumError
 from flask.ext.testing import TestCase
 from sqlalchemy.exc import ProgrammingError
+from werkzeug.datastructures import Headers
+
+##########################################################################
+## Benchmarks
+##########################################################################
+
+# Benchmarks compare timings, which are too noisy on shared CI machines, so
+# they only run when FLASHCUBE_BENCHMARKS is set (e.g. by `make benchmark`).
+benchmark = unittest.skipUnless(os.environ.get('FLASHCUBE_BENCHMARKS', False),
+                                "set FLASHCUBE_BENCHMARKS to run the benchmarks")
+
+##########################################################################
+## Test Mixins
+##########################################################################
+
+class EndpointTestMixin(object):
+    """
+    The API client and request helpers shared by the endpoint tests.
+    """
+
+    APIKEY = "enQt5RH97mYhj6N8OFYraw"
+    SECRET = "utvyzGJCMOGjZul2BwOh0Roq6RRl1sPW3iOBW1lS0AE"
+
+    def build_auth_headers(self, apikey=None, secret=None, timestamp=None):
+        timestamp = timestamp or get_utc_timestamp()
+        apikey    = apikey or self.APIKEY
+        secret    = secret or self.SECRET
+        hmaccode  = create_hmac(apikey, secret, timestamp)
+        headers   = Headers()
+        headers.add("Authorization", "FLASHCUBE %s:%s" % (self.APIKEY, hmaccode))
+        headers.add("Time", str(timestamp))
+        headers.add("Content-Type", "application/x-www-form-urlencoded")
+
+        return headers
+
+    def uriquote(self, value):
+        """
+        Ensures slashes get quoted.
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        return urllib.quote(value, '')
+
+    def hash_email(self, email, quote=True):
+        hashb64 = base64.b64encode(hashlib.sha256(email).digest())
+        if quote:
+            return self.uriquote(hashb64)
+        return hashb64
 
 ##########################################################################
 ## Test Cases
@@ -29,8 +86,7 @@ from sqlalchemy.exc import ProgrammingError
 class InitializationTest(TestCase):
 
     def create_app(self):
-        app.config.from_object('flashcube.conf.TestingConfig')
-        return app
+        return create_app('flashcube.conf.TestingConfig')
 
     def tearDown(self):
         db.session.remove()
@@ -70,3 +126,80 @@ class InitializationTest(TestCase):
 
         # Ensure that the credential table has been created
         self.assertEqual(0, count_credentials(), "Credential table was not created")
+
+    def test_schema_context(self):
+        """
+        Assert the schema template renders an unpartitioned credential table
+        """
+        context = schema_context()
+        self.assertEqual('credential', context['credential_table'])
+        self.assertEqual('"id"', context['credential_primary_key'])
+        self.assertEqual("", context['credential_partition_by'])
+        self.assertEqual("", context['credential_partitions'])
+
+    def test_partitioned_schema_context(self):
+        """
+        Assert the schema template renders hash partitions on request
+        """
+        context = schema_context("credential_partitioned", 4)
+        self.assertIn('"email_hash"', context['credential_primary_key'])
+        self.assertIn('HASH ("email_hash")', context['credential_partition_by'])
+        self.assertEqual(4, context['credential_partitions'].count("PARTITION OF"))
+        self.assertIn('"credential_partitioned_p3"', context['credential_partitions'])
+        self.assertIn('MODULUS 4, REMAINDER 3', context['credential_partitions'])
+
+
+class SecretTest(TestCase):
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        # Two key files with different passphrases
+        self.keys = {}
+        for name, passphrase in (("alpha", "4lph4"), ("bravo", "br4v0")):
+            path = tempfile.mktemp(suffix=".key")
+            EncryptedFileKey(path).write("%s-s3cr3t" % name, password=passphrase)
+            self.keys[name] = path
+        self.environ = os.environ.pop('FLASHCUBE_PASSPHRASE', None)
+
+    def tearDown(self):
+        for path in self.keys.values():
+            os.remove(path)
+        os.environ.pop('FLASHCUBE_PASSPHRASE', None)
+        if self.environ is not None:
+            os.environ['FLASHCUBE_PASSPHRASE'] = self.environ
+        create_app('flashcube.conf.TestingConfig') # Restores the keyring
+
+    def test_retry_same_key(self):
+        """
+        Assert a wrong passphrase is retried for the same key file
+        """
+        os.environ['FLASHCUBE_PASSPHRASE'] = "br4v0"
+        self.assertEqual("bravo-s3cr3t", prompt_for_secret(self.keys["bravo"], "wrong"))
+
+    def test_wrong_environ_passphrase(self):
+        """
+        Assert a wrong passphrase from the environment raises
+        """
+        os.environ['FLASHCUBE_PASSPHRASE'] = "4lph4"
+        self.assertEqual("alpha-s3cr3t", prompt_for_secret(self.keys["alpha"]))
+        with self.assertRaises(CheckSumError):
+            prompt_for_secret(self.keys["bravo"])
+
+    def test_keyring_keys(self):
+        """
+        Assert retired keys are never loaded with the secret of another key
+        """
+        os.environ['FLASHCUBE_PASSPHRASE'] = "4lph4"
+        app.config['FLASHCUBE_KEY_ID']  = 1
+        app.config['FLASHCUBE_KEYRING'] = {0: self.keys["bravo"]}
+        with self.assertRaises(CheckSumError):
+            load_keyring()
+
+        app.config['FLASHCUBE_KEYRING'] = {0: self.keys["alpha"]}
+        keyring    = load_keyring()
+        ciphertext = Cipher("alpha-s3cr3t").encrypt("secret")
+        self.assertEqual(u"secret", keyring.decrypt(ciphertext))
+        self.assertEqual(u"secret", Cipher(app.config['FLASHCUBE_SECRET']).decrypt(
+                         keyring.cipher(1).encrypt("secret")))
@@ -17,10 +17,15 @@ Testing the auth/hmac module
 ## Imports
 ##########################################################################
 
+import os
 import time
+import timeit
+import shutil
+import tempfile
 import unittest
 import calendar
 
+from tests import benchmark
 from flashcube.auth import *
 from datetime import datetime, tzinfo, timedelta
 
@@ -84,3 +89,164 @@ class AuthTest(unittest.TestCase):
         result = create_hmac(apikey, secret)
 
         self.assertEqual(len(result), 44)
+
+    def test_verify_hmac(self):
+        """
+        Assert a pre-keyed HMAC verifies the correct signature
+        """
+        apikey = "44OuTgRE5trBp5c0EmuhTA"
+        secret = "SGXrQzxmART1mBSVcz0dcmTOCRzO699lMnyRNiE4oHM"
+        tstamp = 1378868803455
+        hmackey = create_hmac_key(secret)
+
+        self.assertTrue(verify_hmac(hmackey, apikey, tstamp,
+                                    "fE1XNMYFfkPTdE3duXFA/I9r06nudQGWAzv+AkiD3Jg="))
+
+        # Ensure the pre-keyed HMAC is not modified by verification
+        self.assertTrue(verify_hmac(hmackey, apikey, tstamp,
+                                    create_hmac(apikey, secret, tstamp)))
+
+    def test_verify_bad_hmac(self):
+        """
+        Assert a pre-keyed HMAC rejects incorrect signatures
+        """
+        apikey = "44OuTgRE5trBp5c0EmuhTA"
+        secret = "SGXrQzxmART1mBSVcz0dcmTOCRzO699lMnyRNiE4oHM"
+        tstamp = 1378868803455
+        hmackey = create_hmac_key(secret)
+
+        self.assertFalse(verify_hmac(hmackey, apikey, tstamp + 1,
+                                     "fE1XNMYFfkPTdE3duXFA/I9r06nudQGWAzv+AkiD3Jg="))
+        self.assertFalse(verify_hmac(hmackey, apikey, tstamp,
+                                     create_hmac(apikey, "abcdefghijklmnopqrstuvwxyz1234567890abcdefg", tstamp)))
+        self.assertFalse(verify_hmac(hmackey, apikey, tstamp, "not base64"))
+
+    @benchmark
+    def test_verify_hmac_benchmark(self):
+        """
+        Benchmark pre-keyed HMAC verification against create_hmac
+        """
+        apikey  = "44OuTgRE5trBp5c0EmuhTA"
+        secret  = "SGXrQzxmART1mBSVcz0dcmTOCRzO699lMnyRNiE4oHM"
+        tstamp  = 1378868803455
+        code    = create_hmac(apikey, secret, tstamp)
+        hmackey = create_hmac_key(secret)
+
+        def baseline():
+            return create_hmac(apikey, secret, tstamp) == code
+
+        def prekeyed():
+            return verify_hmac(hmackey, apikey, tstamp, code)
+
+        # Interleave the measurements so both see the same system noise
+        number   = 5000
+        timings  = [[], []]
+        for repeat in xrange(7):
+            for idx, func in enumerate((baseline, prekeyed)):
+                timings[idx].append(timeit.timeit(func, number=number))
+
+        baseline, prekeyed = [min(timing) for timing in timings]
+
+        self.assertLess(prekeyed, baseline,
+            "pre-keyed HMAC %0.2fus/request is not faster than %0.2fus/request" % (
+             prekeyed / number * 1e6, baseline / number * 1e6))
+
+class ClientCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now    = 1000.0
+        self.cache  = ClientCache(maxsize=2, ttl=60, negative_ttl=5, timer=lambda: self.now)
+        secret      = "SGXrQzxmART1mBSVcz0dcmTOCRzO699lMnyRNiE4oHM"
+        self.client = APIClient(1, "Test Client", "44OuTgRE5trBp5c0EmuhTA",
+                                secret, create_hmac_key(secret))
+
+    def test_cache_miss(self):
+        """
+        Assert an uncached apikey is missing
+        """
+        self.assertIs(ClientCache.MISSING, self.cache.get(self.client.apikey))
+
+    def test_cache_hit(self):
+        """
+        Assert a cached client is returned until it expires
+        """
+        self.cache.set(self.client.apikey, self.client)
+        self.assertEqual(self.client, self.cache.get(self.client.apikey))
+
+        self.now += 60
+        self.assertIs(ClientCache.MISSING, self.cache.get(self.client.apikey))
+
+    def test_negative_cache(self):
+        """
+        Assert unknown apikeys are cached as None for the negative ttl
+        """
+        self.cache.set("1234567890qwertyioasdf", None)
+        self.assertIsNone(self.cache.get("1234567890qwertyioasdf"))
+
+        self.now += 5
+        self.assertIs(ClientCache.MISSING, self.cache.get("1234567890qwertyioasdf"))
+
+    def test_cache_bounded(self):
+        """
+        Assert the least recently used apikey is evicted
+        """
+        self.cache.set("a", self.client)
+        self.cache.set("b", None)
+        self.cache.get("a")
+        self.cache.set("c", self.client)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIs(ClientCache.MISSING, self.cache.get("b"))
+        self.assertEqual(self.client, self.cache.get("a"))
+
+    def test_invalidate(self):
+        """
+        Assert apikeys can be invalidated individually or all at once
+        """
+        self.cache.set("a", self.client)
+        self.cache.set("b", None)
+
+        self.cache.invalidate("a")
+        self.assertIs(ClientCache.MISSING, self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_generation(self):
+        """
+        Assert a change of the shared generation invalidates cached clients
+        """
+        tmpdir = tempfile.mkdtemp(prefix="flashcube-clients-")
+        try:
+            path = os.path.join(tmpdir, "flashcube.clients")
+            self.cache.generation = ClientGeneration(path)
+            other = ClientGeneration(path) # As opened by another process
+
+            self.cache.set("a", self.client)
+            self.cache.set("b", None)
+            self.assertEqual(self.client, self.cache.get("a"))
+
+            other.bump()
+            self.assertEqual(1, self.cache.generation.value)
+            self.assertIs(ClientCache.MISSING, self.cache.get("a"))
+            self.assertIs(ClientCache.MISSING, self.cache.get("b"))
+
+            # A client fetched before the bump is not cached as current
+            generation = self.cache.generation.value
+            other.bump()
+            self.cache.set("a", self.client, generation)
+            self.assertIs(ClientCache.MISSING, self.cache.get("a"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_generation_disabled(self):
+        """
+        Assert the generation does not change without a usable path
+        """
+        generation = ClientGeneration()
+        generation.bump()
+        self.assertEqual(0, generation.value)
+
+        generation = ClientGeneration("/nonexistent/flashcube.clients")
+        self.assertEqual(0, generation.value)
@@ -20,11 +20,14 @@ Testing the cipher module
 
 import os
 
+import base64
 import string
 import random
+import timeit
 import unittest
 
 from Crypto.Cipher import AES
+from tests import benchmark
 from flashcube.cipher import *
 
 ##########################################################################
@@ -120,6 +123,100 @@ class CipherTest(unittest.TestCase):
         for item in decryptext:
             self.assertIn(item, plaintext)
 
+    def test_encrypt_many(self):
+        """
+        Assert batch encryption is compatible with decrypt
+        """
+        cipher     = Cipher(self.random_password())
+        plaintext  = ["foo", u"조선 민주주의 인민 공화국", "", self.random_password(100),
+                      "Something exactly 32 bytes long."]
+        ciphertext = cipher.encrypt_many(plaintext)
+
+        self.assertEqual(len(plaintext), len(ciphertext))
+        self.assertEqual(len(ciphertext), len(set(ciphertext)))
+        for ptext, ctext in zip(plaintext, ciphertext):
+            self.assertEqual(ptext, cipher.decrypt(ctext))
+
+    def test_decrypt_many(self):
+        """
+        Assert batch decryption is compatible with encrypt
+        """
+        cipher     = Cipher(self.random_password())
+        plaintext  = ["foo", u"La parole nous a été donnée pour déguiser notre pensée.",
+                      self.random_password(300), "bar"]
+        ciphertext = [cipher.encrypt(ptext) for ptext in plaintext]
+
+        self.assertEqual(plaintext, cipher.decrypt_many(ciphertext))
+        self.assertEqual([], cipher.decrypt_many([]))
+
+    def test_many_not_encoded(self):
+        """
+        Assert batch encryption and decryption without base64
+        """
+        cipher     = Cipher(self.random_password())
+        plaintext  = ["foo", "crazytown", self.random_password(64)]
+        ciphertext = cipher.encrypt_many(plaintext, encode=False)
+
+        self.assertEqual(plaintext, cipher.decrypt_many(ciphertext, decode=False))
+
+    def test_encrypt_bytes(self):
+        """
+        Assert binary encryption accepts bytearrays and memoryviews
+        """
+        cipher    = Cipher(self.random_password())
+        plaintext = "\x00\xff" + self.random_password(47)
+
+        for data in (plaintext, bytearray(plaintext), memoryview(plaintext), buffer(plaintext)):
+            ciphertext = cipher.encrypt_bytes(data)
+            self.assertEqual(len(ciphertext), 80)
+            self.assertEqual(plaintext, cipher.decrypt_bytes(ciphertext))
+            self.assertEqual(plaintext, cipher.decrypt_bytes(bytearray(ciphertext)))
+            self.assertEqual(plaintext, cipher.decrypt_bytes(memoryview(ciphertext)))
+
+    def test_bytes_compatibility(self):
+        """
+        Assert binary ciphertext is the encrypt format without base64
+        """
+        cipher     = Cipher(self.random_password())
+        plaintext  = self.random_password(20)
+
+        ciphertext = cipher.encrypt_bytes(plaintext)
+        self.assertEqual(plaintext, cipher.decrypt(ciphertext, decode=False))
+        self.assertEqual(plaintext, cipher.decrypt(base64.b64encode(ciphertext)))
+
+        ciphertext = cipher.encrypt(plaintext, encode=False)
+        self.assertEqual(plaintext, cipher.decrypt_bytes(ciphertext))
+
+        ciphertext = cipher.encrypt_bytes(plaintext, checksum=False)
+        self.assertEqual(plaintext, cipher.decrypt_bytes(ciphertext, checksum=False))
+
+    def test_decrypt_bytes_errors(self):
+        """
+        Assert binary decryption validates the padding and checksum
+        """
+        cipher     = Cipher(self.random_password())
+        other      = Cipher(self.random_password())
+        ciphertext = cipher.encrypt_bytes(self.random_password())
+
+        self.assertRaises(CheckSumError, other.decrypt_bytes, ciphertext)
+        self.assertRaises(CheckSumError, cipher.decrypt_bytes, ciphertext[:16] + "\x00" * 16)
+
+    def test_decrypt_many_errors(self):
+        """
+        Assert batch decryption reports per-item failures
+        """
+        cipher     = Cipher(self.random_password())
+        other      = Cipher(self.random_password())
+        ciphertext = [cipher.encrypt("Too many monkeys"), other.encrypt("in the tree."),
+                      "not base64", base64.b64encode("too short"), cipher.encrypt("jonesy")]
+
+        results = cipher.decrypt_many(ciphertext)
+        self.assertEqual("Too many monkeys", results[0])
+        self.assertIsInstance(results[1], CheckSumError)
+        self.assertIsInstance(results[2], Exception)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual("jonesy", results[4])
+
     def test_pad(self):
         """
         Testing padding of Cipher object
@@ -177,6 +274,240 @@ class CipherTest(unittest.TestCase):
         cipher     = Cipher(longpass, lazy=True)
         self.assertEqual(cipher.secret, longpass, "On lazy, a true length password was converted!")
 
+    def test_cbc_compatibility(self):
+        """
+        Assert the cached key schedule is compatible with AES-CBC
+        """
+        cipher = Cipher(self.random_password())
+        invec  = os.urandom(AES.block_size)
+
+        for length in xrange(0, 520, 4):
+            plaintext  = os.urandom(length)
+            expected   = AES.new(cipher.secret, AES.MODE_CBC, invec).encrypt(cipher.pad(plaintext))
+
+            self.assertEqual(expected, cipher.cbc_encrypt(invec, cipher.pad(plaintext)))
+            self.assertEqual(plaintext, cipher.decrypt_bytes(invec + expected, checksum=False))
+
+    def test_reset_secret(self):
+        """
+        Assert the key schedule follows changes to the secret
+        """
+        cipher     = Cipher(self.random_password())
+        ciphertext = cipher.encrypt("Too many monkeys in the tree.")
+
+        cipher.secret = Cipher(self.random_password()).secret
+        with self.assertRaises(CheckSumError):
+            cipher.decrypt(ciphertext)
+
+    @benchmark
+    def test_key_schedule_benchmark(self):
+        """
+        Benchmark the cached key schedule against a key schedule per call
+        """
+
+        class KeyPerCallCipher(Cipher):
+
+            def cbc_encrypt(self, invec, plaintext):
+                return AES.new(self.secret, AES.MODE_CBC, invec).encrypt(plaintext)
+
+            def decrypt_bytes(self, ciphertext, checksum=True):
+                invec = ciphertext[:AES.block_size]
+                plaintext = AES.new(self.secret, AES.MODE_CBC, invec).decrypt(ciphertext[AES.block_size:])
+                return self._unwrap(plaintext, checksum)
+
+        password = self.random_password()
+        before   = KeyPerCallCipher(password)
+        after    = Cipher(password)
+        number   = 2000
+        report   = []
+        totals   = [0.0, 0.0]
+
+        for length in (16, 32, 64, 128, 256, 512):
+            plaintext = self.random_password(length)
+            timings   = [[], []]
+
+            # Interleave the measurements so both see the same system noise
+            for repeat in xrange(7):
+                for idx, cipher in enumerate((before, after)):
+                    roundtrip = lambda: cipher.decrypt_bytes(cipher.encrypt_bytes(plaintext))
+                    timings[idx].append(timeit.timeit(roundtrip, number=number))
+
+            timings = [min(timing) for timing in timings]
+            totals  = [total + timing for total, timing in zip(totals, timings)]
+            report.append("%i bytes: %i -> %i ops/sec" % (
+                length, number / timings[0], number / timings[1]))
+
+        self.assertLess(totals[1], totals[0],
+            "cached key schedule is not faster: %s" % "; ".join(report))
+
+class IVPoolTest(unittest.TestCase):
+
+    def test_iv_size(self):
+        """
+        Assert the pool hands out block sized IVs
+        """
+        pool = IVPool(count=4)
+        for idx in xrange(10):
+            self.assertEqual(len(pool.read()), AES.block_size)
+
+    def test_no_duplicate_ivs(self):
+        """
+        Assert the pool does not repeat IVs across refills
+        """
+        pool = IVPool(count=8)
+        ivs  = [pool.read() for idx in xrange(100)]
+        self.assertEqual(len(ivs), len(set(ivs)))
+
+    def test_no_duplicate_ivs_across_forks(self):
+        """
+        Assert forked workers never share IVs with each other or the parent
+        """
+        pool    = IVPool(count=64)
+        workers = 4
+        reads   = 32
+
+        # Fill the parent's buffer before forking
+        ivs     = [pool.read()]
+        readers = []
+
+        for worker in xrange(workers):
+            rfd, wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(rfd)
+                    os.write(wfd, "".join(pool.read() for idx in xrange(reads)))
+                finally:
+                    os._exit(0)
+
+            os.close(wfd)
+            readers.append((pid, rfd))
+
+        for pid, rfd in readers:
+            data = ""
+            while True:
+                chunk = os.read(rfd, 4096)
+                if not chunk: break
+                data += chunk
+            os.close(rfd)
+            os.waitpid(pid, 0)
+
+            ivs.extend(data[idx:idx+AES.block_size] for idx in xrange(0, len(data), AES.block_size))
+
+        ivs.extend(pool.read() for idx in xrange(reads))
+
+        self.assertEqual(len(ivs), 1 + (workers + 1) * reads)
+        self.assertEqual(len(ivs), len(set(ivs)), "Duplicate IVs across forked processes")
+
+class LazyCipherTest(unittest.TestCase):
+
+    def test_lazy_load(self):
+        """
+        Assert the secret is only loaded on first use
+        """
+        calls  = []
+        cipher = LazyCipher(lambda: calls.append(1) or "s3cr3t")
+        self.assertFalse(cipher.loaded)
+        self.assertEqual([], calls)
+
+        ciphertext = cipher.encrypt("The eagle flies at midnight!")
+        self.assertTrue(cipher.loaded)
+        self.assertEqual(u"The eagle flies at midnight!", Cipher("s3cr3t").decrypt(ciphertext))
+        cipher.decrypt(ciphertext)
+        self.assertEqual([1], calls)
+
+        cipher.reset()
+        self.assertFalse(cipher.loaded)
+        cipher.decrypt(ciphertext)
+        self.assertEqual([1, 1], calls)
+
+    def test_no_secret(self):
+        """
+        Ensure a secret is required to use the cipher
+        """
+        cipher = LazyCipher(lambda: None)
+        with self.assertRaises(TypeError):
+            cipher.encrypt("The eagle flies at midnight!")
+        self.assertFalse(cipher.loaded)
+
+class KeyringTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keyring = Keyring(1, "n3ws3cr3t")
+        self.keyring.add(0, "s3cr3t")
+
+    def test_legacy_key(self):
+        """
+        Assert ciphertexts of key 0 are those of a single secret
+        """
+        legacy     = Cipher("s3cr3t")
+        ciphertext = legacy.encrypt("The eagle flies at midnight!")
+        self.assertEqual(0, self.keyring.key_id(ciphertext))
+        self.assertEqual(u"The eagle flies at midnight!", self.keyring.decrypt(ciphertext))
+
+        ciphertext = Keyring(0, "s3cr3t").encrypt("The eagle flies at midnight!")
+        self.assertEqual(u"The eagle flies at midnight!", legacy.decrypt(ciphertext))
+
+    def test_key_header(self):
+        """
+        Assert ciphertexts are prefixed with the id of their key
+        """
+        ciphertext = self.keyring.encrypt("The eagle flies at midnight!", encode=False)
+        self.assertEqual("\xfc\x01", ciphertext[:2])
+        self.assertEqual(2, len(ciphertext) % AES.block_size)
+        self.assertEqual(1, self.keyring.key_id(ciphertext, decode=False))
+        self.assertEqual(u"The eagle flies at midnight!",
+                         self.keyring.decrypt(ciphertext, decode=False))
+
+    def test_stale(self):
+        """
+        Assert only ciphertexts of retired keys on the keyring are stale
+        """
+        self.assertTrue(self.keyring.stale(Cipher("s3cr3t").encrypt("secret")))
+        self.assertFalse(self.keyring.stale(self.keyring.encrypt("secret")))
+
+        other = Keyring(2, "0th3rs3cr3t").encrypt("secret")
+        self.assertEqual(2, self.keyring.key_id(other))
+        self.assertFalse(self.keyring.stale(other))
+
+    def test_unknown_key(self):
+        """
+        Assert ciphertexts of a key not on the keyring fail to decrypt
+        """
+        ciphertext = Keyring(2, "0th3rs3cr3t").encrypt("secret")
+        with self.assertRaises(UnknownKeyError):
+            self.keyring.decrypt(ciphertext)
+        self.assertTrue(issubclass(UnknownKeyError, CheckSumError))
+
+    def test_decrypt_many_keys(self):
+        """
+        Assert a batch of ciphertexts of several keys is decrypted
+        """
+        ciphertexts = [
+            Cipher("s3cr3t").encrypt("first"),
+            self.keyring.encrypt("second"),
+            Keyring(2, "0th3rs3cr3t").encrypt("third"),
+            "not base64!",
+        ]
+        ciphertexts.extend(self.keyring.encrypt_many(["fourth", "fifth"]))
+
+        results = self.keyring.decrypt_many(ciphertexts)
+        self.assertEqual([u"first", u"second"], results[:2])
+        self.assertIsInstance(results[2], UnknownKeyError)
+        self.assertIsInstance(results[3], TypeError)
+        self.assertEqual([u"fourth", u"fifth"], results[4:])
+
+    def test_add_key(self):
+        """
+        Ensure keys have a secret and an id that fits the header
+        """
+        with self.assertRaises(ValueError):
+            self.keyring.add(256, "s3cr3t")
+        with self.assertRaises(TypeError):
+            self.keyring.add(2, None)
+        with self.assertRaises(UnknownKeyError):
+            Keyring(1).encrypt("secret")
+
 class EncryptedFileKeyTest(unittest.TestCase):
 
     FIXTURE_PATH   = "/tmp/private.key"
@@ -0,0 +1,288 @@
+# tests.concurrency_tests
+# Testing the async serving mode and the crypto worker pool.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 12 12:40:18 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: concurrency_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the async serving mode, the crypto worker pool and the background
+queue.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import urllib
+import base64
+import hashlib
+import unittest
+import threading
+
+from flashcube.auth import *
+from flashcube.concurrency import *
+from flashcube.exceptions import ServiceUnavailable
+from flashcube.models import Client
+from flashcube.core import app, db, syncdb, cryptopool, create_app
+from flask import Flask
+from tests import EndpointTestMixin
+from flask.ext.testing import TestCase
+
+##########################################################################
+## Crypto Pool Tests
+##########################################################################
+
+class CryptoPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['FLASHCUBE_CRYPTO_POOL']  = 2
+        self.app.config['FLASHCUBE_CRYPTO_QUEUE'] = 1
+        self.pool = CryptoPool(self.app)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def call(self, func, *args):
+        """
+        Runs the function on the pool from another request (thread).
+        """
+        thread = threading.Thread(target=self.pool.run, args=(func,) + args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def wait_for(self, queued, active, timeout=1.0):
+        """
+        Waits for the gauges of the pool to reach the given values.
+        """
+        for idx in xrange(int(timeout / 0.01)):
+            if (self.pool.queued, self.pool.active) == (queued, active):
+                return
+            threading.Event().wait(0.01)
+        self.fail("pool did not reach %i queued and %i active" % (queued, active))
+
+    def test_inline(self):
+        """
+        Assert functions run in the request without workers
+        """
+        self.app.config['FLASHCUBE_CRYPTO_POOL'] = 0
+        self.pool.init_app(self.app)
+        self.assertIs(threading.current_thread(), self.pool.run(threading.current_thread))
+        self.assertEqual(0, self.pool.completed)
+
+    def test_run(self):
+        """
+        Assert functions run on a worker thread
+        """
+        thread = self.pool.run(threading.current_thread)
+        self.assertIsNot(threading.current_thread(), thread)
+        self.assertTrue(thread.name.startswith("flashcube-crypto-"))
+        self.assertEqual(3, self.pool.run(len, "abc"))
+        self.assertRaises(ZeroDivisionError, self.pool.run, divmod, 1, 0)
+
+        gauges = self.pool.serialize()
+        self.assertEqual(3, gauges['completed'])
+        self.assertEqual(0, gauges['queued'])
+        self.assertEqual(0, gauges['active'])
+
+    def test_concurrent(self):
+        """
+        Assert a slow operation does not stall the other requests
+        """
+        release = threading.Event()
+        slow    = self.call(release.wait)
+        self.wait_for(0, 1)
+
+        self.assertEqual(3, self.pool.run(len, "abc"))
+        self.assertTrue(slow.is_alive())
+
+        release.set()
+        slow.join(1)
+        self.assertFalse(slow.is_alive())
+
+    def test_submit_failure(self):
+        """
+        Assert an operation that is never picked up leaves the gauges right
+        """
+        def broken():
+            raise RuntimeError("the pool was killed")
+
+        self.pool._thread_pool = broken
+        self.assertRaises(RuntimeError, self.pool.run, len, "abc")
+
+        gauges = self.pool.serialize()
+        self.assertEqual(0, gauges['queued'])
+        self.assertEqual(0, gauges['active'])
+        self.assertEqual(0, gauges['completed'])
+
+        # A cancelled submission does not run if a worker picks it up later
+        self.pool.queued += 1
+        submission = Submission(self.pool, len)
+        submission.cancel()
+        self.assertIsNone(submission("abc"))
+        self.assertEqual((0, 0, 0), (self.pool.queued, self.pool.active, self.pool.completed))
+
+    def test_queue_limit(self):
+        """
+        Assert requests are rejected once the queue is full
+        """
+        release = threading.Event()
+        waiting = []
+
+        # Both workers are busy, then one operation waits for them
+        for queued, active in ((0, 1), (0, 2), (1, 2)):
+            waiting.append(self.call(release.wait))
+            self.wait_for(queued, active)
+
+        self.assertEqual(1, self.pool.serialize()['queued'])
+        self.assertRaises(ServiceUnavailable, self.pool.run, len, "abc")
+        self.assertEqual(1, self.pool.rejected)
+
+        release.set()
+        for thread in waiting:
+            thread.join(1)
+
+        self.assertEqual(1, self.pool.peak)
+        self.assertEqual(3, self.pool.completed)
+        self.assertEqual(0, self.pool.queued)
+
+    def test_fork(self):
+        """
+        Assert new workers are started in a forked process
+        """
+        first = self.pool.run(threading.current_thread)
+        self.pool._pid = -1 # As if this process was forked
+        self.assertIsNot(first, self.pool.run(threading.current_thread))
+        self.assertEqual(2, len(self.pool._threads))
+
+    def test_async_mode(self):
+        """
+        Assert the async mode is configured or detected
+        """
+        self.app.config['FLASHCUBE_ASYNC'] = True
+        self.assertTrue(async_mode(self.app))
+        self.app.config['FLASHCUBE_ASYNC'] = False
+        self.assertFalse(async_mode(self.app))
+        self.app.config['FLASHCUBE_ASYNC'] = None
+        self.assertEqual(gevent_patched(), async_mode(self.app))
+
+##########################################################################
+## Background Queue Tests
+##########################################################################
+
+class BackgroundQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['BACKGROUND_QUEUE_SIZE'] = 2
+        self.queue = BackgroundQueue(self.app)
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def test_submit(self):
+        """
+        Assert tasks run in the background in an app context
+        """
+        from flask import current_app
+        results = []
+        self.assertTrue(self.queue.submit("a", lambda x: results.append((x, current_app.name)), 1))
+        self.queue.join()
+
+        self.assertEqual([(1, __name__)], results)
+        self.assertEqual(1, self.queue.completed)
+        self.assertEqual(0, self.queue.serialize()['pending'])
+
+    def test_pending_key(self):
+        """
+        Assert a task is not queued again while its key is pending
+        """
+        release = threading.Event()
+        self.assertTrue(self.queue.submit("a", release.wait))
+        self.assertFalse(self.queue.submit("a", release.wait))
+        self.assertEqual(1, self.queue.submitted)
+
+        release.set()
+        self.queue.join()
+        self.assertTrue(self.queue.submit("a", len, "abc"))
+        self.queue.join()
+        self.assertEqual(2, self.queue.completed)
+
+    def test_queue_full(self):
+        """
+        Assert tasks are dropped once the queue is full
+        """
+        started = threading.Event()
+        release = threading.Event()
+        self.queue.submit("a", lambda: started.set() or release.wait())
+        started.wait(1)
+
+        self.assertTrue(self.queue.submit("b", len, "b"))
+        self.assertTrue(self.queue.submit("c", len, "c"))
+        self.assertFalse(self.queue.submit("d", len, "d"))
+        self.assertEqual(1, self.queue.dropped)
+
+        release.set()
+        self.queue.join()
+        self.assertEqual(3, self.queue.completed)
+
+    def test_failed(self):
+        """
+        Assert a failed task is counted and does not stop the queue
+        """
+        self.queue.submit("a", divmod, 1, 0)
+        self.queue.submit("b", len, "abc")
+        self.queue.join()
+
+        self.assertEqual(1, self.queue.failed)
+        self.assertEqual(1, self.queue.completed)
+
+##########################################################################
+## Crypto Pool Endpoint Tests
+##########################################################################
+
+class CryptoPoolEndpointTest(EndpointTestMixin, TestCase):
+
+    def create_app(self):
+        create_app('flashcube.conf.TestingConfig')
+        app.config['FLASHCUBE_CRYPTO_POOL'] = 2
+        cryptopool.init_app(app)
+        cryptopool.reset()
+        return app
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['FLASHCUBE_CRYPTO_POOL'] = 0
+        cryptopool.init_app(app)
+        db.session.remove()
+        db.drop_all()
+
+    def test_crypto_on_workers(self):
+        """
+        Test credentials are encrypted and decrypted on the workers
+        """
+        email_hash = base64.b64encode(hashlib.sha256('jane@example.com').digest())
+        data       = 'email_hash=%s&password=secret' % urllib.quote(email_hash, '')
+        response   = self.client.post('/cube/', data=data, headers=self.build_auth_headers())
+        self.assertStatus(response, 201)
+
+        endpoint = '/cube/%s/' % urllib.quote(email_hash, '')
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEqual(u'secret', response.json['password'])
+
+        response = self.client.get('/heartbeat/pools/', headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEqual(2, response.json['crypto']['workers'])
+        self.assertEqual(2, response.json['crypto']['completed'])
+        self.assertEqual(0, response.json['crypto']['queued'])
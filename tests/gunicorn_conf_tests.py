@@ -0,0 +1,163 @@
+# tests.gunicorn_conf_tests
+# Testing the gunicorn configuration and the secret handoff.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Mon Nov 16 13:05:27 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: gunicorn_conf_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the gunicorn configuration, both as gunicorn loads it and by
+serving the app with gunicorn in a subprocess.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import urllib2
+import unittest
+import subprocess
+
+from flashcube.gunicorn_conf import cpu_workers
+
+# The configuration module, as given to gunicorn with -c
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "flashcube", "gunicorn_conf.py")
+
+##########################################################################
+## Test Cases
+##########################################################################
+
+class GunicornConfigTest(unittest.TestCase):
+
+    def test_cpu_workers(self):
+        """
+        Assert workers are sized from the CPU count
+        """
+        self.assertEqual(9, cpu_workers("sync", 4))
+        self.assertEqual(4, cpu_workers("gevent", 4))
+        self.assertGreaterEqual(cpu_workers("sync"), 3)
+
+    def test_settings(self):
+        """
+        Assert gunicorn loads the settings from the configuration
+        """
+        from gunicorn.config import Config
+        from gunicorn.app.base import Application
+
+        loader     = Application.__new__(Application)
+        loader.cfg = Config()
+        environ    = {'FLASHCUBE_WORKERS': '3', 'FLASHCUBE_BIND': '127.0.0.1:9999'}
+        original   = dict((key, os.environ.get(key)) for key in environ)
+
+        os.environ.update(environ)
+        try:
+            loader.load_config_from_file(CONFIG)
+        finally:
+            for key, value in original.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+        self.assertEqual(3, loader.cfg.workers)
+        self.assertEqual(['127.0.0.1:9999'], loader.cfg.settings['bind'].get())
+        self.assertTrue(loader.cfg.preload_app)
+        self.assertEqual("flashcube", loader.cfg.proc_name)
+
+class GunicornServerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Find a free port to serve on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        root = os.path.dirname(CONFIG)
+        env  = dict(os.environ)
+        env.pop('FLASHCUBE_PASSPHRASE', None)
+        env.update({
+            'FLASHCUBE_SETTINGS': 'flashcube.conf.TestingConfig',
+            'FLASHCUBE_BIND': '127.0.0.1:%i' % self.port,
+            'FLASHCUBE_WORKERS': '2',
+        })
+
+        # Without a stdin, any prompt for the passphrase fails
+        self.server = subprocess.Popen(
+            [sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()",
+             "-c", CONFIG, "flashcube.wsgi:app"],
+            cwd=os.path.dirname(root), env=env, stdin=open(os.devnull),
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT,
+        )
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.terminate()
+        self.server.wait()
+
+    def get(self, timeout=10):
+        """
+        Fetches the heartbeat, waiting for the server to start.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return json.load(urllib2.urlopen("http://127.0.0.1:%i/heartbeat/" % self.port))
+            except (urllib2.URLError, socket.error):
+                if time.time() > deadline or self.server.poll() is not None: raise
+                time.sleep(0.1)
+
+    def workers(self):
+        """
+        Returns the pids of the worker processes of the server (Linux only).
+        """
+        pids = set()
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open("/proc/%s/stat" % pid) as stat:
+                    if int(stat.read().rsplit(")", 1)[1].split()[1]) == self.server.pid:
+                        pids.add(int(pid))
+            except (IOError, IndexError):
+                continue
+        return pids
+
+    def test_serve_and_reload(self):
+        """
+        Test the workers serve and are reloaded without the passphrase
+        """
+        self.assertTrue(self.get()['success'])
+        if not os.path.isdir("/proc"):
+            return
+
+        for idx in xrange(50):
+            workers = self.workers()
+            if len(workers) == 2: break
+            time.sleep(0.1)
+        self.assertEqual(2, len(workers))
+
+        # The secret is inherited in memory, never in the environment
+        for pid in workers:
+            with open("/proc/%i/environ" % pid) as environ:
+                self.assertNotIn("FLASHCUBE_PASSPHRASE", environ.read())
+
+        # Graceful reload replaces the workers by forking the master again
+        self.server.send_signal(signal.SIGHUP)
+        for idx in xrange(100):
+            reloaded = self.workers()
+            if len(reloaded) == 2 and not reloaded & workers: break
+            time.sleep(0.1)
+
+        self.assertFalse(reloaded & workers, "workers were not replaced")
+        self.assertIsNone(self.server.poll())
+        self.assertTrue(self.get()['success'])
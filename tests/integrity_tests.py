@@ -0,0 +1,187 @@
+# tests.integrity_tests
+# Testing the verification of every stored credential.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 19 11:02:16 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: integrity_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the verification of every stored credential, with credentials
+corrupted in each of the ways that decryption detects.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import base64
+import hashlib
+import tempfile
+import unittest
+
+from flashcube.cipher import *
+from flashcube.models import *
+from flashcube.integrity import *
+from flashcube.rotation import Checkpoint
+from flashcube.core import app, db, syncdb, create_app
+from flask.ext.testing import TestCase
+
+##########################################################################
+## Fixtures
+##########################################################################
+
+CIPHER = Cipher("s3cr3t")
+
+def flip(ciphertext, pos, mask):
+    """
+    Returns the ciphertext with the byte at pos XORed with the mask.
+    """
+    return ciphertext[:pos] + chr(ord(ciphertext[pos]) ^ mask) + ciphertext[pos+1:]
+
+
+def corrupted():
+    """
+    Returns (password, ciphertext) columns corrupted in every way, by the
+    reason that verification reports.
+    """
+    # "secret" and its checksum are padded with 6 bytes of 0x06
+    raw = CIPHER.encrypt("secret", encode=False)
+    return {
+        "invalid base64": ("not base64!", None),
+        "incomplete blocks": (None, raw[:-1]),
+        "unknown key": (Keyring(2, "0th3rs3cr3t").encrypt("secret"), None),
+        "padding mismatch": (None, flip(raw, 15, 0x06)),
+        "checksum mismatch": (base64.b64encode(flip(raw, 0, 0x01)), None),
+        "invalid utf-8": (None, CIPHER.encrypt("\xff\xfe", encode=False)),
+    }
+
+##########################################################################
+## Verification Tests
+##########################################################################
+
+class VerifyRowsTest(unittest.TestCase):
+
+    def test_verify_rows(self):
+        """
+        Assert every kind of corruption is reported
+        """
+        keyring  = Keyring(0, "s3cr3t")
+        expected = corrupted()
+        reasons  = sorted(expected)
+        rows     = [(idx, ) + expected[reason] for idx, reason in enumerate(reasons)]
+        rows.append((len(rows), CIPHER.encrypt(u"s\xe9cret"), None))
+
+        verified, failures = verify_rows(rows, keyring)
+        self.assertEqual(1, verified)
+        self.assertEqual(list(enumerate(reasons)), sorted(failures))
+
+##########################################################################
+## Integrity Scan Tests
+##########################################################################
+
+class IntegrityScanTest(TestCase):
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        self.path    = tempfile.mktemp(suffix=".json")
+        self.keyring = Keyring(0, "s3cr3t")
+
+        for idx in xrange(1, 21):
+            email_hash = base64.b64encode(hashlib.sha256("user%i@example.com" % idx).digest())
+            db.session.add(Credential(email_hash, CIPHER.encrypt("p4ssw0rd-%i" % idx)))
+        db.session.commit()
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        db.session.remove()
+        db.drop_all()
+
+    def corrupt(self):
+        """
+        Corrupts the credentials with ids 1 through 6, returning the ids
+        and reasons of the failures.
+        """
+        failures = []
+        for pk, (reason, (password, ciphertext)) in enumerate(sorted(corrupted().items()), 1):
+            credential = Credential.query.get(pk)
+            credential.password, credential.ciphertext = password, ciphertext
+            failures.append((pk, reason))
+        db.session.commit()
+        return failures
+
+    def verify(self, processes=0, sample=1.0, checkpoint=None, progress=None):
+        checkpoint = checkpoint or Checkpoint(self.path, "verify")
+        scan       = IntegrityScan(self.keyring, checkpoint, processes, chunk=8, size=3, sample=sample)
+
+        scan.start()
+        try:
+            scan.verify(0, db.session, progress)
+        finally:
+            scan.stop()
+        return scan
+
+    def test_verify(self):
+        """
+        Test every credential is verified and the corrupted ones reported
+        """
+        expected = self.corrupt()
+        scan     = self.verify()
+        self.assertEqual(20, scan.examined)
+        self.assertEqual(14, scan.verified)
+        self.assertEqual(expected, sorted(scan.failures))
+
+    def test_verify_processes(self):
+        """
+        Test credentials are verified on a pool of processes
+        """
+        expected = self.corrupt()
+        scan     = self.verify(processes=2)
+        self.assertEqual(14, scan.verified)
+        self.assertEqual(expected, sorted(scan.failures))
+
+    def test_sample(self):
+        """
+        Test only a sample of the credentials is read and verified
+        """
+        scan = self.verify(sample=0.25)
+        self.assertLess(scan.examined, 20)
+        self.assertEqual(scan.examined, scan.verified)
+
+    def test_resume(self):
+        """
+        Test a scan resumes after the last id of its checkpoint
+        """
+        self.corrupt()
+        checkpoint = Checkpoint(self.path, "verify")
+        checkpoint.save(0, 8)
+
+        scan = self.verify(checkpoint=checkpoint.load())
+        self.assertEqual(12, scan.examined)
+        self.assertEqual([], scan.failures)
+        self.assertEqual({0: 20}, Checkpoint(self.path, "verify").load().shards)
+
+    def test_resume_failures(self):
+        """
+        Test a resumed scan reports the failures found before it stopped
+        """
+        expected = self.corrupt()
+
+        def interrupt(scan):
+            raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, self.verify, progress=interrupt)
+        self.assertEqual({0: 8}, Checkpoint(self.path, "verify").load().shards)
+
+        scan = self.verify(checkpoint=Checkpoint(self.path, "verify").load())
+        self.assertEqual(12, scan.examined)
+        self.assertEqual(14, scan.verified)
+        self.assertEqual(expected, sorted(tuple(failure) for failure in scan.failures))
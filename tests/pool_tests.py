@@ -0,0 +1,165 @@
+# tests.pool_tests
+# Testing the instrumented connection pool.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Mon Nov 09 11:26:02 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: pool_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the instrumented connection pool, using SQLite connections.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import sqlite3
+import unittest
+
+from flashcube.auth import *
+from flashcube.pool import *
+from flashcube.models import Client
+from flashcube.core import app, db, syncdb, create_app
+from flask.ext.testing import TestCase
+from sqlalchemy import exc, create_engine
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import Headers
+
+##########################################################################
+## Pool Tests
+##########################################################################
+
+class InstrumentedPoolTest(unittest.TestCase):
+
+    def make_pool(self, **kwargs):
+        return InstrumentedQueuePool(lambda: sqlite3.connect(":memory:"), **kwargs)
+
+    def test_checkout_stats(self):
+        """
+        Assert checkouts and connections are counted
+        """
+        engine = create_engine("sqlite://", poolclass=InstrumentedQueuePool, pool_size=2,
+                               max_overflow=1, pre_ping=True, use_lifo=True)
+        pool   = engine.pool
+        conns  = [pool.connect() for _ in xrange(3)]
+
+        status = pool_status(engine)
+        self.assertTrue(status['pre_ping'])
+        self.assertTrue(status['use_lifo'])
+        self.assertEqual(3, status['checked_out'])
+        self.assertEqual(1, status['overflow'])
+        self.assertEqual(3, status['checkouts'])
+        self.assertEqual(3, status['connects'])
+
+        for conn in conns:
+            conn.close()
+
+        pool.connect().close()
+        self.assertEqual(4, pool.stats.checkouts)
+        self.assertEqual(3, pool.stats.connects)
+        self.assertEqual(0, pool.checkedout())
+
+    def test_timeout_stats(self):
+        """
+        Assert checkout timeouts are counted
+        """
+        pool = self.make_pool(pool_size=1, max_overflow=0, timeout=0.01)
+        conn = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        self.assertEqual(1, pool.stats.timeouts)
+        self.assertGreaterEqual(pool.stats.max_wait, 0.01)
+        conn.close()
+
+    def test_lifo(self):
+        """
+        Assert LIFO pools reuse the most recently returned connection
+        """
+        for use_lifo, expected in ((False, 0), (True, 1)):
+            pool  = self.make_pool(pool_size=2, use_lifo=use_lifo)
+            conns = [pool.connect() for _ in xrange(2)]
+            raw   = [conn.connection for conn in conns]
+            for conn in conns:
+                conn.close()
+
+            conn = pool.connect()
+            self.assertIs(raw[expected], conn.connection)
+            conn.close()
+
+    def test_pre_ping(self):
+        """
+        Assert dropped connections are replaced when pinged
+        """
+        pool = self.make_pool(pool_size=1, pre_ping=True)
+        conn = pool.connect()
+        raw  = conn.connection
+        conn.close()
+
+        raw.close() # Simulate the database dropping the connection
+        conn = pool.connect()
+        self.assertIsNot(raw, conn.connection)
+        self.assertEqual([(1,)], conn.cursor().execute("SELECT 1").fetchall())
+        self.assertEqual(1, pool.stats.failed_pings)
+        conn.close()
+
+        # Recreating the pool keeps the options and statistics
+        recreated = pool.recreate()
+        self.assertTrue(recreated._pre_ping)
+        self.assertIs(pool.stats, recreated.stats)
+
+    def test_engine_options(self):
+        """
+        Assert pool options are only applied to pooled databases
+        """
+        options = {'pool_size': 5, 'max_overflow': 5, 'pre_ping': True, 'use_lifo': True}
+
+        postgres = dict(options)
+        db.apply_driver_hacks(app, make_url("postgresql://localhost/flashcube"), postgres)
+        self.assertIs(InstrumentedQueuePool, postgres['poolclass'])
+        self.assertTrue(postgres['pre_ping'])
+
+        sqlite = dict(options)
+        db.apply_driver_hacks(app, make_url("sqlite:////tmp/flashcube.db"), sqlite)
+        self.assertNotIn('pool_size', sqlite)
+        self.assertNotIn('pre_ping', sqlite)
+
+##########################################################################
+## Pool Endpoint Tests
+##########################################################################
+
+class PoolEndpointTest(TestCase):
+
+    APIKEY = "enQt5RH97mYhj6N8OFYraw"
+    SECRET = "utvyzGJCMOGjZul2BwOh0Roq6RRl1sPW3iOBW1lS0AE"
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_get_pools(self):
+        """
+        Pool statistics are reported for the default database
+        """
+        timestamp = get_utc_timestamp()
+        headers   = Headers()
+        headers.add("Authorization", "FLASHCUBE %s:%s" % (self.APIKEY,
+                    create_hmac(self.APIKEY, self.SECRET, timestamp)))
+        headers.add("Time", str(timestamp))
+
+        self.assert401(self.client.get("/heartbeat/pools/"))
+
+        response = self.client.get("/heartbeat/pools/", headers=headers)
+        self.assert200(response)
+        self.assertIn("default", response.json['pools'])
+        self.assertIn("pool", response.json['pools']['default'])
@@ -0,0 +1,211 @@
+# tests.queries_tests
+# Testing the data access layer for the hot paths.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Tue Nov 10 11:02:57 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: queries_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the data access layer, including a benchmark of the compiled
+statements against the equivalent ORM queries.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import gc
+import sys
+import timeit
+import base64
+import hashlib
+import unittest
+
+from flashcube.models import *
+from tests import benchmark
+from flashcube.queries import *
+from flashcube.core import app, db, syncdb, create_app
+from flask.ext.testing import TestCase
+from sqlalchemy.dialects.postgresql import psycopg2
+
+##########################################################################
+## Test Cases
+##########################################################################
+
+class HotQueriesTest(TestCase):
+
+    APIKEY = "enQt5RH97mYhj6N8OFYraw"
+    SECRET = "utvyzGJCMOGjZul2BwOh0Roq6RRl1sPW3iOBW1lS0AE"
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+
+        self.email_hash = base64.b64encode(hashlib.sha256('jane@example.com').digest())
+        Credential.insert_many([(self.email_hash, 'c2VjcmV0')])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_prepare_sql(self):
+        """
+        Assert statements are prepared with numbered parameters
+        """
+        prepare, execute = UPDATE_CREDENTIAL.prepared(psycopg2.dialect())
+        self.assertTrue(str(prepare).startswith("PREPARE flashcube_update_credential_base64 AS UPDATE"))
+        self.assertIn("$1", str(prepare))
+        self.assertNotIn("%(", str(prepare))
+        self.assertEqual(4, str(prepare).count("$"))
+        self.assertEqual("EXECUTE flashcube_update_credential_base64 (:_password, :_ciphertext, "
+                         ":_updated, :_email_hash)", str(execute))
+
+        # The clauses are only built once, so that they are compiled once
+        self.assertIs(prepare, UPDATE_CREDENTIAL.prepared(psycopg2.dialect())[0])
+        self.assertEqual("flashcube_client_by_apikey", CLIENT_BY_APIKEY.prepared_name)
+
+        # Statements prepared for another email hash storage are not reused
+        app.config['FLASHCUBE_HASH_STORAGE'] = "binary"
+        try:
+            prepare, execute = UPDATE_CREDENTIAL.prepared(psycopg2.dialect())
+            self.assertTrue(str(prepare).startswith("PREPARE flashcube_update_credential_binary AS"))
+            self.assertTrue(str(execute).startswith("EXECUTE flashcube_update_credential_binary ("))
+        finally:
+            app.config['FLASHCUBE_HASH_STORAGE'] = "base64"
+
+        sql, names = HotStatement.numbered("SELECT %(a)s, %(b)s, %(a)s, '100%%'")
+        self.assertEqual("SELECT $1, $2, $1, '100%'", sql)
+        self.assertEqual(['a', 'b'], names)
+
+    def test_get_client(self):
+        """
+        Assert clients are fetched by api key
+        """
+        row = get_client(db.session, self.APIKEY)
+        self.assertEqual("Test Client", row.name)
+        self.assertEqual(self.SECRET, row.secret)
+        self.assertIsNone(get_client(db.session, "1234567890qwertyioasdf"))
+
+    def test_credential_statements(self):
+        """
+        Assert credentials are fetched, updated and deleted by email hash
+        """
+        self.assertEqual(('c2VjcmV0', None), get_credential(db.session, self.email_hash))
+
+        self.assertEqual(1, update_credential(db.session, self.email_hash, ciphertext='secret'))
+        db.session.commit()
+        self.assertEqual((None, 'secret'), get_credential(db.session, self.email_hash))
+
+        self.assertEqual(0, update_credential(db.session, 'x' * 44, password='c2VjcmV0'))
+        self.assertEqual(1, delete_credential(db.session, self.email_hash))
+        self.assertEqual(0, delete_credential(db.session, self.email_hash))
+        db.session.commit()
+        self.assertIsNone(get_credential(db.session, self.email_hash))
+
+    def test_compiled_cache(self):
+        """
+        Assert statements are only compiled once
+        """
+        get_credential(db.session, self.email_hash)
+        size = len(COMPILED_CACHE)
+        for idx in xrange(10):
+            get_credential(db.session, self.email_hash)
+        self.assertEqual(size, len(COMPILED_CACHE))
+
+    @benchmark
+    def test_get_credential_benchmark(self):
+        """
+        Benchmark the compiled lookup against the ORM query
+        """
+        email_hash = self.email_hash
+
+        def baseline():
+            return Credential.query.filter(Credential.email_hash == email_hash).one()
+
+        def compiled():
+            return get_credential(db.session, email_hash)
+
+        # Interleave the measurements so both see the same system noise
+        number  = 500
+        timings = [[], []]
+        for repeat in xrange(5):
+            for idx, func in enumerate((baseline, compiled)):
+                timings[idx].append(timeit.timeit(func, number=number))
+                db.session.commit()
+
+        baseline, compiled = [min(timing) / number * 1e6 for timing in timings]
+
+        self.assertLess(compiled, baseline,
+            "compiled lookup %0.2fus/request is not faster than the ORM %0.2fus/request" % (
+             compiled, baseline))
+
+    def test_get_credential_allocations(self):
+        """
+        Assert the compiled lookup keeps fewer objects alive than the ORM
+        """
+        hashes = [base64.b64encode(hashlib.sha256('user%i@example.com' % idx).digest())
+                  for idx in xrange(100)]
+        Credential.insert_many([(email_hash, 'c2VjcmV0') for email_hash in hashes])
+        db.session.commit()
+
+        def baseline(email_hash):
+            return Credential.query.filter(Credential.email_hash == email_hash).one()
+
+        def compiled(email_hash):
+            return get_credential(db.session, email_hash)
+
+        def retained(func):
+            """
+            Counts the objects tracked by the collector that are still
+            alive per lookup, while the results of the lookups are held.
+            """
+            func(hashes[0]) # Warm up caches, e.g. of the compiled statements
+            db.session.commit()
+            gc.collect()
+            before  = len(gc.get_objects())
+            results = [func(email_hash) for email_hash in hashes]
+            gc.collect()
+            count   = len(gc.get_objects()) - before
+            del results
+            db.session.commit()
+            return float(count) / len(hashes)
+
+        baseline, compiled = retained(baseline), retained(compiled)
+        self.assertLess(compiled, baseline,
+            "compiled lookup retains %0.2f objects/request, the ORM %0.2f objects/request" % (
+             compiled, baseline))
+
+##########################################################################
+## Credential Record Tests
+##########################################################################
+
+class CredentialRecordTest(unittest.TestCase):
+
+    def test_record(self):
+        """
+        Assert records are compact, read-only and unwrap either storage format
+        """
+        record = CredentialRecord(1, 'x' * 44, 'c2VjcmV0')
+        self.assertEqual((), record.__slots__) # No instance __dict__
+        self.assertRaises(AttributeError, setattr, record, 'email', 'jane@example.com')
+        self.assertRaises(AttributeError, setattr, record, 'password', None)
+        self.assertEqual('secret', record.raw_ciphertext)
+
+        record = record._replace(password=None, ciphertext='binary')
+        self.assertEqual('binary', record.raw_ciphertext)
+        self.assertEqual(['ciphertext', 'created', 'email_hash', 'password', 'updated'],
+                         sorted(record.serialize()))
+
+        # Smaller than a mapped instance, even before its state is counted
+        instance = Credential('x' * 44, 'c2VjcmV0')
+        self.assertLess(sys.getsizeof(record),
+                        sys.getsizeof(instance) + sys.getsizeof(instance.__dict__))
@@ -0,0 +1,302 @@
+# tests.replicas_tests
+# Testing the routing of reads to replicas of the primary database.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Fri Nov 06 11:12:40 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: replicas_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the routing of reads to replicas, using local SQLite databases as
+stand-ins for the replicas; rows are "replicated" by copying them.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import time
+import urllib
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from flashcube.auth import *
+from flashcube.models import *
+from flashcube.replicas import *
+from flashcube.core import app, db, syncdb, auth, replicas, create_app
+from flask import Flask
+from tests import EndpointTestMixin
+from flask.ext.testing import TestCase
+from tests.shards_tests import SHARD_SCHEMA
+
+##########################################################################
+## Fixtures
+##########################################################################
+
+# SQLite version of the client table for each replica
+CLIENT_SCHEMA = (
+    'CREATE TABLE "client" ('
+    '"id" INTEGER PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL UNIQUE, '
+    '"description" VARCHAR(1024), '
+    '"ipaddr" VARCHAR(50), '
+    '"apikey" CHAR(22) NOT NULL UNIQUE, '
+    '"secret" CHAR(43) NOT NULL UNIQUE, '
+    '"created" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+    '"updated" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+)
+
+##########################################################################
+## Recent Writes Tests
+##########################################################################
+
+class RecentWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now    = 1000.0
+        self.writes = RecentWrites(window=5, maxsize=1024, timer=lambda: self.now)
+
+    def test_window(self):
+        """
+        Assert written keys are recent until the window passes
+        """
+        self.writes.add('a', 'b')
+        self.assertIn('a', self.writes)
+        self.assertNotIn('c', self.writes)
+
+        self.now += 3
+        self.writes.add('b')
+        self.now += 3
+        self.assertNotIn('a', self.writes)
+        self.assertIn('b', self.writes)
+
+        self.now += 3
+        self.assertNotIn('b', self.writes)
+        self.assertEqual(0, len(self.writes))
+
+    def test_shared_slot(self):
+        """
+        Assert keys that share a slot are recent while either one is
+        """
+        writes = RecentWrites(window=5, maxsize=1, timer=lambda: self.now)
+        writes.add('a')
+        self.assertIn('b', writes)
+        self.assertEqual(1, len(writes))
+
+    def test_across_processes(self):
+        """
+        Assert keys written by a forked process are recent in the others
+        """
+        child = multiprocessing.Process(target=self.writes.add, args=('a', u'b'))
+        child.start()
+        child.join()
+
+        self.assertEqual(0, child.exitcode)
+        self.assertIn('a', self.writes)
+        self.assertIn(u'b', self.writes)
+        self.assertNotIn('c', self.writes)
+
+    def test_clear(self):
+        """
+        Assert cleared writes are no longer recent
+        """
+        self.writes.add('a', 'b')
+        self.writes.clear()
+        self.assertNotIn('a', self.writes)
+        self.assertEqual(0, len(self.writes))
+
+    def test_no_window(self):
+        """
+        Assert nothing is recorded without a window
+        """
+        self.writes.window = 0
+        self.writes.add('a')
+        self.assertNotIn('a', self.writes)
+
+class ReplicaSetTest(unittest.TestCase):
+
+    def test_shared_memory(self):
+        """
+        Assert the recent writes are only allocated with replicas, once
+        """
+        flask   = Flask(__name__)
+        replica = ReplicaSet(db, flask)
+        self.assertIsNone(replica.writes)
+
+        flask.config['FLASHCUBE_REPLICAS'] = ["sqlite://"]
+        replica.init_app(flask)
+        writes = replica.writes
+        self.assertIsNotNone(writes)
+
+        flask.config['FLASHCUBE_WRITE_WINDOW'] = 10
+        replica.init_app(flask)
+        self.assertIs(writes, replica.writes)
+        self.assertEqual(10, writes.window)
+
+##########################################################################
+## Replica Endpoint Tests
+##########################################################################
+
+class ReplicaEndpointsTest(EndpointTestMixin, TestCase):
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the primary database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+        auth.invalidate()
+
+        self.now    = time.time()
+        self.tmpdir = tempfile.mkdtemp(prefix="flashcube-replicas-")
+        replicas.timer = lambda: self.now
+        self.configure("replica.db")
+
+        self.replica = replicas.session(0)
+        self.replica.execute(CLIENT_SCHEMA)
+        self.replica.execute(SHARD_SCHEMA)
+        self.replica.commit()
+        self.replicate()
+
+    def tearDown(self):
+        replicas.remove()
+        replicas.timer = time.time
+        app.config['FLASHCUBE_REPLICAS'] = []
+        replicas.init_app(app)
+        shutil.rmtree(self.tmpdir)
+        auth.invalidate()
+
+        db.session.remove()
+        db.drop_all()
+
+    def configure(self, *names):
+        """
+        Configures a SQLite replica in the temp directory for each name.
+        """
+        app.config['FLASHCUBE_REPLICAS'] = [
+            "sqlite:///%s" % os.path.join(self.tmpdir, name) for name in names
+        ]
+        replicas.init_app(app)
+
+    def replicate(self):
+        """
+        Copies the clients and credentials on the primary to the replica.
+        """
+        self.replica.execute('DELETE FROM "client"')
+        self.replica.execute('DELETE FROM "credential"')
+        for row in db.session.query(Client):
+            self.replica.execute(
+                'INSERT INTO "client" ("name", "apikey", "secret") VALUES (:name, :apikey, :secret)',
+                {'name': row.name, 'apikey': row.apikey, 'secret': row.secret})
+
+        columns = (Credential.email_hash, Credential.password, Credential.ciphertext,
+                   Credential.created, Credential.updated)
+        rows    = [dict((column.name, value) for column, value in zip(columns, row))
+                   for row in db.session.query(*columns)]
+        Credential.restore_many(rows, self.replica)
+        self.replica.commit()
+        db.session.commit()
+
+    def post(self, email_hash, password):
+        data = 'email_hash=%s&password=%s' % (urllib.quote(email_hash, ''), urllib.quote(password, ''))
+        return self.client.post('/cube/', data=data, headers=self.build_auth_headers())
+
+    def get(self, email_hash):
+        endpoint = '/cube/%s/' % urllib.quote(email_hash, '')
+        return self.client.get(endpoint, headers=self.build_auth_headers())
+
+    def test_read_your_writes(self):
+        """
+        Test reads go to the primary only just after a write
+        """
+        email_hash = self.hash_email('jane@example.com', False)
+        self.assertStatus(self.post(email_hash, 'secret'), 201)
+
+        # Not yet replicated, but just written so read from the primary
+        self.assert200(self.get(email_hash))
+
+        # Once the window passes, read from the (stale) replica
+        self.now += app.config['FLASHCUBE_WRITE_WINDOW'] + 1
+        self.assert404(self.get(email_hash))
+
+        self.replicate()
+        response = self.get(email_hash)
+        self.assert200(response)
+        self.assertEqual(u'secret', response.json['password'])
+
+    def test_writes_go_to_primary(self):
+        """
+        Test writes are never sent to the replica
+        """
+        email_hash = self.hash_email('jane@example.com', False)
+        self.assertStatus(self.post(email_hash, 'secret'), 201)
+        self.replicate()
+        self.now += app.config['FLASHCUBE_WRITE_WINDOW'] + 1
+
+        endpoint = '/cube/%s/' % urllib.quote(email_hash, '')
+        self.assert200(self.client.put(endpoint, data='password=changed',
+                                       headers=self.build_auth_headers()))
+
+        # The update is read from the primary until it is replicated
+        self.assertEqual(u'changed', self.get(email_hash).json['password'])
+        self.now += app.config['FLASHCUBE_WRITE_WINDOW'] + 1
+        self.assertEqual(u'secret', self.get(email_hash).json['password'])
+
+        self.assert200(self.client.delete(endpoint, headers=self.build_auth_headers()))
+        self.assertEqual(0, Credential.query.count())
+        self.assertEqual(1, self.replica.query(Credential).count())
+        self.replica.commit()
+
+    def test_mget_replica(self):
+        """
+        Test mget reads from the replica unless a hash was just written
+        """
+        stale = self.hash_email('jane@example.com', False)
+        fresh = self.hash_email('john@example.com', False)
+        self.assertStatus(self.post(stale, 'secret'), 201)
+        self.replicate()
+        self.now += app.config['FLASHCUBE_WRITE_WINDOW'] + 1
+
+        self.assertStatus(self.post(fresh, 'other'), 201)
+        data = 'email_hash=%s&email_hash=%s' % (urllib.quote(stale, ''), urllib.quote(fresh, ''))
+
+        # Both are found, since the fresh hash sends the batch to the primary
+        response = self.client.post('/cube/_mget/', data=data, headers=self.build_auth_headers())
+        self.assertEqual([True, True], [item['success'] for item in response.json['results']])
+
+        self.now += app.config['FLASHCUBE_WRITE_WINDOW'] + 1
+        response = self.client.post('/cube/_mget/', data=data, headers=self.build_auth_headers())
+        self.assertEqual([True, False], [item['success'] for item in response.json['results']])
+
+    def test_replica_failover(self):
+        """
+        Test a failed replica is skipped in favor of the primary
+        """
+        email_hash = self.hash_email('jane@example.com', False)
+        self.assertStatus(self.post(email_hash, 'secret'), 201)
+        self.now += app.config['FLASHCUBE_WRITE_WINDOW'] + 1
+
+        # This replica has no tables, so every query on it fails
+        self.configure("missing.db")
+        self.assertEqual([0], replicas.healthy())
+
+        auth.invalidate()
+        self.assert200(self.get(email_hash))
+        self.assertEqual([], replicas.healthy())
+
+        # Failed replicas are tried again after the retry period
+        self.now += app.config['FLASHCUBE_REPLICA_RETRY'] + 1
+        self.assertEqual([0], replicas.healthy())
+
+        # Queries fail over to the next healthy replica first
+        self.configure("missing.db", "replica.db")
+        self.replicate()
+        self.assert200(self.get(email_hash))
+        self.assertEqual([1], replicas.healthy())
@@ -0,0 +1,234 @@
+# tests.rotation_tests
+# Testing the offline re-encryption of credentials with the current key.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Wed Nov 18 15:31:08 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: rotation_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the offline re-encryption of credentials with the current key.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import base64
+import hashlib
+import tempfile
+import unittest
+
+from flashcube.cipher import *
+from flashcube.models import *
+from flashcube.rotation import *
+from flashcube.core import app, db, syncdb, create_app
+from flask.ext.testing import TestCase
+
+##########################################################################
+## Fixtures
+##########################################################################
+
+def email_hash(idx):
+    return base64.b64encode(hashlib.sha256("user%i@example.com" % idx).digest())
+
+
+def password(idx):
+    return u"p4ssw\xf6rd-%i" % idx
+
+##########################################################################
+## Re-encryption Tests
+##########################################################################
+
+class RewrapRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keyring = Keyring(1, "n3ws3cr3t")
+        self.keyring.add(0, "s3cr3t")
+
+    def test_rewrap_rows(self):
+        """
+        Assert stale rows are re-encrypted in their storage format
+        """
+        legacy = Cipher("s3cr3t")
+        rows   = [
+            (1, legacy.encrypt(password(1)), None),
+            (2, None, legacy.encrypt(password(2), encode=False)),
+            (3, self.keyring.encrypt(password(3)), None),
+            (4, Keyring(2, "0th3rs3cr3t").encrypt(password(4)), None),
+            (5, "not base64!", None),
+        ]
+
+        passwords, binary, current, failed = rewrap_rows(rows, self.keyring)
+        self.assertEqual(1, current)
+        self.assertEqual([4, 5], sorted(failed))
+
+        self.assertEqual([1], [param['_id'] for param in passwords])
+        self.assertEqual(rows[0][1], passwords[0]['_old'])
+        self.assertEqual(password(1), self.keyring.decrypt(passwords[0]['_new']))
+        self.assertFalse(self.keyring.stale(passwords[0]['_new']))
+
+        self.assertEqual([2], [param['_id'] for param in binary])
+        self.assertEqual(rows[1][2], binary[0]['_old'])
+        self.assertEqual(password(2), self.keyring.decrypt(binary[0]['_new'], decode=False))
+
+##########################################################################
+## Checkpoint Tests
+##########################################################################
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix=".json")
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_resume(self):
+        """
+        Assert the progress is resumed by a rotation to the same key
+        """
+        checkpoint = Checkpoint(self.path, 1)
+        self.assertEqual(0, checkpoint.load().last_id(0))
+        checkpoint.save(0, 42)
+        checkpoint.save(1, 7)
+
+        checkpoint.save(1, 9, {'failed': [3]})
+
+        self.assertEqual({0: 42, 1: 9}, Checkpoint(self.path, 1).load().shards)
+        self.assertEqual({'failed': [3]}, Checkpoint(self.path, 1).load().counts)
+        self.assertEqual({}, Checkpoint(self.path, 2).load().shards)
+
+        checkpoint.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual({}, Checkpoint(self.path, 1).load().shards)
+        self.assertEqual({}, Checkpoint(self.path, 1).load().counts)
+
+##########################################################################
+## Rotation Tests
+##########################################################################
+
+class RotationTest(TestCase):
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        self.path    = tempfile.mktemp(suffix=".json")
+        self.keyring = Keyring(1, "n3ws3cr3t")
+        self.keyring.add(0, "s3cr3t")
+
+        # Credentials in both storage formats under the retired key
+        legacy = Cipher("s3cr3t")
+        for idx in xrange(1, 12):
+            if idx % 2:
+                db.session.add(Credential(email_hash(idx), legacy.encrypt(password(idx))))
+            else:
+                db.session.add(Credential(email_hash(idx),
+                    ciphertext=legacy.encrypt(password(idx), encode=False)))
+        db.session.commit()
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        db.session.remove()
+        db.drop_all()
+
+    def stored(self):
+        """
+        Returns the key id and password of each credential, by id.
+        """
+        rows = db.session.query(Credential.id, Credential.password, Credential.ciphertext)
+        rows = rows.order_by(Credential.id).all()
+        db.session.commit()
+
+        stored = []
+        for pk, password, ciphertext in rows:
+            raw = Credential.unwrap(password, ciphertext)
+            stored.append((self.keyring.key_id(raw, decode=False),
+                           self.keyring.decrypt(raw, decode=False)))
+        return stored
+
+    def rotate(self, processes=0, checkpoint=None):
+        checkpoint = checkpoint or Checkpoint(self.path, 1)
+        rotation   = Rotation(self.keyring, checkpoint, processes, chunk=4, size=3)
+        progress   = []
+
+        rotation.start()
+        try:
+            rotation.rotate(0, db.session, lambda rotation: progress.append(rotation.examined))
+        finally:
+            rotation.stop()
+        return rotation, progress
+
+    def test_rotate(self):
+        """
+        Test every credential is re-encrypted with the current key
+        """
+        rotation, progress = self.rotate()
+        self.assertEqual(11, rotation.rotated)
+        self.assertEqual([4, 8, 11], progress)
+        self.assertEqual([(1, password(idx)) for idx in xrange(1, 12)], self.stored())
+        self.assertEqual({0: 11}, Checkpoint(self.path, 1).load().shards)
+
+        # Storage formats are unchanged
+        binary = db.session.query(Credential.id).filter(Credential.ciphertext != None)
+        self.assertEqual(range(2, 12, 2), sorted(pk for pk, in binary))
+
+        rotation, progress = self.rotate(checkpoint=Checkpoint(self.path, 1).load())
+        self.assertEqual(0, rotation.examined)
+
+    def test_rotate_processes(self):
+        """
+        Test credentials are re-encrypted on a pool of processes
+        """
+        rotation, progress = self.rotate(processes=2)
+        self.assertEqual(11, rotation.rotated)
+        self.assertEqual(0, rotation.current)
+        self.assertEqual([(1, password(idx)) for idx in xrange(1, 12)], self.stored())
+
+    def test_resume(self):
+        """
+        Test a rotation resumes after the last id of its checkpoint
+        """
+        checkpoint = Checkpoint(self.path, 1)
+        checkpoint.save(0, 8)
+
+        rotation, progress = self.rotate(checkpoint=checkpoint.load())
+        self.assertEqual(3, rotation.rotated)
+        self.assertEqual([0] * 8 + [1] * 3, [key_id for key_id, _ in self.stored()])
+
+    def test_rotate_twice(self):
+        """
+        Test credentials that are already current are skipped
+        """
+        self.rotate()
+        os.remove(self.path)
+
+        rotation, progress = self.rotate()
+        self.assertEqual(0, rotation.rotated)
+        self.assertEqual(11, rotation.current)
+
+    def test_rewrap_batch(self):
+        """
+        Test a batch only replaces the rows whose stored value is unchanged
+        """
+        rows = db.session.query(Credential.id, Credential.password, Credential.ciphertext)
+        rows = [(pk, password, ciphertext and str(ciphertext))
+                for pk, password, ciphertext in rows.order_by(Credential.id).all()]
+        passwords, binary, current, failed = rewrap_rows(rows, self.keyring)
+
+        # A concurrent write to the first of each storage format
+        passwords[0]['_old'] = passwords[1]['_old']
+        binary[0]['_old']    = binary[1]['_old']
+
+        self.assertEqual(5, Credential.rewrap_batch(passwords, False))
+        self.assertEqual(4, Credential.rewrap_batch(binary, True))
+        db.session.commit()
+        self.assertEqual([0, 0] + [1] * 9, [key_id for key_id, _ in self.stored()])
@@ -0,0 +1,295 @@
+# tests.shards_tests
+# Testing the sharding of credentials across several databases.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Thu Nov 05 16:20:31 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: shards_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing the sharding of credentials, using several local SQLite databases
+as stand-ins for the shards.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import shutil
+import hashlib
+import base64
+import tempfile
+import unittest
+
+from flashcube.auth import *
+from flashcube.models import *
+from flashcube.shards import *
+from flashcube.core import app, db, syncdb, shards, create_app
+from tests import EndpointTestMixin
+from flask.ext.testing import TestCase
+
+##########################################################################
+## Fixtures
+##########################################################################
+
+# SQLite version of the credential table for each shard
+SHARD_SCHEMA = (
+    'CREATE TABLE "credential" ('
+    '"id" INTEGER PRIMARY KEY, '
+    '"email_hash" CHAR(44) NOT NULL UNIQUE, '
+    '"password" VARCHAR(512), '
+    '"ciphertext" BLOB, '
+    '"created" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+    '"updated" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+)
+
+##########################################################################
+## Routing Tests
+##########################################################################
+
+class ShardRoutingTest(unittest.TestCase):
+
+    def test_jump_hash_range(self):
+        """
+        Test that jump hash returns a bucket in range
+        """
+        for key in xrange(1000):
+            self.assertEqual(0, jump_hash(key, 1))
+            self.assertIn(jump_hash(key, 7), range(7))
+
+    def test_jump_hash_stability(self):
+        """
+        Test adding a bucket only moves keys into the new bucket
+        """
+        keys  = [base64.b64encode(hashlib.sha256(str(idx)).digest()) for idx in xrange(2000)]
+        moved = 0
+        for key in keys:
+            before = shard_index(key, 4)
+            after  = shard_index(key, 5)
+            self.assertEqual(before, shard_index(key, 4), "Shard index is not stable")
+            if before != after:
+                self.assertEqual(4, after, "Key moved between existing shards")
+                moved += 1
+
+        # About one fifth of the keys should move to the new shard
+        self.assertTrue(300 < moved < 500, "Moved %i of 2000 keys" % moved)
+
+    def test_hash_storage(self):
+        """
+        Test the shard does not depend on how the email hash is stored
+        """
+        for idx in xrange(200):
+            raw = hashlib.sha256(str(idx)).digest()
+            self.assertEqual(shard_index(raw, 7), shard_index(base64.b64encode(raw), 7))
+
+##########################################################################
+## Sharded Endpoint Tests
+##########################################################################
+
+class ShardedEndpointsTest(EndpointTestMixin, TestCase):
+
+    SHARDS = 3
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Clients remain in the default database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+
+        self.tmpdir = tempfile.mkdtemp(prefix="flashcube-shards-")
+        self.configure(self.SHARDS)
+        for idx in xrange(self.SHARDS):
+            self.execute(idx, SHARD_SCHEMA)
+
+    def tearDown(self):
+        shards.remove()
+        app.config['FLASHCUBE_SHARDS'] = []
+        app.config['FLASHCUBE_RESHARD_FROM'] = None
+        shards.init_app(app)
+        shutil.rmtree(self.tmpdir)
+
+        db.session.remove()
+        db.drop_all()
+
+    def configure(self, count, previous=None):
+        """
+        Configures the given number of SQLite shards in the temp directory.
+        """
+        app.config['FLASHCUBE_SHARDS'] = [
+            "sqlite:///%s" % os.path.join(self.tmpdir, "shard%i.db" % idx)
+            for idx in xrange(count)
+        ]
+        app.config['FLASHCUBE_RESHARD_FROM'] = previous
+        shards.init_app(app)
+
+    def execute(self, idx, sql):
+        session = shards.session(idx)
+        try:
+            return session.execute(sql).fetchall() if sql.startswith("SELECT") else session.execute(sql)
+        finally:
+            session.commit()
+
+    def stored(self, idx):
+        """
+        Returns the email hashes stored on the shard with the given index.
+        """
+        return set(row[0].rstrip() for row in self.execute(idx, 'SELECT "email_hash" FROM "credential"'))
+
+    def post_bulk(self, credentials):
+        data = '&'.join('email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                       self.uriquote(password))
+                        for email_hash, password in credentials.items())
+        return self.client.post('/cube/_bulk/', data=data, headers=self.build_auth_headers())
+
+    def mget(self, email_hashes):
+        data = '&'.join('email_hash=%s' % self.uriquote(email_hash) for email_hash in email_hashes)
+        response = self.client.post('/cube/_mget/', data=data, headers=self.build_auth_headers())
+        self.assert200(response)
+        return dict((item['email_hash'], item['password']) for item in response.json['results']
+                    if item['success'])
+
+    def assertPlaced(self, email_hashes, count=None):
+        """
+        Asserts every email hash is stored only on the shard it belongs on.
+        """
+        for idx in xrange(count or self.SHARDS):
+            expected = set(email_hash for email_hash in email_hashes
+                           if shard_index(email_hash, count or self.SHARDS) == idx)
+            self.assertEqual(expected, self.stored(idx) & set(email_hashes))
+
+    def test_shard_binds(self):
+        """
+        Test each shard has its own engine and session
+        """
+        self.assertTrue(shards.enabled)
+        self.assertEqual(self.SHARDS, len(shards.sessions()))
+
+        engines = set(shards.session(idx).get_bind() for idx in xrange(self.SHARDS))
+        self.assertEqual(self.SHARDS, len(engines))
+        self.assertNotIn(db.engine, engines)
+
+    def test_sharded_credentials(self):
+        """
+        Test POST, GET, PUT and DELETE route to the shard of the hash
+        """
+        emails   = ['user%i@example.com' % idx for idx in xrange(12)]
+        hashes   = [self.hash_email(email, False) for email in emails]
+        headers  = self.build_auth_headers()
+
+        for email_hash in hashes:
+            data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash), self.uriquote('secret'))
+            self.assertStatus(self.client.post("/cube/", data=data, headers=headers), 201)
+
+        self.assertPlaced(hashes)
+        self.assertEqual(0, Credential.query.count(), "Credentials stored in default database")
+
+        # Duplicates are detected on the shard
+        data = 'email_hash=%s&password=%s' % (self.uriquote(hashes[0]), self.uriquote('other'))
+        self.assertStatus(self.client.post('/cube/', data=data, headers=headers), 409)
+
+        for email_hash in hashes:
+            endpoint = "/cube/%s/" % self.uriquote(email_hash)
+            response = self.client.get(endpoint, headers=headers)
+            self.assert200(response)
+            self.assertEqual(u'secret', response.json['password'])
+
+        endpoint = "/cube/%s/" % self.uriquote(hashes[1])
+        self.assert200(self.client.put(endpoint, data='password=changed', headers=headers))
+        self.assertEqual(u'changed', self.client.get(endpoint, headers=headers).json['password'])
+
+        self.assert200(self.client.delete(endpoint, headers=headers))
+        self.assert404(self.client.get(endpoint, headers=headers))
+        self.assertPlaced(hashes[2:])
+
+    def test_sharded_bulk_and_mget(self):
+        """
+        Test bulk POST and mget group email hashes by shard
+        """
+        expected = dict((self.hash_email('user%i@example.com' % idx, False), u'pa$$%i' % idx)
+                        for idx in xrange(20))
+        response = self.post_bulk(expected)
+        self.assert200(response)
+        self.assertTrue(all(item['success'] for item in response.json['results']))
+        self.assertPlaced(expected)
+
+        # Conflicts are still reported per item
+        response = self.post_bulk(dict(expected.items()[:3]))
+        self.assert200(response)
+        self.assertFalse(any(item['success'] for item in response.json['results']))
+
+        self.assertEqual(expected, self.mget(expected))
+
+    def test_malformed_hashes(self):
+        """
+        Test malformed email hashes are rejected before they are routed
+        """
+        headers  = self.build_auth_headers()
+        endpoint = "/cube/foo/"
+        data     = 'email_hash=foo&password=secret'
+
+        self.assert404(self.client.get(endpoint, headers=headers))
+        self.assert404(self.client.put(endpoint, data='password=changed', headers=headers))
+        self.assert404(self.client.delete(endpoint, headers=headers))
+        self.assertStatus(self.client.post("/cube/", data=data, headers=headers), 409)
+
+        # Only the malformed items of a batch fail
+        valid    = self.hash_email('jane@example.com', False)
+        response = self.post_bulk({valid: u'secret', 'foo': u'secret'})
+        self.assert200(response)
+        results  = dict((item['email_hash'], item['success']) for item in response.json['results'])
+        self.assertEqual({valid: True, 'foo': False}, results)
+        self.assertEqual({valid: u'secret'}, self.mget([valid, 'foo']))
+
+    def test_reshard_online(self):
+        """
+        Test credentials are served while moved onto a new shard
+        """
+        expected = dict((self.hash_email('user%i@example.com' % idx, False), u'pa$$%i' % idx)
+                        for idx in xrange(30))
+        self.assert200(self.post_bulk(expected))
+        self.assertPlaced(expected)
+
+        # Add a shard, still reading from the previous placement
+        self.configure(self.SHARDS + 1, self.SHARDS)
+        self.execute(self.SHARDS, SHARD_SCHEMA)
+        headers = self.build_auth_headers()
+
+        moving = [email_hash for email_hash in expected
+                  if shard_index(email_hash, self.SHARDS) != shards.index(email_hash)]
+        self.assertTrue(moving, "No credentials need to move")
+
+        self.assertEqual(expected, self.mget(expected))
+
+        # Writes to a credential that has not moved yet are not duplicated
+        endpoint = "/cube/%s/" % self.uriquote(moving[0])
+        data = 'email_hash=%s&password=%s' % (self.uriquote(moving[0]), self.uriquote('other'))
+        self.assertStatus(self.client.post('/cube/', data=data, headers=headers), 409)
+        self.assert200(self.client.put(endpoint, data='password=changed', headers=headers))
+        expected[moving[0]] = u'changed'
+
+        # Move the credentials in small batches
+        total = 0
+        for idx in xrange(shards.count):
+            after = 0
+            while True:
+                last, moved, skipped = reshard_batch(shards, idx, after, 4)
+                if last is None: break
+                self.assertEqual([], skipped)
+                total += moved
+                after  = last
+
+        self.assertEqual(len(moving), total)
+        self.assertPlaced(expected, self.SHARDS + 1)
+
+        # Once done, the previous placement is no longer needed
+        self.configure(self.SHARDS + 1)
+        for email_hash, password in expected.items():
+            response = self.client.get("/cube/%s/" % self.uriquote(email_hash), headers=headers)
+            self.assert200(response)
+            self.assertEqual(password, response.json['password'])
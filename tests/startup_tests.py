@@ -0,0 +1,100 @@
+# tests.startup_tests
+# Testing the import time of the command line utilities and the workers.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Fri Nov 13 11:20:45 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: startup_tests.py [] benjamin@bengfort.com $
+
+"""
+Testing what the command line utilities and the worker boot path load at
+import, in a fresh interpreter for each import. Import times vary between
+machines, so they are only checked against a budget by the benchmarks.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+from tests import benchmark
+
+# Reports the import time of a module, and what it loaded, as JSON
+MEASURE = (
+    "import sys, time, json; started = time.time(); import %s; "
+    "elapsed = time.time() - started; %s; "
+    "print json.dumps({'elapsed': elapsed, 'flask': 'flask' in sys.modules, "
+    "'sqlalchemy': 'sqlalchemy' in sys.modules, 'loaded': loaded})"
+)
+
+##########################################################################
+## Test Cases
+##########################################################################
+
+class StartupTest(unittest.TestCase):
+
+    # Import time budgets, in seconds
+    KEYGEN_BUDGET = 0.15
+    WORKER_BUDGET = 1.0
+
+    def measure(self, module, loaded="loaded = None", repeat=1, **environ):
+        """
+        Imports the module in new interpreters, returning the fastest run.
+        """
+        env = dict(os.environ)
+        env.pop('FLASHCUBE_PASSPHRASE', None)
+        env.update(environ)
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        runs = []
+        for idx in xrange(repeat):
+            # Without a stdin, any prompt for the passphrase fails
+            output = subprocess.check_output([sys.executable, "-c", MEASURE % (module, loaded)],
+                                             cwd=root, env=env, stdin=open(os.devnull))
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        return min(runs, key=lambda run: run['elapsed'])
+
+    def test_keygen_startup(self):
+        """
+        Assert flashcube-keygen does not import the app
+        """
+        run = self.measure("flashcube.console.secret")
+        self.assertFalse(run['flask'], "flashcube-keygen imported Flask")
+        self.assertFalse(run['sqlalchemy'], "flashcube-keygen imported SQLAlchemy")
+
+    def test_worker_startup(self):
+        """
+        Assert the worker boots without loading the secret
+        """
+        run = self.measure("flashcube.wsgi", "from flashcube.core import crypto; loaded = crypto.loaded",
+                           FLASHCUBE_SETTINGS="flashcube.conf.DevelopmentConfig")
+        self.assertFalse(run['loaded'], "the worker loaded the secret at boot")
+
+    @benchmark
+    def test_keygen_startup_benchmark(self):
+        """
+        Benchmark the import time of flashcube-keygen against its budget
+        """
+        run = self.measure("flashcube.console.secret", repeat=3)
+        self.assertLess(run['elapsed'], self.KEYGEN_BUDGET,
+            "flashcube-keygen imports in %0.1fms, over the budget of %0.1fms" % (
+             run['elapsed'] * 1000, self.KEYGEN_BUDGET * 1000))
+
+    @benchmark
+    def test_worker_startup_benchmark(self):
+        """
+        Benchmark the boot time of the worker against its budget
+        """
+        run = self.measure("flashcube.wsgi", repeat=3,
+                           FLASHCUBE_SETTINGS="flashcube.conf.DevelopmentConfig")
+        self.assertLess(run['elapsed'], self.WORKER_BUDGET,
+            "the worker boots in %0.1fms, over the budget of %0.1fms" % (
+             run['elapsed'] * 1000, self.WORKER_BUDGET * 1000))
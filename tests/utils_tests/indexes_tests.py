@@ -0,0 +1,84 @@
+# tests.utils_tests.indexes_tests
+# The testing module for flashcube.utils.indexes module.
+#
+# Author:   Benjamin Bengfort <benjamin@bengfort.com>
+# Created:  Tue Nov 03 10:31:44 2015 -0500
+#
+# Copyright (C) 2015 Bengfort.com
+# For license information, see LICENSE.txt
+#
+# ID: indexes_tests.py [] benjamin@bengfort.com $
+
+"""
+The testing module for flashcube.utils.indexes module.
+"""
+
+##########################################################################
+## Imports
+##########################################################################
+
+import unittest
+
+from flashcube.utils.indexes import *
+
+##########################################################################
+## Test Cases
+##########################################################################
+
+class IndexAuditTest(unittest.TestCase):
+
+    def make_index(self, name, tablename='credential', columns='2 3126 0', **kwargs):
+        fields = {
+            'expressions': '', 'predicate': '', 'method': 'btree',
+            'is_unique': False, 'is_primary': False, 'is_constraint': False,
+            'scans': 10, 'size': 8192, 'definition': '',
+        }
+        fields.update(kwargs)
+        return Index(name, tablename, columns, **fields)
+
+    def test_duplicate_of_constraint(self):
+        """
+        Assert a plain index duplicating a UNIQUE constraint is redundant
+        """
+        unique = self.make_index('credential_email_hash_key', is_unique=True, is_constraint=True)
+        plain  = self.make_index('idx_credential_email_hash')
+
+        redundant = redundant_indexes([plain, unique])
+        self.assertEqual([(plain, unique)], redundant)
+        self.assertTrue(droppable(plain))
+        self.assertFalse(droppable(unique))
+
+    def test_distinct_indexes(self):
+        """
+        Assert indices that differ in table, columns, method or predicate are kept
+        """
+        indexes = [
+            self.make_index('idx_a'),
+            self.make_index('idx_b', tablename='client'),
+            self.make_index('idx_c', columns='3 3126 0'),
+            self.make_index('idx_d', method='hash'),
+            self.make_index('idx_e', predicate='(ciphertext IS NULL)'),
+        ]
+        self.assertEqual([], redundant_indexes(indexes))
+
+    def test_many_duplicates(self):
+        """
+        Assert all but the preferred of many duplicate indices are redundant
+        """
+        indexes = [self.make_index(name) for name in ('idx_c', 'idx_a', 'idx_b')]
+        redundant = redundant_indexes(indexes)
+        self.assertEqual(['idx_b', 'idx_c'], [index.name for index, _ in redundant])
+        self.assertEqual(set(['idx_a']), set(kept.name for _, kept in redundant))
+
+    def test_unused_indexes(self):
+        """
+        Assert unscanned indices that do not enforce constraints are unused
+        """
+        indexes = [
+            self.make_index('idx_scanned'),
+            self.make_index('idx_unscanned', scans=0),
+            self.make_index('credential_pkey', scans=0, is_unique=True,
+                            is_primary=True, is_constraint=True),
+            self.make_index('idx_unique', scans=0, is_unique=True),
+        ]
+        self.assertEqual(['idx_unscanned'], [index.name for index in unused_indexes(indexes)])
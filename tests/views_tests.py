@@ -20,29 +20,25 @@ Uses flask-testing with a client to make api calls.
 
 import os
 
-import urllib
 import hashlib
 import base64
 
 from flashcube.auth import *
 from flashcube.models import *
-from flashcube import app, db, syncdb
+from flashcube.cipher import EncryptedFileKey
+from flashcube.core import app, db, syncdb, crypto, background, create_app, schema_context
+from tests import EndpointTestMixin
 from flask.ext.testing import TestCase
-from werkzeug.datastructures import Headers
 
 
 ##########################################################################
 ## Test Cases
 ##########################################################################
 
-class FlashcubeEndpointsTest(TestCase):
-
-    APIKEY = "enQt5RH97mYhj6N8OFYraw"
-    SECRET = "utvyzGJCMOGjZul2BwOh0Roq6RRl1sPW3iOBW1lS0AE"
+class FlashcubeEndpointsTest(EndpointTestMixin, TestCase):
 
     def create_app(self):
-        app.config.from_object('flashcube.conf.TestingConfig')
-        return app
+        return create_app('flashcube.conf.TestingConfig')
 
     def setUp(self):
         syncdb() # Uses the schema to create the database
@@ -54,32 +50,6 @@ class FlashcubeEndpointsTest(TestCase):
         db.session.remove()
         db.drop_all()
 
-    def build_auth_headers(self, apikey=None, secret=None, timestamp=None):
-        timestamp = timestamp or get_utc_timestamp()
-        apikey    = apikey or self.APIKEY
-        secret    = secret or self.SECRET
-        hmaccode  = create_hmac(apikey, secret, timestamp)
-        headers   = Headers()
-        headers.add("Authorization", "FLASHCUBE %s:%s" % (self.APIKEY, hmaccode))
-        headers.add("Time", str(timestamp))
-        headers.add("Content-Type", "application/x-www-form-urlencoded")
-
-        return headers
-
-    def uriquote(self, value):
-        """
-        Ensures slashes get quoted.
-        """
-        if isinstance(value, unicode):
-            value = value.encode('utf8')
-        return urllib.quote(value, '')
-
-    def hash_email(self, email, quote=True):
-        hashb64 = base64.b64encode(hashlib.sha256(email).digest())
-        if quote:
-            return self.uriquote(hashb64)
-        return hashb64
-
     def test_not_found_root(self):
         """
         Test the root directory returns 404
@@ -218,6 +188,24 @@ class FlashcubeEndpointsTest(TestCase):
                                     headers=self.build_auth_headers())
         self.assertStatus(response, 409)
 
+    def test_post_duplicate_unchanged(self):
+        """
+        Assert a duplicate POST does not overwrite the credential
+        """
+        email_hash = self.hash_email('ben@example.com', False)
+        for password in ('supersecretpass', 'othersecretpass'):
+            data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                  self.uriquote(password))
+            response = self.client.post('/cube/', data=data,
+                                        headers=self.build_auth_headers())
+
+        self.assertStatus(response, 409)
+        self.assertEqual(1, Credential.query.filter(Credential.email_hash == email_hash).count())
+
+        endpoint = '/cube/%s/' % self.uriquote(email_hash)
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assertEquals('supersecretpass', response.json['password'])
+
     def test_post_blank_password(self):
         """
         Assert password cannot be blank in POST
@@ -521,13 +509,471 @@ class FlashcubeEndpointsTest(TestCase):
         self.assert401(self.client.get(endpoint, **kwargs))
         self.assert401(self.client.put(endpoint, **kwargs))
         self.assert401(self.client.delete(endpoint, **kwargs))
+        self.assert401(self.client.post('/cube/_mget/', **kwargs))
 
-class HeartbeatEndpointsTest(TestCase):
+    def test_mget_credentials(self):
+        """
+        Can GET many credentials in a single request
+        """
+        expected = [
+            (self.hash_email('aleis@example.com', False), u'supersecretpa$$'),
+            (self.hash_email('jenny@example.com', False), u'déguiser'),
+        ]
+
+        for email_hash, password in expected:
+            data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                  self.uriquote(password))
+            response = self.client.post('/cube/', data=data,
+                                        headers=self.build_auth_headers())
+            self.assertStatus(response, 201)
+
+        data = '&'.join('email_hash=%s' % self.uriquote(email_hash)
+                        for email_hash, _ in expected)
+        response = self.client.post('/cube/_mget/', data=data,
+                                    headers=self.build_auth_headers())
+
+        self.assert200(response)
+        json = response.json
+
+        # Test success flag
+        self.assertIn('success', json, "No success flag on response")
+        self.assertEquals(True, json['success'], "Success bool incorrect for status code")
+
+        # Test results are returned in request order
+        self.assertIn('results', json, "No results returned")
+        self.assertEquals(len(expected), len(json['results']))
+        for (email_hash, password), item in zip(expected, json['results']):
+            self.assertEquals(True, item['success'])
+            self.assertEquals(email_hash, item['email_hash'])
+            self.assertEquals(password, item['password'])
+
+    def test_mget_not_found_items(self):
+        """
+        A missing hash in a multi-get does not fail the batch
+        """
+        found   = self.hash_email('james@example.com', False)
+        missing = self.hash_email('grant@example.com', False)
+        data = 'email_hash=%s&password=%s' % (self.uriquote(found),
+                                              self.uriquote('k1tt3ns$r3CUTE*&'))
+        response = self.client.post('/cube/', data=data,
+                                    headers=self.build_auth_headers())
+
+        data = 'email_hash=%s&email_hash=%s' % (self.uriquote(missing),
+                                                self.uriquote(found))
+        response = self.client.post('/cube/_mget/', data=data,
+                                    headers=self.build_auth_headers())
+
+        self.assert200(response)
+        missed, item = response.json['results']
+
+        self.assertEquals(False, missed['success'])
+        self.assertEquals(missing, missed['email_hash'])
+        self.assertEquals(404, missed['error']['status'])
+
+        self.assertEquals(True, item['success'])
+        self.assertEquals(found, item['email_hash'])
+
+    def test_mget_email_required(self):
+        """
+        Assert at least one email hash is required to multi-get
+        """
+        response = self.client.post('/cube/_mget/', data='',
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 409)
+
+    def test_mget_batch_limit(self):
+        """
+        Assert the batch limit is respected by multi-get
+        """
+        limit = app.config['FLASHCUBE_BATCH_LIMIT']
+        data  = '&'.join('email_hash=%s' % self.hash_email('user%i@example.com' % idx)
+                         for idx in xrange(limit + 1))
+        response = self.client.post('/cube/_mget/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 409)
+
+    def test_bulk_post_credentials(self):
+        """
+        Test the bulk POST of many credentials to flashcube
+        """
+        expected = [
+            (self.hash_email('ben@example.com', False), u'supersecretpass'),
+            (self.hash_email('gwen@example.com', False), u'exonérée'),
+            (self.hash_email('andy@example.com', False), u'sk7n3t4ler#'),
+        ]
+
+        data = '&'.join('email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                       self.uriquote(password))
+                        for email_hash, password in expected)
+        response = self.client.post('/cube/_bulk/', data=data,
+                                    headers=self.build_auth_headers())
+
+        self.assert200(response)
+        json = response.json
+
+        # Test success flag
+        self.assertIn('success', json, "No success flag on response")
+        self.assertEquals(True, json['success'], "Success bool incorrect for status code")
+
+        # Test every item was created
+        self.assertEquals(len(expected), len(json['results']))
+        for (email_hash, _), item in zip(expected, json['results']):
+            self.assertEquals(True, item['success'])
+            self.assertEquals(email_hash, item['email_hash'])
+            self.assertEquals('created', item['status'])
+
+        # Test the credentials can be fetched
+        for email_hash, password in expected:
+            endpoint = '/cube/%s/' % self.uriquote(email_hash)
+            response = self.client.get(endpoint, headers=self.build_auth_headers())
+            self.assert200(response)
+            self.assertEquals(password, response.json['password'])
+
+    def test_bulk_post_conflicts(self):
+        """
+        Duplicate and existing hashes are conflicts in a bulk POST
+        """
+        existing = self.hash_email('ben@example.com', False)
+        fresh    = self.hash_email('arden@example.com', False)
+
+        data = 'email_hash=%s&password=%s' % (self.uriquote(existing),
+                                              self.uriquote('supersecretpass'))
+        response = self.client.post('/cube/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 201)
+
+        items = ((existing, 'othersecretpass'), (fresh, 'gangnamstyle'),
+                 (fresh, 'gangnamstyle'), (fresh, ''))
+        data  = '&'.join('email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                        self.uriquote(password))
+                         for email_hash, password in items)
+        response = self.client.post('/cube/_bulk/', data=data,
+                                    headers=self.build_auth_headers())
+
+        self.assert200(response)
+        statuses = [item['status'] if item['success'] else item['error']['status']
+                    for item in response.json['results']]
+        self.assertEquals([409, 'created', 409, 409], statuses)
+
+    def test_bulk_post_mismatched_pairs(self):
+        """
+        Assert every email hash requires a password in a bulk POST
+        """
+        data = 'email_hash=%s&email_hash=%s&password=%s' % (
+            self.hash_email('ben@example.com'), self.hash_email('gwen@example.com'),
+            self.uriquote('supersecretpass'))
+        response = self.client.post('/cube/_bulk/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 409)
+
+    def test_binary_storage(self):
+        """
+        Test credentials are stored as raw ciphertext in binary mode
+        """
+        app.config['FLASHCUBE_STORAGE'] = 'binary'
+        email_hash = self.hash_email('allen@example.com', False)
+        password   = u'exonérée'
+        data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                              self.uriquote(password))
+
+        response = self.client.post('/cube/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 201)
+
+        obj = Credential.query.filter(Credential.email_hash == email_hash).one()
+        self.assertIsNone(obj.password)
+        self.assertEquals(32, len(obj.ciphertext))
+
+        endpoint = '/cube/%s/' % self.uriquote(email_hash)
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals(password, response.json['password'])
+
+    def test_mixed_storage(self):
+        """
+        Test both storage formats are readable during the transition
+        """
+        expected = [
+            (self.hash_email('ben@example.com', False), u'supersecretpass'),
+            (self.hash_email('gwen@example.com', False), u'sk7n3t4ler#'),
+        ]
+
+        for storage, (email_hash, password) in zip(('base64', 'binary'), expected):
+            app.config['FLASHCUBE_STORAGE'] = storage
+            data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                  self.uriquote(password))
+            response = self.client.post('/cube/', data=data,
+                                        headers=self.build_auth_headers())
+            self.assertStatus(response, 201)
+
+        data = '&'.join('email_hash=%s' % self.uriquote(email_hash)
+                        for email_hash, _ in expected)
+        response = self.client.post('/cube/_mget/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals([password for _, password in expected],
+                          [item['password'] for item in response.json['results']])
+
+        # A PUT rewrites the credential in the current storage format
+        app.config['FLASHCUBE_STORAGE'] = 'base64'
+        endpoint = '/cube/%s/' % self.uriquote(expected[1][0])
+        response = self.client.put(endpoint, data='password=puppies4lief',
+                                   headers=self.build_auth_headers())
+        self.assert200(response)
+
+        obj = Credential.query.filter(Credential.email_hash == expected[1][0]).one()
+        self.assertIsNone(obj.ciphertext)
+        self.assertEquals(u'puppies4lief', self.client.get(endpoint,
+                          headers=self.build_auth_headers()).json['password'])
+
+    def test_convert_storage(self):
+        """
+        Test the online conversion of stored credentials in batches
+        """
+        expected = dict((self.hash_email('user%i@example.com' % idx, False), u'pa$$%i' % idx)
+                        for idx in xrange(5))
+        data = '&'.join('email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                       self.uriquote(password))
+                        for email_hash, password in expected.items())
+        response = self.client.post('/cube/_bulk/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assert200(response)
+
+        for binary in (True, False):
+            after, total = 0, 0
+            while after is not None:
+                after, converted, failed = Credential.convert_batch(after, 2, binary)
+                db.session.commit()
+                total += converted
+                self.assertEquals([], failed)
+            self.assertEquals(len(expected), total)
+
+            for obj in Credential.query.all():
+                self.assertEquals(binary, obj.password is None)
+                self.assertEquals(binary, obj.ciphertext is not None)
+
+            for email_hash, password in expected.items():
+                endpoint = '/cube/%s/' % self.uriquote(email_hash)
+                response = self.client.get(endpoint, headers=self.build_auth_headers())
+                self.assertEquals(password, response.json['password'])
+
+    def test_copy_credentials(self):
+        """
+        Test the chunked copy of credentials into another table
+        """
+        expected = dict((self.hash_email('user%i@example.com' % idx, False), u'pa$$%i' % idx)
+                        for idx in xrange(5))
+        data = '&'.join('email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                       self.uriquote(password))
+                        for email_hash, password in expected.items())
+        response = self.client.post('/cube/_bulk/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assert200(response)
+
+        db.session.execute('CREATE TABLE credential_copy AS SELECT * FROM credential WHERE 1 = 0')
+        try:
+            after, total = 0, 0
+            while True:
+                last, copied = Credential.copy_batch('credential_copy', after, 2)
+                db.session.commit()
+                if last is None: break
+                after  = last
+                total += copied
+
+            self.assertEquals(len(expected), total)
+            rows = db.session.execute('SELECT * FROM credential ORDER BY id').fetchall()
+            copy = db.session.execute('SELECT * FROM credential_copy ORDER BY id').fetchall()
+            self.assertEquals(rows, copy)
+        finally:
+            db.session.rollback()
+            db.session.execute('DROP TABLE credential_copy')
+            db.session.commit()
+
+class BinaryHashEndpointsTest(EndpointTestMixin, TestCase):
+    """
+    The endpoints with email hashes stored as binary digests; the setting
+    is made before syncdb, so that the table is created with a BYTEA.
+    """
 
     def create_app(self):
-        app.config.from_object('flashcube.conf.TestingConfig')
+        create_app('flashcube.conf.TestingConfig')
+        app.config['FLASHCUBE_HASH_STORAGE'] = 'binary'
         return app
 
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_binary_email_hash(self):
+        """
+        Test email hashes are stored as 32 byte digests in binary mode
+        """
+        self.assertEquals("BYTEA", schema_context()['email_hash_type'])
+        email_hash = self.hash_email('james@example.com', False)
+        endpoint   = '/cube/%s/' % self.uriquote(email_hash)
+        data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                              self.uriquote(u'déguiser'))
+
+        response = self.client.post('/cube/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 201)
+
+        response = self.client.post('/cube/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 409)
+
+        obj = Credential.query.one()
+        self.assertEquals(hashlib.sha256('james@example.com').digest(), obj.email_hash)
+
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals(email_hash, response.json['email_hash'])
+        self.assertEquals(u'déguiser', response.json['password'])
+
+        response = self.client.put(endpoint, data='password=puppies4lief',
+                                   headers=self.build_auth_headers())
+        self.assert200(response)
+
+        data = 'email_hash=%s&email_hash=%s' % (self.uriquote(email_hash),
+                                                self.hash_email('gwen@example.com'))
+        response = self.client.post('/cube/_mget/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertEquals([True, False], [item['success'] for item in response.json['results']])
+        self.assertEquals(u'puppies4lief', response.json['results'][0]['password'])
+
+        response = self.client.delete(endpoint, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals(0, Credential.query.count())
+
+    def test_binary_email_hash_invalid(self):
+        """
+        Test invalid email hashes are rejected in binary mode
+        """
+        invalid = base64.b64encode('tooshort')
+
+        data = 'email_hash=%s&password=%s' % (self.uriquote(invalid), 'gangnamstyle')
+        response = self.client.post('/cube/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertStatus(response, 409)
+
+        endpoint = '/cube/%s/' % self.uriquote(invalid)
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assert404(response)
+
+        data = 'email_hash=%s&password=%s&email_hash=%s&password=%s' % (
+            self.uriquote(invalid), 'gangnamstyle',
+            self.hash_email('gwen@example.com'), 'gangnamstyle')
+        response = self.client.post('/cube/_bulk/', data=data,
+                                    headers=self.build_auth_headers())
+        self.assertEquals([False, True], [item['success'] for item in response.json['results']])
+
+class KeyRotationEndpointsTest(EndpointTestMixin, TestCase):
+
+    KEYPATH = "/tmp/flashcube-retired.key"
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
+    def setUp(self):
+        syncdb() # Uses the schema to create the database
+        db.session.add(Client("Test Client", self.APIKEY, self.SECRET))
+        db.session.commit()
+
+        # Store credentials under the secret of the testing config (key 0)
+        self.credentials = [
+            (base64.b64encode(hashlib.sha256(email).digest()), password)
+            for email, password in (('aleis@example.com', u'supersecretpa$$'),
+                                    ('jenny@example.com', u'd\xe9guiser'))
+        ]
+        for email_hash, password in self.credentials:
+            data = 'email_hash=%s&password=%s' % (self.uriquote(email_hash),
+                                                  self.uriquote(password))
+            response = self.client.post('/cube/', data=data, headers=self.build_auth_headers())
+            self.assertStatus(response, 201)
+
+        # Then retire it to a key file and rotate to key 1
+        EncryptedFileKey(self.KEYPATH).write(app.config['FLASHCUBE_SECRET'], password="p4ssphr4se")
+        os.environ['FLASHCUBE_PASSPHRASE'] = "p4ssphr4se"
+        app.config['FLASHCUBE_SECRET']  = "n3ws3cr3tsauce"
+        app.config['FLASHCUBE_KEY_ID']  = 1
+        app.config['FLASHCUBE_KEYRING'] = {0: self.KEYPATH}
+        crypto.reset()
+
+    def tearDown(self):
+        background.join()
+        os.environ.pop('FLASHCUBE_PASSPHRASE', None)
+        if os.path.exists(self.KEYPATH):
+            os.remove(self.KEYPATH)
+
+        create_app('flashcube.conf.TestingConfig') # Restores the keyring
+        db.session.remove()
+        db.drop_all()
+
+    def key_ids(self):
+        """
+        Returns the ids of the keys of the stored credentials.
+        """
+        db.session.remove() # Read what the background thread committed
+        rows = db.session.execute('SELECT password, ciphertext FROM credential').fetchall()
+        return [crypto.key_id(Credential.unwrap(*row), decode=False) for row in rows]
+
+    def test_rewrap_on_get(self):
+        """
+        Test credentials of a retired key are re-encrypted when read
+        """
+        email_hash, password = self.credentials[0]
+        endpoint = '/cube/%s/' % self.uriquote(email_hash)
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals(password, response.json['password'])
+
+        background.join()
+        self.assertEquals([0, 1], sorted(self.key_ids()))
+
+        response = self.client.get(endpoint, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals(password, response.json['password'])
+
+    def test_rewrap_on_mget(self):
+        """
+        Test credentials of a retired key are re-encrypted when read in bulk
+        """
+        data = '&'.join('email_hash=%s' % self.uriquote(email_hash)
+                        for email_hash, _ in self.credentials)
+        response = self.client.post('/cube/_mget/', data=data, headers=self.build_auth_headers())
+        self.assert200(response)
+        self.assertEquals([password for _, password in self.credentials],
+                          [item['password'] for item in response.json['results']])
+
+        background.join()
+        self.assertEquals([1, 1], self.key_ids())
+
+    def test_rewrap_disabled(self):
+        """
+        Test credentials are not re-encrypted if rewrapping is disabled
+        """
+        app.config['FLASHCUBE_REWRAP'] = False
+        try:
+            email_hash, password = self.credentials[0]
+            endpoint = '/cube/%s/' % self.uriquote(email_hash)
+            response = self.client.get(endpoint, headers=self.build_auth_headers())
+            self.assertEquals(password, response.json['password'])
+        finally:
+            app.config['FLASHCUBE_REWRAP'] = True
+
+        background.join()
+        self.assertEquals([0, 0], self.key_ids())
+
+class HeartbeatEndpointsTest(TestCase):
+
+    def create_app(self):
+        return create_app('flashcube.conf.TestingConfig')
+
     def setUp(self):
         syncdb() # Uses the schema to create the database
 